@@ -2,10 +2,16 @@ from assassyn.frontend import *
 from instruction import *
 from RS import *
 from lsq import *
+from vec_alu import *
 from opcodes import *
 from utils import *
+from perf import *
+from csr import *
 
 ROB_SIZE = 8
+VALUE_PREDICTION = False    # 按 PC 预测 load 的结果，后面依赖它的指令不用等 load 提交；默认关掉，打开以后看 vp_* 的统计
+VP_LOG_SIZE = 4             # 值预测表的项数取 log
+VP_CONF_BITS = 2            # 连续预测对这么多次（计数器饱和）之后才真正使用预测值
 
 class ROB(Module):
 
@@ -15,7 +21,8 @@ class ROB(Module):
             "signals": Port(decoder_signals),
             "addr": Port(Bits(32)),
             "predicted_taken": Port(Bits(1)),
-            "pred_next_pc": Port(Bits(32))
+            "pred_next_pc": Port(Bits(32)),
+            "tid": Port(Bits(1))
         }, no_arbiter = True)
         self.name = "ROB"
 
@@ -32,23 +39,64 @@ class ROB(Module):
         result_array_from_mul_alu: Array,
         pc_result_array_from_mul_alu: Array,
         signal_array_from_mul_alu: Array,
+        rob_index_array_from_div_alu: Array,
+        result_array_from_div_alu: Array,
+        pc_result_array_from_div_alu: Array,
+        signal_array_from_div_alu: Array,
+        rob_index_array_from_vec_alu: Array,
+        signal_array_from_vec_alu: Array,
+        write_vrf_array_from_vec_alu: Array,
+        vd_array_from_vec_alu: Array,
+        lane_result_arrays_from_vec_alu: list,
+        scalar_result_array_from_vec_alu: Array,
         rob_index_array_from_lsq: Array,
         result_array_from_lsq: Array,
         pc_result_array_from_lsq: Array,
         signal_array_from_lsq: Array,
+        store_rob_index_array_from_lsq: Array,
+        store_pc_result_array_from_lsq: Array,
+        store_signal_array_from_lsq: Array,
         memory_place_array: Array,
+        load_bank_array: Array,
+        vec_load_valid_array: Array,
+        vec_load_beat_array: Array,
+        vec_load_bank_array: Array,
+        vec_load_rob_index_array: Array,
+        vrf: list,
         clear_signal_array: Array,
-        reset_pc_addr_array: Array,
+        reset_pc_addr_arrays: list,
+        thread_clear_arrays: list,
         rs: RS,
         lsq: LSQ,
+        load_credit_array: Array,
+        store_credit_array: Array,
+        atomic_signal_array: Array,
+        atomic_rob_index_array: Array,
+        atomic_result_array: Array,
+        vec_alu: VEC_ALU,
         bht_array: Array,
         btb_target_array: Array,
-        bht_log_size: int
+        bht_log_size: int,
+        conf_array: Array,
+        commit_valid_array: Array,
+        commit_addr_array: Array,
+        hartid: int,
+        halt_arrays: list,
+        threads: int,
+        thread_count_arrays: list,
+        thread_halt_arrays: list,
+        perf: PerfCounters
     ):
         # log("signal_array_from_mul_alu: {}", signal_array_from_mul_alu[0])
-        rf_value_array = RegArray(Bits(32), 32)
-        rf_recorder_array = RegArray(Bits(3), 32)
-        rf_has_recorder_array = [RegArray(Bits(1), 1) for _ in range(32)]
+        # 多核时每个核从同一个入口开始执行，a0 里放着自己的 hartid
+        # SMT 时每个线程也算一个 hart，各有一份寄存器堆和重命名表；ROB 条目不分区，记下自己属于哪个线程
+        # 一个线程清空流水线时只清它自己：它在 ROB 里更年轻的条目标成作废，照常执行完，走到 head 时不提交直接退出，
+        # 不写寄存器堆、不写内存；别的线程的条目和前端都不受影响
+        rf_value_arrays = [RegArray(Bits(32), 32, initializer = [hartid * threads + t if i == 10 else 0 for i in range(32)])
+                           for t in range(threads)]
+        rf_recorder_arrays = [RegArray(Bits(3), 32) for _ in range(threads)]
+        rf_has_recorder_arrays = [[RegArray(Bits(1), 1) for _ in range(32)] for _ in range(threads)]
+        csrs = CSRCounters()        # SMT 时各线程共用一组计数器
 
         allocated_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]
         ready_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]
@@ -64,6 +112,9 @@ class ROB(Module):
         is_branch_array = RegArray(Bits(1), ROB_SIZE)
         is_load_or_store_array = RegArray(Bits(1), ROB_SIZE)
         is_mult_array = RegArray(Bits(1), ROB_SIZE)
+        is_csr_read_array = RegArray(Bits(1), ROB_SIZE)     # csrrs：提交时读计数器，不用 ALU 算出的值
+        is_div_array = RegArray(Bits(1), ROB_SIZE)
+        is_compressed_array = RegArray(Bits(1), ROB_SIZE)
         predicted_taken_array = RegArray(Bits(1), ROB_SIZE)
         pred_next_pc_array = RegArray(Bits(32), ROB_SIZE)
 
@@ -73,16 +124,61 @@ class ROB(Module):
         rs2_array = RegArray(Bits(5), ROB_SIZE)
         imm_array = RegArray(Bits(32), ROB_SIZE)
         mul_result_array = RegArray(Bits(32), ROB_SIZE)
+        div_result_array = RegArray(Bits(32), ROB_SIZE)
         calc_result_array = RegArray(Bits(32), ROB_SIZE)
         load_result_array = RegArray(Bits(32), ROB_SIZE)
         memory_length_array = RegArray(Bits(2), ROB_SIZE)
+        memory_signed_array = RegArray(Bits(1), ROB_SIZE)
         pc_result_array = [RegArray(Bits(32), 1) for _ in range(ROB_SIZE)]
+        is_elim_array = RegArray(Bits(1), ROB_SIZE)                              # 在重命名阶段就被消除，不经过 RS 和 ALU
+        elim_wait_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]      # 被消除的 move 还在等源寄存器的值
+        elim_recorder_array = RegArray(Bits(3), ROB_SIZE)
+        elim_const_array = RegArray(Bits(32), ROB_SIZE)
+        elim_value_array = [RegArray(Bits(32), 1) for _ in range(ROB_SIZE)]
         addr_array = RegArray(Bits(32), ROB_SIZE)
+        is_vector_array = RegArray(Bits(1), ROB_SIZE)
+        vec_op_array = RegArray(Bits(3), ROB_SIZE)
+        vd_array = RegArray(Bits(3), ROB_SIZE)
+        vs1_array = RegArray(Bits(3), ROB_SIZE)
+        vs2_array = RegArray(Bits(3), ROB_SIZE)
+        vec_issued_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]   # 向量运算已经发给 VEC_ALU
+        vec_result_array = RegArray(Bits(32), ROB_SIZE)                      # vredsum 写回标量寄存器的值
+        is_hammock_array = RegArray(Bits(1), ROB_SIZE)
+        is_predicated_array = RegArray(Bits(1), ROB_SIZE)
+        pred_unsafe_array = RegArray(Bits(1), ROB_SIZE)     # 在影子里不能简单作废的指令：访存、分支、向量、ebreak
+        shadow_active = [RegArray(Bits(1), 1) for _ in range(threads)]     # 一条谓词化的分支跳转了，它的影子还没有提交完
+        shadow_lo = [RegArray(Bits(32), 1) for _ in range(threads)]
+        shadow_hi = [RegArray(Bits(32), 1) for _ in range(threads)]
+        tid_array = RegArray(Bits(1), ROB_SIZE)
+        dead_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]       # SMT 时所在的线程已经清空，这条是错误路径上的
+        vp_used_array = RegArray(Bits(1), ROB_SIZE)                         # 这条 load 的结果已经被预测出去了
+        vp_value_array = RegArray(Bits(32), ROB_SIZE)
+        vp_wrong_array = [RegArray(Bits(1), 1) for _ in range(ROB_SIZE)]     # load 写回时发现预测错了，提交时要清空后面的指令
+
+        # 值预测表：last 是最近一次提交的结果，spec 是最近一次预测出去的值，二者之差按 stride 递推
+        vp_last = RegArray(Bits(32), 1 << VP_LOG_SIZE)
+        vp_stride = RegArray(Bits(32), 1 << VP_LOG_SIZE)
+        vp_conf = RegArray(Bits(VP_CONF_BITS), 1 << VP_LOG_SIZE)
+        vp_spec = [RegArray(Bits(32), 1) for _ in range(1 << VP_LOG_SIZE)]
+
+        # ROB 自己记着 load 队列和 store 队列各占了多少条，LSQ 每退出一条就还回一个 credit
+        lq_used = RegArray(Int(32), 1, initializer = [0])
+        sq_used = RegArray(Int(32), 1, initializer = [0])
 
         rob_phys_full = (rob_size[0] >= Int(32)(ROB_SIZE))
         rob_empty = (rob_size[0] == Int(32)(0))
 
-        receive, signals, addr, predicted_taken, pred_next_pc = self.pop_all_ports(True)
+        receive, signals, addr, predicted_taken, pred_next_pc, tid = self.pop_all_ports(True)
+
+        def rf_value(t, reg):
+            return by_thread(t, [arr[reg] for arr in rf_value_arrays])
+
+        def rf_recorder(t, reg):
+            return by_thread(t, [arr[reg] for arr in rf_recorder_arrays])
+
+        def rf_has_recorder(t, reg):
+            return by_thread(t, [read_mux(arrs, reg, 32, 1) for arrs in rf_has_recorder_arrays])
+
         rd = signals.rd
         has_rd = signals.rd_valid
         rs1 = signals.rs1
@@ -107,56 +203,222 @@ class ROB(Module):
         updated_head_ptr = head_ptr + Int(32)(1)
         updated_head_ptr = (updated_head_ptr == Int(32)(ROB_SIZE)).select(Int(32)(0), updated_head_ptr)
         
-        commit = ~rob_empty & read_mux(ready_array, head_idx, ROB_SIZE, 1)
+        # ebreak 不提交，停在 head 上直到模拟结束
+        head_dead = read_mux(dead_array, head_idx, ROB_SIZE, 1) if threads > 1 else Bits(1)(0)
+        commit = ~rob_empty & read_mux(ready_array, head_idx, ROB_SIZE, 1) & ~is_final_array[head_idx] & ~head_dead
+        # 作废的条目做完就退出；ebreak 和向量运算在 head 上才会开始执行，作废了就不再执行，直接退出
+        dead_retire = ~rob_empty & head_dead & (read_mux(ready_array, head_idx, ROB_SIZE, 1) | is_final_array[head_idx] |
+                                                (is_vector_array[head_idx] & ~is_load_or_store_array[head_idx]))
         
-        pc_seq = (addr_array[head_idx].bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
-        pc_result_val = read_mux(pc_result_array, head_idx, ROB_SIZE, 32)
+        inst_len = is_compressed_array[head_idx].select(Int(32)(2), Int(32)(4))
+        pc_seq = (addr_array[head_idx].bitcast(Int(32)) + inst_len).bitcast(Bits(32))
+        # 只有跳转指令的下一条 PC 要用执行单元算出来的结果，其余指令按自己的长度顺序执行
+        pc_result_val = is_branch_array[head_idx].select(read_mux(pc_result_array, head_idx, ROB_SIZE, 32), pc_seq)
         actual_taken = (pc_result_val != pc_seq)
         pred_taken_stored = predicted_taken_array[head_idx]
         pred_next_pc_stored = pred_next_pc_array[head_idx]
         
-        is_misprediction = commit & (pc_result_val != pred_next_pc_stored)
+        # 谓词化的分支跳转时不算预测错误：影子里的指令照常提交，只是写回 rd 原来的值，相当于在影子末尾做了一次选择
+        # 影子里有不能作废的指令时，退回到清空流水线，从分支目标重新取指
+        head_addr = addr_array[head_idx]
+        head_tid = tid_array[head_idx]
+        head_predicated = is_predicated_array[head_idx]
+        in_shadow = by_thread(head_tid, [shadow_active[t][0] & (head_addr > shadow_lo[t][0]) & (head_addr < shadow_hi[t][0])
+                                         for t in range(threads)])
+        head_shadow_hi = by_thread(head_tid, [hi[0] for hi in shadow_hi])
+        shadow_flush = ~rob_empty & in_shadow & pred_unsafe_array[head_idx] & ~head_dead
+
+        # 值预测错了的 load 照常提交正确的结果，只是把后面用过预测值的指令都清掉，从下一条重新取指
+        vp_squash = commit & vp_used_array[head_idx] & read_mux(vp_wrong_array, head_idx, ROB_SIZE, 1)
+
+        # SMT 时一个线程的 ebreak 到了 head，这个线程就停下来；还有别的线程在跑的话这条 ebreak 退出 ROB，
+        # 只清空这个线程后面的指令，所有线程都停下来以后才算这个核停下来
+        halt = ~rob_empty & is_final_array[head_idx] & ~in_shadow & ~head_dead
+        if threads > 1:
+            others_running = Bits(1)(0)
+            for t in range(threads):
+                running = Bits(1)(0)
+                for u in range(threads):
+                    if u != t:
+                        running = running | ~thread_halt_arrays[u][0]
+                others_running = (head_tid == Bits(1)(t)).select(running, others_running)
+            thread_retire = halt & others_running
+            core_halt = halt & ~others_running
+        else:
+            thread_retire = Bits(1)(0)
+            core_halt = halt
+
+        is_misprediction = (commit & (pc_result_val != pred_next_pc_stored) & ~head_predicated) | shadow_flush | vp_squash | thread_retire
+        # 单线程时清空整个后端；SMT 时只清空 head 所在的线程，后端的 clear 不再拉起
+        if threads > 1:
+            squash = [is_misprediction & (head_tid == Bits(1)(t)) for t in range(threads)]
+            global_flush = Bits(1)(0)
+        else:
+            squash = [is_misprediction]
+            global_flush = is_misprediction
+        # 这个周期送来的指令属于正在清空的线程时，它也在错误路径上
+        squash_in = by_thread(tid, squash)
+        retire = commit | dead_retire | thread_retire
         
         has_unresolved_branch = Bits(1)(0)
         for i in range(ROB_SIZE):
             has_unresolved_branch = has_unresolved_branch | (allocated_array[i][0] & is_branch_array[i])
         stall_for_store = has_unresolved_branch & is_memory_write
-        should_receive = ~rob_phys_full & receive & (~clear_signal_array[0])
+        needs_lq = is_load_or_store & signals.memory[0:0]
+        needs_sq = is_load_or_store & signals.memory[1:1]
+        # 前端清空以后下一个周期到的指令是清空之前译码的，要么在错误路径上，要么排在一条收不下的指令后面，都丢掉
+        front_clear = by_thread(tid, [c[0] for c in thread_clear_arrays])
+        incoming = receive & (~clear_signal_array[0]) & ~front_clear
+        lsq_overflow = incoming & ((needs_lq & (lq_used[0] >= Int(32)(LOAD_QUEUE_SIZE))) |
+                                   (needs_sq & (sq_used[0] >= Int(32)(STORE_QUEUE_SIZE))))
+        should_receive = ~rob_phys_full & incoming & ~lsq_overflow
+        # ROB 或者 LSQ 装不下送来的指令时不能把它丢掉：让它所在线程的前端从这条指令重新取指，后端不清空，
+        # 跟在它后面已经在路上的指令在下个周期被 front_clear 丢掉。这个周期正在清空的线程送来的指令本来就在错误路径上
+        dropped = incoming & (rob_phys_full | lsq_overflow) & ~squash_in
+        refetch = [dropped & (tid == Bits(1)(t)) for t in range(threads)]
 
-        with Condition(should_receive & ~is_misprediction):
+        with Condition(should_receive & ~squash_in):
             rd_valid_array[tail_idx] = has_rd
             predicted_taken_array[tail_idx] = predicted_taken
             pred_next_pc_array[tail_idx] = pred_next_pc
 
-        with Condition(should_receive & ~is_misprediction & has_rd):
+        with Condition(should_receive & ~squash_in & has_rd):
             rd_array[tail_idx] = rd
-        with Condition(should_receive & ~is_misprediction & has_rs1):
+        with Condition(should_receive & ~squash_in & has_rs1):
             rs1_array[tail_idx] = rs1
-        with Condition(should_receive & ~is_misprediction & has_rs2):
+        with Condition(should_receive & ~squash_in & has_rs2):
             rs2_array[tail_idx] = rs2
-        with Condition(should_receive & ~is_misprediction & has_imm):
+        with Condition(should_receive & ~squash_in & has_imm):
             imm_array[tail_idx] = imm
 
+        # 作废的条目退出时也要广播，后面等它的作废条目才能做完；它们不会被别的线程的条目等待
         modify_recorder = ~rob_empty & read_mux(ready_array, head_idx, ROB_SIZE, 1) & rd_valid_array[head_idx]
         rs_modify_recorder = modify_recorder
         lsq_modify_recorder = modify_recorder
         modify_value = is_load_or_store_array[head_idx].select(load_result_array[head_idx], calc_result_array[head_idx])
         modify_value = is_mult_array[head_idx].select(mul_result_array[head_idx], modify_value)
+        modify_value = is_div_array[head_idx].select(div_result_array[head_idx], modify_value)
+        modify_value = is_elim_array[head_idx].select(read_mux(elim_value_array, head_idx, ROB_SIZE, 32), modify_value)
+        modify_value = (is_vector_array[head_idx] & ~is_load_or_store_array[head_idx]).select(vec_result_array[head_idx], modify_value)
+        # 计数器在提交时读，读到的是这条指令之前提交的指令数和当前的周期数
+        modify_value = is_csr_read_array[head_idx].select(csrs.read(imm_array[head_idx][0:11]), modify_value)
+        modify_value = in_shadow.select(rf_value(head_tid, rd_array[head_idx]), modify_value)
+
+        # move / 零习语消除：结果等于某个源寄存器的值加上一个常数的指令不需要发射
+        #   addi rd, rs, 0 / add rd, rs, x0 / or rd, x0, rs 之类的 move  -> 源寄存器的值
+        #   addi rd, x0, imm / lui rd, imm                            -> 常数 imm
+        #   xor rd, rs, rs / sub rd, rs, rs                           -> 0
+        # 被消除的指令在分派时就算完成，到 head 时不用等它的源：源比它老，源提交广播时它把值取进 elim_value，
+        # 它最早也要下个周期才到 head。后面读它 rd 的指令在重命名时直接换成它的源（见 rename_src），
+        # 源提交（或者 load 提前唤醒）时就能发射，不用再等这条 move 提交
+        alu_type = signals.alu
+        is_add = (alu_type == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_ADD))
+        is_or = (alu_type == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_OR)) | (alu_type == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_ORI))
+        is_xor = (alu_type == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_XOR))
+        is_sub = (alu_type == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_SUB))
+        plain = has_rd & ~is_branch & ~is_load_or_store & ~signals.is_pc_calc & ~signals.csr_read & ~signals.csr_write & ~signals.is_mepc
+        rs1_zero = ~has_rs1 | (rs1 == Bits(5)(0))
+        rs2_zero = rs2 == Bits(5)(0)
+        imm_zero = imm == Bits(32)(0)
+        reg_form = has_rs2 & ~has_imm
+
+        imm_const = plain & has_imm & (is_add | is_or | is_xor) & rs1_zero
+        imm_move = plain & has_imm & (is_add | is_or | is_xor) & ~rs1_zero & imm_zero
+        reg_move_rs1 = plain & reg_form & (is_add | is_or | is_xor) & ~rs1_zero & rs2_zero
+        reg_move_rs2 = plain & reg_form & (is_add | is_or | is_xor) & rs1_zero
+        zero_idiom = plain & reg_form & (is_xor | is_sub) & (rs1 == rs2)
 
-        rs_write = should_receive & ~is_misprediction & (~is_load_or_store)
-        lsq_write = should_receive & ~is_misprediction & is_load_or_store
+        is_move = imm_move | reg_move_rs1 | reg_move_rs2
+        is_idiom = imm_const | zero_idiom
+        eliminated = is_move | is_idiom
+        elim_src = reg_move_rs2.select(rs2, rs1)
+        elim_src = is_idiom.select(Bits(5)(0), elim_src)
+        elim_const = imm_const.select(imm, Bits(32)(0))
 
-        with Condition(should_receive & ~is_misprediction):
+        # 重命名：寄存器的 recorder 是一条被消除的 move 时换成 move 的源，
+        # move 还在等源就等源的 recorder（move 的常数一定是 0），已经取到值就直接用这个值
+        def rename_src(reg):
+            rec = rf_recorder(tid, reg)
+            has = rf_has_recorder(tid, reg)
+            via_elim = has & is_elim_array[rec]
+            elim_waiting = via_elim & read_mux(elim_wait_array, rec, ROB_SIZE, 1)
+            elim_done = via_elim & ~elim_waiting
+            value = elim_done.select(read_mux(elim_value_array, rec, ROB_SIZE, 32), rf_value(tid, reg))
+            rec = elim_waiting.select(elim_recorder_array[rec], rec)
+            return rec, has & ~elim_done, value
+
+        elim_src_recorder, elim_src_has_recorder, elim_src_value = rename_src(elim_src)
+        src_coincidence = elim_src_has_recorder & modify_recorder & (elim_src_recorder == head_idx.bitcast(Bits(3)))
+        src_ready = (elim_src == Bits(5)(0)) | ~elim_src_has_recorder | src_coincidence
+        src_value = (elim_src == Bits(5)(0)).select(Bits(32)(0), src_coincidence.select(modify_value, elim_src_value))
+        elim_value = (src_value.bitcast(Int(32)) + elim_const.bitcast(Int(32))).bitcast(Bits(32))
+
+        # 值预测：置信度饱和的 load 在分派时就给出预测值，之后读它 rd 的指令直接拿预测值，不再等它提交
+        # 同一条 load 可能有好几个实例在飞，spec 每预测一次往前推一个 stride
+        vp_load = should_receive & ~squash_in & is_load_or_store & ~is_memory_write & ~signals.is_vector & \
+                  has_rd & (rd != Bits(5)(0))
+        vp_idx = addr[1:VP_LOG_SIZE].bitcast(Bits(VP_LOG_SIZE))
+        vp_pred = (read_mux(vp_spec, vp_idx, 1 << VP_LOG_SIZE, 32).bitcast(Int(32)) + vp_stride[vp_idx].bitcast(Int(32))).bitcast(Bits(32))
+        vp_use = Bits(1)(1 if VALUE_PREDICTION else 0) & vp_load & \
+                 (vp_conf[vp_idx] == Bits(VP_CONF_BITS)((1 << VP_CONF_BITS) - 1))
+
+        rs1_recorder, rs1_has_recorder, rs1_value = rename_src(rs1)
+        rs2_recorder, rs2_has_recorder, rs2_value = rename_src(rs2)
+        rs1_vp = (rs1 != Bits(5)(0)) & rs1_has_recorder & vp_used_array[rs1_recorder]
+        rs2_vp = (rs2 != Bits(5)(0)) & rs2_has_recorder & vp_used_array[rs2_recorder]
+        rs1_value = rs1_vp.select(vp_value_array[rs1_recorder], rs1_value)
+        rs2_value = rs2_vp.select(vp_value_array[rs2_recorder], rs2_value)
+        rs1_has_recorder = rs1_has_recorder & ~rs1_vp
+        rs2_has_recorder = rs2_has_recorder & ~rs2_vp
+
+        # 向量寄存器堆没有重命名，向量运算不进 RS，等它成为 ROB head 时再发给 VEC_ALU
+        rs_write = should_receive & ~squash_in & (~is_load_or_store) & ~eliminated & ~signals.is_vector
+        lsq_write = should_receive & ~squash_in & is_load_or_store
+
+        with Condition(should_receive & ~squash_in):
             # log("ROB entry {} allocated", tail_ptr)
+            tid_array[tail_idx] = tid
             is_branch_array[tail_idx] = is_branch
             is_memory_write_array[tail_idx] = is_memory_write
             is_reg_write_array[tail_idx] = is_reg_write
             addr_array[tail_idx] = addr
             is_load_or_store_array[tail_idx] = is_load_or_store
             is_mult_array[tail_idx] = signals.is_mult
+            is_csr_read_array[tail_idx] = signals.csr_calculate
+            is_div_array[tail_idx] = signals.is_div
+            is_compressed_array[tail_idx] = signals.is_compressed
             memory_length_array[tail_idx] = signals.memory_length
-            write1hot(ready_array, tail_idx, Bits(1)(0))
+            memory_signed_array[tail_idx] = signals.mem_ext[0:0]
+            write1hot(ready_array, tail_idx, eliminated)
             is_final_array[tail_idx] = is_final
+            is_elim_array[tail_idx] = eliminated
+            write1hot(elim_wait_array, tail_idx, eliminated & ~src_ready)
+            write1hot(elim_value_array, tail_idx, elim_value)
+            elim_recorder_array[tail_idx] = elim_src_recorder
+            elim_const_array[tail_idx] = elim_const
+            is_vector_array[tail_idx] = signals.is_vector
+            vec_op_array[tail_idx] = signals.vec_op
+            vd_array[tail_idx] = signals.vd
+            vs1_array[tail_idx] = signals.vs1
+            vs2_array[tail_idx] = signals.vs2
+            write1hot(vec_issued_array, tail_idx, Bits(1)(0))
+            is_hammock_array[tail_idx] = signals.is_hammock
+            is_predicated_array[tail_idx] = signals.is_predicated
+            pred_unsafe_array[tail_idx] = is_load_or_store | is_branch | signals.is_vector | is_final
+            vp_used_array[tail_idx] = vp_use
+            vp_value_array[tail_idx] = vp_pred
+            write1hot(vp_wrong_array, tail_idx, Bits(1)(0))
+            if threads > 1:
+                write1hot(dead_array, tail_idx, Bits(1)(0))
+
+        for i in range(ROB_SIZE):
+            capture = allocated_array[i][0] & elim_wait_array[i][0] & modify_recorder & (elim_recorder_array[i] == head_idx.bitcast(Bits(3)))
+            with Condition(capture):
+                elim_value_array[i][0] = (modify_value.bitcast(Int(32)) + elim_const_array[i].bitcast(Int(32))).bitcast(Bits(32))
+                elim_wait_array[i][0] = Bits(1)(0)
+
+        perf.incr("rob_moves_eliminated", should_receive & ~squash_in & is_move)
+        perf.incr("rob_idioms_eliminated", should_receive & ~squash_in & is_idiom)
 
         rob_index_from_alu = rob_index_array_from_alu[0]
         write_result_from_alu = signal_array_from_alu[0]
@@ -175,44 +437,109 @@ class ROB(Module):
             mul_result_array[rob_index_from_mul_alu[0:2]] = result_array_from_mul_alu[0]
             write1hot(pc_result_array, rob_index_from_mul_alu[0:2], pc_result_array_from_mul_alu[0], width = 3)
             write1hot(ready_array, rob_index_from_mul_alu[0:2], Bits(1)(1), width = 3)
+
+        rob_index_from_div_alu = rob_index_array_from_div_alu[0]
+        write_result_from_div_alu = signal_array_from_div_alu[0]
+        write_result_from_div_alu = write_result_from_div_alu & read_mux(allocated_array, rob_index_from_div_alu[0:2], ROB_SIZE, 1)
+        with Condition(write_result_from_div_alu):
+            #log("Write back from DIV ALU to ROB entry {} | value: 0x{:08x}", rob_index_from_div_alu[0:2], result_array_from_div_alu[0])
+            div_result_array[rob_index_from_div_alu[0:2]] = result_array_from_div_alu[0]
+            write1hot(pc_result_array, rob_index_from_div_alu[0:2], pc_result_array_from_div_alu[0], width = 3)
+            write1hot(ready_array, rob_index_from_div_alu[0:2], Bits(1)(1), width = 3)
         
         rob_index_from_lsq = rob_index_array_from_lsq[0]
         write_signal_from_lsq = signal_array_from_lsq[0]
         write_result_from_lsq = write_signal_from_lsq & read_mux(allocated_array, rob_index_from_lsq[0:2], ROB_SIZE, 1)
-        load_byte = (memory_length_array[rob_index_from_lsq[0:2]] == Bits(2)(0))
-        result_byte = Bits(8)(0)
-        result_byte = (memory_place_array[0] == Bits(2)(0)).select(result_array_from_lsq[0][0:7], result_byte)
-        result_byte = (memory_place_array[0] == Bits(2)(1)).select(result_array_from_lsq[0][8:15], result_byte)
-        result_byte = (memory_place_array[0] == Bits(2)(2)).select(result_array_from_lsq[0][16:23], result_byte)
-        result_byte = (memory_place_array[0] == Bits(2)(3)).select(result_array_from_lsq[0][24:31], result_byte)
+        load_value = load_bus_value(result_array_from_lsq, load_bank_array[0], memory_place_array[0], memory_length_array[rob_index_from_lsq[0:2]],
+                                    memory_signed_array[rob_index_from_lsq[0:2]])
         with Condition(write_result_from_lsq):
-            load_result_array[rob_index_from_lsq[0:2]] = load_byte.select(concat(Bits(24)(0), result_byte), result_array_from_lsq[0].bitcast(Bits(32)))
+            load_result_array[rob_index_from_lsq[0:2]] = load_value
+            write1hot(vp_wrong_array, rob_index_from_lsq[0:2], vp_value_array[rob_index_from_lsq[0:2]] != load_value, width = 3)
             write1hot(pc_result_array, rob_index_from_lsq[0:2], pc_result_array_from_lsq[0], width = 3)
             write1hot(ready_array, rob_index_from_lsq[0:2], Bits(1)(1), width = 3)
 
+        # 向量运算在 ROB head 上发射，此时更早的指令都已经提交，读到的向量寄存器就是最新的值
+        vec_issue = ~rob_empty & is_vector_array[head_idx] & ~is_load_or_store_array[head_idx] & \
+                    ~read_mux(ready_array, head_idx, ROB_SIZE, 1) & ~read_mux(vec_issued_array, head_idx, ROB_SIZE, 1) & \
+                    ~clear_signal_array[0] & ~head_dead
+        with Condition(vec_issue):
+            write1hot(vec_issued_array, head_idx, Bits(1)(1))
+        vec_alu.async_called(
+            valid = vec_issue,
+            rob_index = head_idx.bitcast(Bits(3)),
+            op = vec_op_array[head_idx],
+            vd = vd_array[head_idx],
+            vs1 = vs1_array[head_idx],
+            vs2 = vs2_array[head_idx]
+        )
+
+        rob_index_from_vec_alu = rob_index_array_from_vec_alu[0]
+        write_result_from_vec_alu = signal_array_from_vec_alu[0] & read_mux(allocated_array, rob_index_from_vec_alu[0:2], ROB_SIZE, 1)
+        with Condition(write_result_from_vec_alu):
+            vec_result_array[rob_index_from_vec_alu[0:2]] = scalar_result_array_from_vec_alu[0]
+            write1hot(ready_array, rob_index_from_vec_alu[0:2], Bits(1)(1), width = 3)
+        with Condition(write_result_from_vec_alu & write_vrf_array_from_vec_alu[0]):
+            for lane in range(VLANES):
+                vrf[lane][vd_array_from_vec_alu[0]] = lane_result_arrays_from_vec_alu[lane][0]
+
+        # vle32：LSQ 上个周期从两个 bank 各读了一个字，按地址顺序写进 vd 相邻的两个 lane，最后一拍完成
+        vec_load_index = vec_load_rob_index_array[0][0:2]
+        vec_load_ok = vec_load_valid_array[0] & read_mux(allocated_array, vec_load_index, ROB_SIZE, 1)
+        vec_load_live = vec_load_ok & ~read_mux(dead_array, vec_load_index, ROB_SIZE, 1) if threads > 1 else vec_load_ok
+        bank_words = dcache_words(result_array_from_lsq)
+        in_order = (vec_load_bank_array[0] == Bits(1)(0))
+        vec_load_words = [in_order.select(bank_words[0], bank_words[1]), in_order.select(bank_words[1], bank_words[0])]
+        for beat in range(VEC_BEATS):
+            with Condition(vec_load_live & (vec_load_beat_array[0] == Int(32)(beat))):
+                for k in range(DCACHE_BANKS):
+                    vrf[beat * DCACHE_BANKS + k][vd_array[vec_load_index]] = vec_load_words[k]
+        with Condition(vec_load_ok & (vec_load_beat_array[0] == Int(32)(VEC_BEATS - 1))):
+            write1hot(ready_array, vec_load_index, Bits(1)(1), width = 3)
+
+        # sc.w / amoadd.w 执行完以后把要写回 rd 的值送回来，按 load 的结果提交
+        atomic_index = atomic_rob_index_array[0][0:2]
+        write_atomic = atomic_signal_array[0] & read_mux(allocated_array, atomic_index, ROB_SIZE, 1)
+        with Condition(write_atomic):
+            load_result_array[atomic_index] = atomic_result_array[0]
+            write1hot(ready_array, atomic_index, Bits(1)(1), width = 3)
+
+        # store 走单独的端口完成，可以和同一周期的 load 一起写回
+        store_rob_index_from_lsq = store_rob_index_array_from_lsq[0]
+        write_store_from_lsq = store_signal_array_from_lsq[0] & read_mux(allocated_array, store_rob_index_from_lsq[0:2], ROB_SIZE, 1)
+        with Condition(write_store_from_lsq):
+            write1hot(pc_result_array, store_rob_index_from_lsq[0:2], store_pc_result_array_from_lsq[0], width = 3)
+            write1hot(ready_array, store_rob_index_from_lsq[0:2], Bits(1)(1), width = 3)
+
         modify_rd = rd_valid_array[head_idx].select(rd_array[head_idx], Bits(5)(0))
         recorder = head_ptr
-        receive_write = should_receive & ~is_misprediction & has_rd
-        commit_write = modify_recorder & (modify_rd != Bits(5)(0)) & \
-                       read_mux(rf_has_recorder_array, modify_rd, 32, 1) & \
-                       (rf_recorder_array[modify_rd] == recorder.bitcast(Bits(5)))
-        conflict = receive_write & commit_write & (rd == modify_rd)
-
-        with Condition(receive_write & (rd != Bits(5)(0))):
-             write1hot(rf_has_recorder_array, rd, Bits(1)(1))
-             rf_recorder_array[rd] = tail_idx.bitcast(Bits(3))
-        with Condition(commit_write & ~conflict & ~is_misprediction):
-             write1hot(rf_has_recorder_array, modify_rd, Bits(1)(0))
-        with Condition(modify_recorder & (modify_rd != Bits(5)(0))):
-            rf_value_array[modify_rd] = modify_value
+        receive_write = should_receive & ~squash_in & has_rd
+        commit_write = modify_recorder & ~head_dead & (modify_rd != Bits(5)(0)) & \
+                       rf_has_recorder(head_tid, modify_rd) & \
+                       (rf_recorder(head_tid, modify_rd) == recorder.bitcast(Bits(5)))
+        conflict = receive_write & commit_write & (rd == modify_rd) & (tid == head_tid)
+
+        for t in range(threads):
+            is_tid = tid == Bits(1)(t)
+            is_head_tid = head_tid == Bits(1)(t)
+            with Condition(receive_write & is_tid & (rd != Bits(5)(0))):
+                 write1hot(rf_has_recorder_arrays[t], rd, Bits(1)(1))
+                 rf_recorder_arrays[t][rd] = tail_idx.bitcast(Bits(3))
+            with Condition(commit_write & is_head_tid & ~conflict & ~squash[t]):
+                 write1hot(rf_has_recorder_arrays[t], modify_rd, Bits(1)(0))
+            with Condition(modify_recorder & ~head_dead & is_head_tid & (modify_rd != Bits(5)(0))):
+                rf_value_arrays[t][modify_rd] = modify_value
     
         with Condition(commit):
             log("ROB entry {} committed, addr: 0x{:08x}", head_ptr, addr_array[head_idx])
+        perf.incr("rob_commits", commit)
+        if threads > 1:
+            for t in range(threads):
+                perf.incr(f"rob_commits_t{t}", commit & (head_tid == Bits(1)(t)))
 
-        bht_idx = addr_array[head_idx][2 : 2+bht_log_size - 1].bitcast(Bits(6))
+        bht_idx = addr_array[head_idx][1 : bht_log_size].bitcast(Bits(6))
         old_state = bht_array[bht_idx]
         
-        with Condition(commit & is_branch_array[head_idx]):
+        with Condition(commit & is_branch_array[head_idx] & ~shadow_flush):
             # log("Update Predictor: PC 0x{:05x} | OldState {} | ActualTaken {}", addr_array[head_idx], old_state, actual_taken)
             state_uint = old_state.bitcast(UInt(2))
             res_plus = (state_uint + UInt(2)(1)).bitcast(Bits(2))
@@ -221,29 +548,140 @@ class ROB(Module):
             plus_one = (old_state == Bits(2)(3)).select(Bits(2)(3), res_plus)
             minus_one = (old_state == Bits(2)(0)).select(Bits(2)(0), res_minus)
             new_state = actual_taken.select(plus_one, minus_one)
+            # hammock 分支一律往不跳转训练，这样取指总会走进影子，下次还能谓词化
+            new_state = is_hammock_array[head_idx].select(Bits(2)(0), new_state)
             
             bht_array[bht_idx] = new_state
+
+            # 置信度计数器和 BHT 一起训练：预测对了加一（饱和），预测错了清零
+            old_conf = conf_array[bht_idx]
+            conf_bits = old_conf.dtype.bits
+            conf_max = old_conf == Bits(conf_bits)((1 << conf_bits) - 1)
+            conf_plus = conf_max.select(old_conf, (old_conf.bitcast(UInt(conf_bits)) + UInt(conf_bits)(1)).bitcast(Bits(conf_bits)))
+            conf_array[bht_idx] = (pc_result_val != pred_next_pc_stored).select(Bits(conf_bits)(0), conf_plus)
             
             with Condition(actual_taken):
                 btb_target_array[bht_idx] = pc_result_val
 
-        with Condition(~rob_empty & is_final_array[head_idx]):
-            log("ebreak | addr: 0x{:08x}", addr_array[head_idx])
-            finish()
+        # 值预测表在 load 提交时训练：结果等于 last + stride 时置信度加一，否则清零并换成新的 stride
+        vp_commit_idx = head_addr[1:VP_LOG_SIZE].bitcast(Bits(VP_LOG_SIZE))
+        vp_train = commit & is_load_or_store_array[head_idx] & ~is_memory_write_array[head_idx] & \
+                   ~is_vector_array[head_idx] & rd_valid_array[head_idx] & ~in_shadow
+        vp_actual = load_result_array[head_idx]
+        vp_old_last = vp_last[vp_commit_idx]
+        vp_old_conf = vp_conf[vp_commit_idx]
+        vp_expect = (vp_old_last.bitcast(Int(32)) + vp_stride[vp_commit_idx].bitcast(Int(32))).bitcast(Bits(32))
+        vp_hit = vp_actual == vp_expect
+        vp_conf_max = vp_old_conf == Bits(VP_CONF_BITS)((1 << VP_CONF_BITS) - 1)
+        vp_conf_plus = vp_conf_max.select(vp_old_conf, (vp_old_conf.bitcast(UInt(VP_CONF_BITS)) + UInt(VP_CONF_BITS)(1)).bitcast(Bits(VP_CONF_BITS)))
+        with Condition(vp_train):
+            vp_last[vp_commit_idx] = vp_actual
+            vp_stride[vp_commit_idx] = (vp_actual.bitcast(Int(32)) - vp_old_last.bitcast(Int(32))).bitcast(Bits(32))
+            vp_conf[vp_commit_idx] = vp_hit.select(vp_conf_plus, Bits(VP_CONF_BITS)(0))
+
+        # spec 在清空流水线时退回到已经提交的值，训练没命中时也从实际结果重新开始递推
+        for i in range(1 << VP_LOG_SIZE):
+            is_train = vp_train & (vp_commit_idx == Bits(VP_LOG_SIZE)(i))
+            is_pred = vp_load & (vp_idx == Bits(VP_LOG_SIZE)(i))
+            restart = is_train & ~vp_hit
+            spec_value = is_misprediction.select(is_train.select(vp_actual, vp_last[i]), restart.select(vp_actual, vp_pred))
+            with Condition(is_misprediction | is_pred | restart):
+                vp_spec[i][0] = spec_value
+
+        # 清空流水线的线程从 head 正确的下一条开始重新取指，它的重命名表清空
+        next_arch_pc = in_shadow.select(head_shadow_hi, pc_result_val)
+        open_shadow = commit & head_predicated & actual_taken & ~shadow_flush
+        for t in range(threads):
+            is_head_tid = head_tid == Bits(1)(t)
+            with Condition(squash[t]):
+                # log("Branch misprediction: ROB {} | Actual: {} | Pred: {}", head_ptr, actual_taken, pred_taken_stored)
+                reset_pc_addr_arrays[t][0] = next_arch_pc
+                for i in range(32):
+                    rf_has_recorder_arrays[t][i][0] = Bits(1)(0)
+            with Condition(refetch[t]):
+                reset_pc_addr_arrays[t][0] = addr
 
-        with Condition(is_misprediction):
-            # log("Branch misprediction: ROB {} | Actual: {} | Pred: {}", head_ptr, actual_taken, pred_taken_stored)
-            reset_pc_addr_array[0] = pc_result_val
-            for i in range(32):
-                rf_has_recorder_array[i][0] = Bits(1)(0)
+            keep_shadow = shadow_active[t][0] & (rob_empty | head_dead | ~is_head_tid | in_shadow) & ~squash[t]
+            with Condition(open_shadow & is_head_tid):
+                shadow_lo[t][0] = head_addr
+                shadow_hi[t][0] = pc_result_val
+            shadow_active[t][0] = (open_shadow & is_head_tid).select(Bits(1)(1), keep_shadow)
 
-        head[0] = is_misprediction.select(Int(32)(0), commit.select(updated_head_ptr, head_ptr))
-        tail[0] = is_misprediction.select(Int(32)(0), should_receive.select(updated_tail_ptr, tail_ptr))
-        new_size = rob_size[0] + should_receive.select(Int(32)(1), Int(32)(0)) - commit.select(Int(32)(1), Int(32)(0))
-        new_rob_size = is_misprediction.select(Int(32)(0), new_size)
+        # 取指门控放行的依据：门控住的那条指令提交了
+        commit_valid_array[0] = commit.select(Bits(1)(1), Bits(1)(0))
+        commit_addr_array[0] = head_addr
+
+        # 预测错误时被清掉的都是错误路径上取进来的指令；SMT 时是这个线程除了 head 以外的条目
+        if threads > 1:
+            flushed = by_thread(head_tid, [cnt[0] for cnt in thread_count_arrays]) - (commit | thread_retire).select(Int(32)(1), Int(32)(0))
+        else:
+            flushed = rob_size[0] - commit.select(Int(32)(1), Int(32)(0))
+        perf.incr("rob_wrong_path_insts", is_misprediction, flushed.bitcast(UInt(32)))
+        perf.incr("rob_dead_retired", dead_retire)
+
+        perf.incr("rob_predicated_branches", commit & head_predicated & ~shadow_flush)
+        perf.incr("rob_avoided_mispredictions", open_shadow)
+        perf.incr("rob_shadow_nullified", commit & in_shadow & ~shadow_flush)
+        perf.incr("rob_shadow_flushes", shadow_flush)
+
+        vp_commit_used = commit & vp_used_array[head_idx] & is_load_or_store_array[head_idx] & ~is_memory_write_array[head_idx]
+        perf.incr("vp_loads", vp_train)
+        perf.incr("vp_predictions", should_receive & ~squash_in & vp_use)
+        perf.incr("vp_correct", vp_commit_used & ~vp_squash)
+        perf.incr("vp_squashes", vp_squash)
+
+        accept = should_receive & ~squash_in
+        head[0] = global_flush.select(Int(32)(0), retire.select(updated_head_ptr, head_ptr))
+        tail[0] = global_flush.select(Int(32)(0), accept.select(updated_tail_ptr, tail_ptr))
+        new_size = rob_size[0] + accept.select(Int(32)(1), Int(32)(0)) - retire.select(Int(32)(1), Int(32)(0))
+        new_rob_size = global_flush.select(Int(32)(0), new_size)
         rob_size[0] = new_rob_size
 
-        rob_full = (new_rob_size >= Int(32)(ROB_SIZE // 2))
+        # 每个线程在 ROB 里有几条指令，取指按这个数挑线程（ICOUNT）
+        if threads > 1:
+            for t in range(threads):
+                count = thread_count_arrays[t][0]
+                count = count + (accept & (tid == Bits(1)(t))).select(Int(32)(1), Int(32)(0))
+                count = count - (commit & (head_tid == Bits(1)(t))).select(Int(32)(1), Int(32)(0))
+                thread_count_arrays[t][0] = squash[t].select(Int(32)(0), count)
+
+        # 队列里剩下的位置不够装下反压生效之前还在路上的指令时，就让前端停下来
+        # SMT 时每个线程的译码器都可能留着一条等融合的指令，路上的指令会多几条
+        skid = LSQ_SKID + threads - 1
+        flush_lsq = global_flush | clear_signal_array[0]
+        new_lq_used = lq_used[0] + (lsq_write & needs_lq).select(Int(32)(1), Int(32)(0)) - load_credit_array[0].select(Int(32)(1), Int(32)(0))
+        new_sq_used = sq_used[0] + (lsq_write & needs_sq).select(Int(32)(1), Int(32)(0)) - store_credit_array[0].select(Int(32)(1), Int(32)(0))
+        lq_used[0] = flush_lsq.select(Int(32)(0), new_lq_used)
+        sq_used[0] = flush_lsq.select(Int(32)(0), new_sq_used)
+        # 剩下的位置正好等于路上的指令数时也要反压：这几条全部到达以后队列就满了，再来一条就会溢出
+        lq_backpressure = ~flush_lsq & (new_lq_used + Int(32)(skid) >= Int(32)(LOAD_QUEUE_SIZE))
+        sq_backpressure = ~flush_lsq & (new_sq_used + Int(32)(skid) >= Int(32)(STORE_QUEUE_SIZE))
+        perf.incr("rob_lq_backpressure", lq_backpressure)
+        perf.incr("rob_sq_backpressure", sq_backpressure)
+        # 占用过的最多的 credit 数，不应该超过队列的大小
+        perf.peak("rob_lq_peak_used", lq_used[0].bitcast(UInt(32)))
+        perf.peak("rob_sq_peak_used", sq_used[0].bitcast(UInt(32)))
+        perf.incr("rob_lsq_overflow", lsq_overflow)
+        perf.incr("rob_refetches", dropped)
+
+        head_is_load = is_load_or_store_array[head_idx] & ~is_memory_write_array[head_idx]
+        branch_mispredict = commit & is_branch_array[head_idx] & (pc_result_val != pred_next_pc_stored) & ~head_predicated
+        csrs.tick(commit.select(UInt(64)(1), UInt(64)(0)), {
+            'branch_mispredicts': branch_mispredict,
+            'lsq_stall_cycles': lq_backpressure | sq_backpressure | lsq_overflow,
+            'loads': commit & head_is_load,
+            'stores': commit & is_memory_write_array[head_idx],
+        })
+        perf.incr("rob_branches", commit & is_branch_array[head_idx])
+        perf.incr("rob_mispredictions", branch_mispredict)
+        perf.incr("rob_flushes", is_misprediction)
+        perf.incr("rob_loads", commit & head_is_load)
+        perf.incr("rob_stores", commit & is_memory_write_array[head_idx])
+
+        rob_full = (new_rob_size >= Int(32)(ROB_SIZE // 2)) | lq_backpressure | sq_backpressure
+        # rob_full_cycles 是 ROB 真的满了的周期；rob_stall_cycles 是占用到一半、让前端停下来的周期
+        perf.incr("rob_full_cycles", rob_size[0] == Int(32)(ROB_SIZE))
+        perf.incr("rob_stall_cycles", new_rob_size >= Int(32)(ROB_SIZE // 2))
         rob_full_array[0] = rob_full
         rob_full_array_for_fetcher[0] = (rob_size[0] >= Int(32)(ROB_SIZE - 2))
 
@@ -251,47 +689,62 @@ class ROB(Module):
             idx = Bits(5)(i)
             is_head = (idx == head_ptr.bitcast(Bits(5)))
             is_tail = (idx == tail_ptr.bitcast(Bits(5)))
-            write_0 = is_misprediction | (commit & is_head)
-            write_1 = should_receive & is_tail & ~is_misprediction
+            write_0 = global_flush | (retire & is_head)
+            write_1 = accept & is_tail
             with Condition(write_0):
                 allocated_array[i][0] = Bits(1)(0)
             with Condition(write_1):
                 allocated_array[i][0] = Bits(1)(1)
+            if threads > 1:
+                # 清空的线程在 ROB 里除了 head 以外的条目都作废；影子里不能执行的 head 没有提交，它自己也作废
+                kill = Bits(1)(0)
+                for t in range(threads):
+                    kill = kill | (squash[t] & (tid_array[i] == Bits(1)(t)))
+                with Condition(allocated_array[i][0] & (~is_head | (shadow_flush & ~commit)) & kill):
+                    dead_array[i][0] = Bits(1)(1)
 
-        clear_signal_array[0] = is_misprediction.select(Bits(1)(1), Bits(1)(0))
+        clear_signal_array[0] = global_flush.select(Bits(1)(1), Bits(1)(0))
+        # 只有清空的那个线程（或者有指令没收下的线程）的前端丢掉手里的指令，从 reset_pc 重新取指
+        for t in range(threads):
+            thread_clear_arrays[t][0] = (squash[t] | refetch[t]).select(Bits(1)(1), Bits(1)(0))
         
         rs.async_called(
             rs_write = rs_write,
             rs_modify_recorder = rs_modify_recorder,
             rob_index = tail_idx.bitcast(Bits(3)),
             signals = signals,
-            rs1_value = rf_value_array[rs1],
-            rs1_recorder = rf_recorder_array[rs1].bitcast(Bits(3)),
-            rs1_has_recorder = read_mux(rf_has_recorder_array, rs1, 32, 1),
-            rs2_value = rf_value_array[rs2],
-            rs2_recorder = rf_recorder_array[rs2].bitcast(Bits(3)),
-            rs2_has_recorder = read_mux(rf_has_recorder_array, rs2, 32, 1),
+            rs1_value = rs1_value,
+            rs1_recorder = rs1_recorder,
+            rs1_has_recorder = rs1_has_recorder,
+            rs2_value = rs2_value,
+            rs2_recorder = rs2_recorder,
+            rs2_has_recorder = rs2_has_recorder,
             addr = addr,
             rs_modify_rd = modify_rd,
             rs_recorder = recorder.bitcast(Bits(3)),
             rs_modify_value = modify_value
         )
+        # 告诉 LSQ 这个 head 不会提交，它的 store 不能写内存：SMT 时作废的条目，以及这个周期因为影子作废的 head
+        # 单线程时这两种情况都会清空整个后端，不需要单独通知
+        head_killed = (head_dead | shadow_flush) if threads > 1 else Bits(1)(0)
         lsq.async_called(
             lsq_write = lsq_write,
             lsq_modify_recorder = lsq_modify_recorder,
             rob_index = tail_idx.bitcast(Bits(3)),
             signals = signals,
-            rs1_value = rf_value_array[rs1],
-            rs1_recorder = rf_recorder_array[rs1],
-            rs1_has_recorder = read_mux(rf_has_recorder_array, rs1, 32, 1),
-            rs2_value = rf_value_array[rs2],
-            rs2_recorder = rf_recorder_array[rs2],
-            rs2_has_recorder = read_mux(rf_has_recorder_array, rs2, 32, 1),
+            rs1_value = rs1_value,
+            rs1_recorder = rs1_recorder,
+            rs1_has_recorder = rs1_has_recorder,
+            rs2_value = rs2_value,
+            rs2_recorder = rs2_recorder,
+            rs2_has_recorder = rs2_has_recorder,
             addr = addr,
             lsq_modify_rd = modify_rd,
             lsq_recorder = recorder.bitcast(Bits(3)),
             lsq_modify_value = modify_value,
-            rob_head_index = head_idx.bitcast(Bits(3))
+            rob_head_index = head_idx.bitcast(Bits(3)),
+            rob_head_dead = head_killed,
+            tid = tid
         )
         #for i in range(ROB_SIZE):
             # log("ROB Entry {}: allocated: {} | ready: {} | calc_result: 0x{:08x} | load_result: 0x{:08x} | pc_addr: 0x{:08x}",
@@ -304,6 +757,58 @@ class ROB(Module):
             # )
 
         # for i in range(32):
-        log("register value {}: 0x{:08x}", Bits(5)(10), rf_value_array[10])
+        log("register value {}: 0x{:08x}", Bits(5)(10), rf_value_arrays[0][10])
+        for t in range(1, threads):
+            log(f"thread {t} register value {{}}: 0x{{:08x}}", Bits(5)(10), rf_value_arrays[t][10])
+
+        # 计数器要在所有模块都 build 完之后才能全部导出，所以 ROB 最后 build
+        # 多核时先停下来的核停在 ebreak 上等着，所有核都到了 ebreak 才结束模拟
+        halted = halt_arrays[hartid]
+        perf.incr("cycles", ~halted[0])
+
+        # top-down：每个周期按 ROB head 的情况归到一类，各类加起来等于 cycles
+        #   retiring          这个周期有指令提交
+        #   bad_speculation   分支在 ALU 里算出来和预测的不一样以后，到它提交清空流水线之前没有提交的周期，
+        #                     以及清空的那个周期、前端跟着清空的周期和 SMT 时作废的条目占着 head 的周期
+        #   frontend_refill   清空以后 ROB 还没收到新指令
+        #   frontend_fetch    其余 ROB 空着的周期：取指被门控、icache / 译码没有送来指令
+        #   backend_memory    head 是还没完成的访存指令
+        #   backend_core      head 在等执行单元（ALU / MUL_ALU / DIV_ALU / VEC_ALU）或者它的操作数
+        refilling = RegArray(Bits(1), 1)
+        refilling[0] = is_misprediction | (refilling[0] & ~accept)
+        # 预测错的分支一算出结果，ROB 里比它年轻的指令就都在错误路径上了，一直到流水线被清空
+        alu_idx = rob_index_from_alu[0:2]
+        resolved_wrong = write_result_from_alu & is_branch_array[alu_idx] & ~is_predicated_array[alu_idx] & \
+                         (pc_result_array_from_alu[0] != pred_next_pc_array[alu_idx])
+        if threads > 1:
+            resolved_wrong = resolved_wrong & ~read_mux(dead_array, alu_idx, ROB_SIZE, 1)
+        wrong_path = RegArray(Bits(1), 1)
+        flushing = is_misprediction | clear_signal_array[0]
+        wrong_path[0] = ~flushing & (resolved_wrong | wrong_path[0])
+        counting = ~halted[0]
+        recovering = ~commit & (flushing | resolved_wrong | wrong_path[0] | head_dead)
+        waiting = ~commit & ~recovering & ~rob_empty
+        perf.incr("topdown_retiring", counting & commit)
+        perf.incr("topdown_bad_speculation", counting & recovering)
+        perf.incr("topdown_frontend_refill", counting & ~commit & ~recovering & rob_empty & refilling[0])
+        perf.incr("topdown_frontend_fetch", counting & ~commit & ~recovering & rob_empty & ~refilling[0])
+        perf.incr("topdown_backend_memory", counting & waiting & is_load_or_store_array[head_idx])
+        perf.incr("topdown_backend_core", counting & waiting & ~is_load_or_store_array[head_idx])
+        others_halted = Bits(1)(1)
+        for k, arr in enumerate(halt_arrays):
+            if k != hartid:
+                others_halted = others_halted & arr[0]
+        if threads > 1:
+            with Condition(thread_retire):
+                log("ebreak | hart: {} | thread: {} | addr: 0x{:08x}", Bits(32)(hartid), head_tid, addr_array[head_idx])
+            for t in range(threads):
+                with Condition(halt & (head_tid == Bits(1)(t))):
+                    thread_halt_arrays[t][0] = Bits(1)(1)
+        with Condition(core_halt & ~halted[0]):
+            log("ebreak | hart: {} | addr: 0x{:08x}", Bits(32)(hartid), addr_array[head_idx])
+            perf.dump()
+        halted[0] = core_halt | halted[0]
+        with Condition(core_halt & others_halted):
+            finish()
         return rob_full
     
\ No newline at end of file
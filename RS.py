@@ -2,7 +2,9 @@ from assassyn.frontend import *
 from instruction import *
 from alu import *
 from mul_alu import *
+from div_alu import *
 from utils import *
+from perf import *
 
 RS_SIZE = 8
 
@@ -35,7 +37,19 @@ class RS(Module):
             self, 
             alu: ALU,
             mul_alu: MUL_ALU,
+            div_alu: DIV_ALU,
+            div_busy_array: Array,
             clear_signal_array: Array,
+            load_wakeup_valid_array: Array,
+            load_wakeup_index_array: Array,
+            load_signal_array: Array,
+            load_rob_index_array: Array,
+            load_dout_arrays: list,
+            load_bank_array: Array,
+            memory_place_array: Array,
+            load_length_array: Array,
+            load_signed_array: Array,
+            perf: PerfCounters,
         ):
 
         # RS 自身的性质
@@ -60,10 +74,15 @@ class RS(Module):
         cond_array = RegArray(Bits(RV32I_ALU.CNT), RS_SIZE)
         flip_array = RegArray(Bits(1), RS_SIZE)
         is_branch_array = RegArray(Bits(1), RS_SIZE)
+        is_compressed_array = RegArray(Bits(1), RS_SIZE)
+        cmp_to_rd_array = RegArray(Bits(1), RS_SIZE)
         addr_array = RegArray(Bits(32), RS_SIZE)
         get_high_bit_array = RegArray(Bits(1), RS_SIZE)
         rs1_sign_array = RegArray(Bits(1), RS_SIZE)
         rs2_sign_array = RegArray(Bits(1), RS_SIZE)
+        is_rem_array = RegArray(Bits(1), RS_SIZE)
+        div_signed_array = RegArray(Bits(1), RS_SIZE)
+        div_sent = RegArray(Bits(1), 1)         # 上个周期刚发出去一条除法，除法器的 busy 这个周期还看不到
                                   
         (
             rs_write,
@@ -117,44 +136,106 @@ class RS(Module):
             cond_array[rob_index] = signals.cond
             flip_array[rob_index] = signals.flip
             is_branch_array[rob_index] = signals.is_branch
+            is_compressed_array[rob_index] = signals.is_compressed
+            cmp_to_rd_array[rob_index] = signals.cmp_to_rd
             get_high_bit_array[rob_index] = signals.get_high_bit
             rs1_sign_array[rob_index] = signals.rs1_sign
             rs2_sign_array[rob_index] = signals.rs2_sign
+            is_rem_array[rob_index] = signals.is_rem
+            div_signed_array[rob_index] = signals.div_signed
             write1hot(allocated_array, rob_index, Bits(1)(1))
 
+        # 推测唤醒：LSQ 把 load 调度出去以后 LOAD_HIT_LATENCY 个周期就唤醒等待它的条目，不等数据真的回来，
+        # 被唤醒的条目这个周期就可以被选中发射，操作数从 load 总线上旁路；
+        # 数据没有按时回来（dcache bank 冲突、DRAM 还在等）时选中的这条作废：不发给执行单元，条目留在 RS 里，
+        # 等数据真正回到 load 总线的那个周期再被唤醒一次，重新发射
+        wake_valid = load_wakeup_valid_array[0]
+        wake_index = load_wakeup_index_array[0]
+        ret_valid = load_signal_array[0]
+        ret_index = load_rob_index_array[0]
+        load_value = load_bus_value(load_dout_arrays, load_bank_array[0], memory_place_array[0], load_length_array[0], load_signed_array[0])
+
+        rs1_ret = []
+        rs2_ret = []
         send_index = Bits(3)(0)
         send = Bits(1)(0)
+        send_rs1_ret = Bits(1)(0)
+        send_rs2_ret = Bits(1)(0)
+        send_miss = Bits(1)(0)
         send_index_to_mul = Bits(3)(0)
         send_to_mul = Bits(1)(0)
+        mul_rs1_ret = Bits(1)(0)
+        mul_rs2_ret = Bits(1)(0)
+        mul_miss = Bits(1)(0)
+        send_index_to_div = Bits(3)(0)
+        send_to_div = Bits(1)(0)
+        div_rs1_ret = Bits(1)(0)
+        div_rs2_ret = Bits(1)(0)
+        div_miss = Bits(1)(0)
+        div_free = ~div_busy_array[0] & ~div_sent[0]
         for i in range(RS_SIZE):
             allocated = allocated_array[i][0]
-            rs1_valid = (~has_rs1_array[i]) | (has_rs1_array[i] & (~has_rs1_recorder_array[i][0]))
-            rs2_valid = (~has_rs2_array[i]) | (has_rs2_array[i] & (~has_rs2_recorder_array[i][0]))
-            valid = allocated & rs1_valid & rs2_valid & ~(alu_type_array[i] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_MUL))
-            valid_to_mul = allocated & rs1_valid & rs2_valid & (alu_type_array[i] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_MUL))
+            rs1_waiting = has_rs1_array[i] & has_rs1_recorder_array[i][0]
+            rs2_waiting = has_rs2_array[i] & has_rs2_recorder_array[i][0]
+            rs1_spec = rs1_waiting & wake_valid & (rs1_recorder_array[i] == wake_index)
+            rs2_spec = rs2_waiting & wake_valid & (rs2_recorder_array[i] == wake_index)
+            rs1_ret.append(rs1_waiting & ret_valid & (rs1_recorder_array[i] == ret_index))
+            rs2_ret.append(rs2_waiting & ret_valid & (rs2_recorder_array[i] == ret_index))
+            rs1_valid = (~rs1_waiting) | rs1_spec | rs1_ret[i]
+            rs2_valid = (~rs2_waiting) | rs2_spec | rs2_ret[i]
+            miss = (rs1_spec & ~rs1_ret[i]) | (rs2_spec & ~rs2_ret[i])
+            is_mul = (alu_type_array[i] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_MUL))
+            is_div = (alu_type_array[i] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_DIV))
+            valid = allocated & rs1_valid & rs2_valid & ~is_mul & ~is_div
+            valid_to_mul = allocated & rs1_valid & rs2_valid & is_mul
+            valid_to_div = allocated & rs1_valid & rs2_valid & is_div & div_free
             # log("RS entry {} - allocated:  {} | rs1_valid: {} | rs2_valid: {} | valid: {}",
             #     Bits(5)(i), allocated, rs1_valid, rs2_valid, valid)
             send_index = valid.select(Bits(3)(i), send_index)
             send = valid.select(Bits(1)(1), send)
+            send_rs1_ret = valid.select(rs1_ret[i], send_rs1_ret)
+            send_rs2_ret = valid.select(rs2_ret[i], send_rs2_ret)
+            send_miss = valid.select(miss, send_miss)
             send_index_to_mul = valid_to_mul.select(Bits(3)(i), send_index_to_mul)
             send_to_mul = valid_to_mul.select(Bits(1)(1), send_to_mul)
+            mul_rs1_ret = valid_to_mul.select(rs1_ret[i], mul_rs1_ret)
+            mul_rs2_ret = valid_to_mul.select(rs2_ret[i], mul_rs2_ret)
+            mul_miss = valid_to_mul.select(miss, mul_miss)
+            send_index_to_div = valid_to_div.select(Bits(3)(i), send_index_to_div)
+            send_to_div = valid_to_div.select(Bits(1)(1), send_to_div)
+            div_rs1_ret = valid_to_div.select(rs1_ret[i], div_rs1_ret)
+            div_rs2_ret = valid_to_div.select(rs2_ret[i], div_rs2_ret)
+            div_miss = valid_to_div.select(miss, div_miss)
+
+        # 这个周期作废的发射：选中了，但推测唤醒它的 load 没有按时回来
+        replays = (send & send_miss) | (send_to_mul & mul_miss) | (send_to_div & div_miss)
+        send = send & ~send_miss
+        send_to_mul = send_to_mul & ~mul_miss
+        send_to_div = send_to_div & ~div_miss
+        send_spec = (send & (send_rs1_ret | send_rs2_ret)) | (send_to_mul & (mul_rs1_ret | mul_rs2_ret)) | \
+                    (send_to_div & (div_rs1_ret | div_rs2_ret))
 
         # log("send_index: {} | send: {}", send_index, send)
 
-        a = (rs1_array[send_index] == Bits(5)(0)).select(Bits(32)(0), read_mux(rs1_value_array, send_index, RS_SIZE, 32))
-        b = (rs2_array[send_index] == Bits(5)(0)).select(Bits(32)(0), read_mux(rs2_value_array, send_index, RS_SIZE, 32))
+        a = (rs1_array[send_index] == Bits(5)(0)).select(Bits(32)(0), send_rs1_ret.select(load_value, read_mux(rs1_value_array, send_index, RS_SIZE, 32)))
+        b = (rs2_array[send_index] == Bits(5)(0)).select(Bits(32)(0), send_rs2_ret.select(load_value, read_mux(rs2_value_array, send_index, RS_SIZE, 32)))
 
         alu_a = (is_branch_array[send_index]).select(addr_array[send_index], a)
         alu_b = has_imm_array[send_index].select(imm_array[send_index], b)
         send = send & (~clear_signal_array[0])
 
-        mul_a = (rs1_array[send_index_to_mul] == Bits(5)(0)).select(Bits(32)(0), read_mux(rs1_value_array, send_index_to_mul, RS_SIZE, 32))
-        mul_b = (rs2_array[send_index_to_mul] == Bits(5)(0)).select(Bits(32)(0), read_mux(rs2_value_array, send_index_to_mul, RS_SIZE, 32))
+        mul_a = (rs1_array[send_index_to_mul] == Bits(5)(0)).select(Bits(32)(0), mul_rs1_ret.select(load_value, read_mux(rs1_value_array, send_index_to_mul, RS_SIZE, 32)))
+        mul_b = (rs2_array[send_index_to_mul] == Bits(5)(0)).select(Bits(32)(0), mul_rs2_ret.select(load_value, read_mux(rs2_value_array, send_index_to_mul, RS_SIZE, 32)))
 
         mul_alu_a = mul_a
         mul_alu_b = mul_b
         send_to_mul = send_to_mul & (~clear_signal_array[0])
 
+        div_a = (rs1_array[send_index_to_div] == Bits(5)(0)).select(Bits(32)(0), div_rs1_ret.select(load_value, read_mux(rs1_value_array, send_index_to_div, RS_SIZE, 32)))
+        div_b = (rs2_array[send_index_to_div] == Bits(5)(0)).select(Bits(32)(0), div_rs2_ret.select(load_value, read_mux(rs2_value_array, send_index_to_div, RS_SIZE, 32)))
+        send_to_div = send_to_div & (~clear_signal_array[0])
+        div_sent[0] = send_to_div
+
         with Condition(send):
             # 这里需要实现把已经准备好的第一条指令送去 alu 执行
             # log("RS entry {} send to alu", send_index)
@@ -165,6 +246,10 @@ class RS(Module):
             # log("RS entry {} send to mul_alu", send_index_to_mul)
             write1hot(allocated_array, send_index_to_mul, Bits(1)(0), width = 3)
 
+        with Condition(send_to_div):
+            # log("RS entry {} send to div_alu", send_index_to_div)
+            write1hot(allocated_array, send_index_to_div, Bits(1)(0), width = 3)
+
 
         alu.async_called(
             valid = send,
@@ -179,7 +264,9 @@ class RS(Module):
             flip = flip_array[send_index],
             is_branch = is_branch_array[send_index],
             calc_type = send.select(alu_type_array[send_index], Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE)),
-            pc_addr = addr_array[send_index]
+            pc_addr = addr_array[send_index],
+            is_compressed = is_compressed_array[send_index],
+            cmp_to_rd = cmp_to_rd_array[send_index]
         )
 
         mul_alu.async_called(
@@ -195,6 +282,16 @@ class RS(Module):
             clear = clear_signal_array[0],
         )
 
+        div_alu.async_called(
+            valid = send_to_div,
+            rob_index = rob_index_array[send_index_to_div],
+            alu_a = div_a,
+            alu_b = div_b,
+            pc_addr = addr_array[send_index_to_div],
+            is_rem = is_rem_array[send_index_to_div],
+            div_signed = div_signed_array[send_index_to_div],
+        )
+
         with Condition(rs_modify_recorder):
             # log("RS modify recorder: rs_recorder: {} | rs_modify_value: 0x{:08x}",
             #    rs_recorder, rs_modify_value)
@@ -208,6 +305,23 @@ class RS(Module):
                     has_rs2_recorder_array[i][0] = Bits(1)(0)
                     rs2_value_array[i][0]= rs_modify_value
 
+        # load 的数据回到总线上，等待它的条目都把值存下来，包括推测唤醒时扑空、等着重发的条目
+        with Condition(ret_valid):
+            for i in range(RS_SIZE):
+                with Condition(allocated_array[i][0] & rs1_ret[i]):
+                    has_rs1_recorder_array[i][0] = Bits(1)(0)
+                    rs1_value_array[i][0] = load_value
+                with Condition(allocated_array[i][0] & rs2_ret[i]):
+                    has_rs2_recorder_array[i][0] = Bits(1)(0)
+                    rs2_value_array[i][0] = load_value
+
+        perf.incr("rs_load_wakeup_issues", send_spec & ~clear_signal_array[0])
+        perf.incr("rs_load_replays", replays & ~clear_signal_array[0])
+        rs_full = Bits(1)(1)
+        for i in range(RS_SIZE):
+            rs_full = rs_full & allocated_array[i][0]
+        perf.incr("rs_full_cycles", rs_full & ~clear_signal_array[0])
+
         with Condition(clear_signal_array[0]):
             for i in range(RS_SIZE):
                 allocated_array[i][0] = Bits(1)(0)
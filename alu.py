@@ -1,5 +1,24 @@
 from assassyn.frontend import *
 from instruction import *
+from perf import *
+
+def count_leading_zeros(value):
+    count = Bits(32)(32)
+    for i in range(32):
+        count = value[i:i].select(Bits(32)(31 - i), count)
+    return count
+
+def count_trailing_zeros(value):
+    count = Bits(32)(32)
+    for i in reversed(range(32)):
+        count = value[i:i].select(Bits(32)(i), count)
+    return count
+
+def popcount(value):
+    terms = [concat(Bits(5)(0), value[i:i]).bitcast(UInt(6)) for i in range(32)]
+    while len(terms) > 1:
+        terms = [terms[i] + terms[i + 1] for i in range(0, len(terms), 2)]
+    return concat(Bits(26)(0), terms[0].bitcast(Bits(6)))
 
 class ALU(Module):
 
@@ -18,6 +37,8 @@ class ALU(Module):
             "is_branch": Port(Bits(1)),
             "calc_type": Port(Bits(RV32I_ALU.CNT)),
             "pc_addr": Port(Bits(32)),
+            "is_compressed": Port(Bits(1)),
+            "cmp_to_rd": Port(Bits(1)),
         }, no_arbiter = True)
         self.name = "ALU"
 
@@ -28,6 +49,7 @@ class ALU(Module):
         result_array: Array,
         pc_result_array: Array,
         signal_array: Array,
+        perf: PerfCounters,
     ):
         (
             valid,
@@ -42,7 +64,9 @@ class ALU(Module):
             flip,
             is_branch,
             calc_type,
-            pc_addr
+            pc_addr,
+            is_compressed,
+            cmp_to_rd
         ) = self.pop_all_ports(True)
 
         results = [Bits(32)(0)] * RV32I_ALU.CNT
@@ -70,16 +94,37 @@ class ALU(Module):
         results[RV32I_ALU.ALU_SRA] = sra_signed_result 
         results[RV32I_ALU.ALU_SRA_U] = alu_a >> alu_b[0:4]
         results[RV32I_ALU.ALU_NONE] = Bits(32)(0)
+        results[RV32I_ALU.ALU_SHADD] = ((alu_a << alu_b[0:4]).bitcast(Int(32)) + b.bitcast(Int(32))).bitcast(Bits(32))
+
+        # Zbb
+        shamt = alu_b[0:4]
+        neg_shamt = (UInt(5)(0) - shamt.bitcast(UInt(5))).bitcast(Bits(5))
+        signed_lt = alu_a.bitcast(Int(32)) < alu_b.bitcast(Int(32))
+        unsigned_lt = alu_a < alu_b
+        results[RV32I_ALU.ALU_ANDN] = alu_a & ~alu_b
+        results[RV32I_ALU.ALU_ORN] = alu_a | ~alu_b
+        results[RV32I_ALU.ALU_CLZ] = count_leading_zeros(alu_a)
+        results[RV32I_ALU.ALU_CTZ] = count_trailing_zeros(alu_a)
+        results[RV32I_ALU.ALU_CPOP] = popcount(alu_a)
+        results[RV32I_ALU.ALU_MIN] = signed_lt.select(alu_a, alu_b)
+        results[RV32I_ALU.ALU_MINU] = unsigned_lt.select(alu_a, alu_b)
+        results[RV32I_ALU.ALU_MAX] = signed_lt.select(alu_b, alu_a)
+        results[RV32I_ALU.ALU_MAXU] = unsigned_lt.select(alu_b, alu_a)
+        results[RV32I_ALU.ALU_ROL] = (alu_a << shamt) | (alu_a >> neg_shamt)
+        results[RV32I_ALU.ALU_ROR] = (alu_a >> shamt) | (alu_a << neg_shamt)
 
         alu = calc_type
         result = alu.select1hot(*results)
         calc_result = result
-        result = link_pc.select((pc_addr.bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32)), result)
+        inst_len = is_compressed.select(Int(32)(2), Int(32)(4))
+        seq_pc = (pc_addr.bitcast(Int(32)) + inst_len).bitcast(Bits(32))
+        result = link_pc.select(seq_pc, result)
 
         condition = cond.select1hot(*results)
+        result = cmp_to_rd.select(condition, result)
         condition = flip.select(~condition, condition)
 
-        new_pc = (pc_addr.bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
+        new_pc = seq_pc
         jump = is_branch.select(condition[0:0], Bits(1)(0))
         new_pc = jump.select(calc_result, new_pc)
         
@@ -88,6 +133,13 @@ class ALU(Module):
         pc_result_array[0] = new_pc
         signal_array[0] = valid
 
+        bitmanip = Bits(1)(0)
+        for op in [RV32I_ALU.ALU_SHADD, RV32I_ALU.ALU_ANDN, RV32I_ALU.ALU_ORN, RV32I_ALU.ALU_CLZ, RV32I_ALU.ALU_CTZ, RV32I_ALU.ALU_CPOP,
+                   RV32I_ALU.ALU_MIN, RV32I_ALU.ALU_MINU, RV32I_ALU.ALU_MAX, RV32I_ALU.ALU_MAXU, RV32I_ALU.ALU_ROL, RV32I_ALU.ALU_ROR]:
+            bitmanip = bitmanip | calc_type[op:op]
+        perf.incr("alu_ops", valid)
+        perf.incr("alu_bitmanip_ops", valid & bitmanip)
+
         # with Condition(valid):
         #    log("a: 0x{:08x} | b: 0x{:08x} | alu_a: 0x{:08x} | alu_b: 0x{:08x} | result: 0x{:08x} | cond: 0x{:08x} | pc: 0x{:08x} | new_pc: 0x{:08x}",
         #        a, b, alu_a, alu_b, result, cond, pc_addr, new_pc)
@@ -0,0 +1,44 @@
+from assassyn.frontend import *
+
+# hpmcounter3、hpmcounter4…… 依次统计的事件；每个核按名字给出这些事件的条件，没有给出的事件不计数
+HPM_EVENTS = [
+    'branch_mispredicts',   # 预测错误、需要清空流水线的分支
+    'lsq_stall_cycles',     # 访存指令因为 LSQ（或者 DRAM）没有空位而停下来的周期
+    'loads',                # 提交的 load
+    'stores',               # 提交的 store
+]
+
+class CSRCounters:
+    # 程序可以用 csrrs 读的计数器：mcycle / cycle / time、minstret / instret、mhpmcounter3.. / hpmcounter3..
+    # 都是 64 位，地址的第 7 位为 1 时读高 32 位（mcycleh 等）；写计数器的 CSR 不支持
+    # 要在使用它的模块的 build 里创建：每个周期调用一次 tick，读的时候调用 read
+
+    def __init__(self):
+        self.mcycle = RegArray(UInt(64), 1, initializer=[0])
+        self.minstret = RegArray(UInt(64), 1, initializer=[0])
+        self.hpm = [RegArray(UInt(64), 1, initializer=[0]) for _ in HPM_EVENTS]
+
+    def tick(self, retired, events):
+        # retired 是这个周期提交的指令数（UInt(64)），events 是事件名到这个周期是否发生的映射
+        for name in events:
+            assert name in HPM_EVENTS, f"unknown hpm event {name}"
+        self.mcycle[0] = self.mcycle[0] + UInt(64)(1)
+        self.minstret[0] = self.minstret[0] + retired
+        for name, cnt in zip(HPM_EVENTS, self.hpm):
+            if name in events:
+                with Condition(events[name]):
+                    cnt[0] = cnt[0] + UInt(64)(1)
+
+    def read(self, csr):
+        # csr 是 12 位的 CSR 地址；不是计数器的地址读出 0
+        index = csr[0:4]
+        high = csr[7:7]
+        group = csr[8:11]
+        is_counter = ((group == Bits(4)(0xB)) | (group == Bits(4)(0xC))) & (csr[5:6] == Bits(2)(0))
+        counters = [(0, self.mcycle), (1, self.mcycle), (2, self.minstret)]
+        counters += [(3 + k, cnt) for k, cnt in enumerate(self.hpm)]
+        value = Bits(64)(0)
+        for i, cnt in counters:
+            value = (index == Bits(5)(i)).select(cnt[0].bitcast(Bits(64)), value)
+        value = high.select(value[32:63], value[0:31])
+        return is_counter.select(value, Bits(32)(0))
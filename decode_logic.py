@@ -2,7 +2,104 @@ from assassyn.frontend import *
 from opcodes import *
 from instruction import *
 
-def decode_logic(instruction):
+HAMMOCK_MAX_LEN = 4     # 向前跳过不超过这么多条 32 位指令的条件分支可以被谓词化，两边都执行
+
+def sign_extend(value, width):
+    bits = value.dtype.bits
+    sign = value[bits - 1:bits - 1]
+    pad = sign.select(Bits(width - bits)((1 << (width - bits)) - 1), Bits(width - bits)(0))
+    return concat(pad, value)
+
+def rvc_i_type(imm, rs1, func3, rd, opcode):
+    return concat(imm, rs1, Bits(3)(func3), rd, Bits(7)(opcode))
+
+def rvc_s_type(imm, rs2, rs1, func3, opcode):
+    return concat(imm[5:11], rs2, rs1, Bits(3)(func3), imm[0:4], Bits(7)(opcode))
+
+def rvc_b_type(imm, rs2, rs1, func3, opcode):
+    # imm 是 13 位的字节偏移
+    return concat(imm[12:12], imm[5:10], rs2, rs1, Bits(3)(func3), imm[1:4], imm[11:11], Bits(7)(opcode))
+
+def rvc_j_type(imm, rd, opcode):
+    # imm 是 21 位的字节偏移
+    return concat(imm[20:20], imm[1:10], imm[11:11], imm[12:19], rd, Bits(7)(opcode))
+
+def rvc_r_type(func7, rs2, rs1, func3, rd, opcode):
+    return concat(Bits(7)(func7), rs2, rs1, Bits(3)(func3), rd, Bits(7)(opcode))
+
+def expand_rvc(c):
+    # 把 16 位的 RV32C 指令展开成等价的 32 位指令，后面的译码逻辑不用区分压缩指令
+    # 不认识的编码展开成全 0，交给 decode_logic 报告不支持
+    quadrant = c[0:1]
+    func3 = c[13:15]
+    rd = c[7:11]
+    rs2 = c[2:6]
+    rd_p = concat(Bits(2)(0b01), c[2:4])       # rd' / rs2'，x8 - x15
+    rs1_p = concat(Bits(2)(0b01), c[7:9])      # rs1' / rd'
+    x0 = Bits(5)(0)
+    x1 = Bits(5)(1)
+    x2 = Bits(5)(2)
+
+    imm6 = concat(c[12:12], c[2:6])
+    shamt = concat(Bits(1)(0), c[2:6])
+    addi4spn_imm = concat(Bits(2)(0), c[7:10], c[11:12], c[5:5], c[6:6], Bits(2)(0))
+    lw_imm = concat(Bits(5)(0), c[5:5], c[10:12], c[6:6], Bits(2)(0))
+    jal_imm = sign_extend(concat(c[12:12], c[8:8], c[9:10], c[6:6], c[7:7], c[2:2], c[11:11], c[3:5], Bits(1)(0)), 21)
+    addi16sp_imm = sign_extend(concat(c[12:12], c[3:4], c[5:5], c[2:2], c[6:6], Bits(4)(0)), 12)
+    branch_imm = sign_extend(concat(c[12:12], c[5:6], c[2:2], c[10:11], c[3:4], Bits(1)(0)), 13)
+    lwsp_imm = concat(Bits(4)(0), c[2:3], c[12:12], c[4:6], Bits(2)(0))
+    swsp_imm = concat(Bits(4)(0), c[7:8], c[9:12], Bits(2)(0))
+
+    def is_op(q, f3):
+        return (quadrant == Bits(2)(q)) & (func3 == Bits(3)(f3))
+
+    alu_op = c[10:11]
+    arith_op = c[5:6]
+    rs2_zero = (rs2 == Bits(5)(0))
+    rd_zero = (rd == Bits(5)(0))
+
+    cases = [
+        # quadrant 0
+        (is_op(0b00, 0b000), rvc_i_type(addi4spn_imm, x2, 0b000, rd_p, 0b0010011)),                    # c.addi4spn
+        (is_op(0b00, 0b010), rvc_i_type(lw_imm, rs1_p, 0b010, rd_p, 0b0000011)),                        # c.lw
+        (is_op(0b00, 0b110), rvc_s_type(lw_imm, rd_p, rs1_p, 0b010, 0b0100011)),                        # c.sw
+        # quadrant 1
+        (is_op(0b01, 0b000), rvc_i_type(sign_extend(imm6, 12), rd, 0b000, rd, 0b0010011)),             # c.addi / c.nop
+        (is_op(0b01, 0b001), rvc_j_type(jal_imm, x1, 0b1101111)),                                       # c.jal
+        (is_op(0b01, 0b010), rvc_i_type(sign_extend(imm6, 12), x0, 0b000, rd, 0b0010011)),             # c.li
+        (is_op(0b01, 0b011) & (rd == x2), rvc_i_type(addi16sp_imm, x2, 0b000, x2, 0b0010011)),          # c.addi16sp
+        (is_op(0b01, 0b011) & (rd != x2), concat(sign_extend(imm6, 20), rd, Bits(7)(0b0110111))),       # c.lui
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b00)), rvc_i_type(concat(Bits(6)(0), shamt), rs1_p, 0b101, rs1_p, 0b0010011)),         # c.srli
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b01)), rvc_i_type(concat(Bits(6)(0b010000), shamt), rs1_p, 0b101, rs1_p, 0b0010011)),  # c.srai
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b10)), rvc_i_type(sign_extend(imm6, 12), rs1_p, 0b111, rs1_p, 0b0010011)),             # c.andi
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b11)) & (arith_op == Bits(2)(0b00)), rvc_r_type(0b0100000, rd_p, rs1_p, 0b000, rs1_p, 0b0110011)),  # c.sub
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b11)) & (arith_op == Bits(2)(0b01)), rvc_r_type(0b0000000, rd_p, rs1_p, 0b100, rs1_p, 0b0110011)),  # c.xor
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b11)) & (arith_op == Bits(2)(0b10)), rvc_r_type(0b0000000, rd_p, rs1_p, 0b110, rs1_p, 0b0110011)),  # c.or
+        (is_op(0b01, 0b100) & (alu_op == Bits(2)(0b11)) & (arith_op == Bits(2)(0b11)), rvc_r_type(0b0000000, rd_p, rs1_p, 0b111, rs1_p, 0b0110011)),  # c.and
+        (is_op(0b01, 0b101), rvc_j_type(jal_imm, x0, 0b1101111)),                                       # c.j
+        (is_op(0b01, 0b110), rvc_b_type(branch_imm, x0, rs1_p, 0b000, 0b1100011)),                      # c.beqz
+        (is_op(0b01, 0b111), rvc_b_type(branch_imm, x0, rs1_p, 0b001, 0b1100011)),                      # c.bnez
+        # quadrant 2
+        (is_op(0b10, 0b000), rvc_i_type(concat(Bits(6)(0), shamt), rd, 0b001, rd, 0b0010011)),         # c.slli
+        (is_op(0b10, 0b010), rvc_i_type(lwsp_imm, x2, 0b010, rd, 0b0000011)),                           # c.lwsp
+        (is_op(0b10, 0b100) & ~c[12:12] & rs2_zero, rvc_i_type(Bits(12)(0), rd, 0b000, x0, 0b1100111)),  # c.jr
+        (is_op(0b10, 0b100) & ~c[12:12] & ~rs2_zero, rvc_r_type(0b0000000, rs2, x0, 0b000, rd, 0b0110011)),  # c.mv
+        (is_op(0b10, 0b100) & c[12:12] & rs2_zero & rd_zero, Bits(32)(0x00100073)),                     # c.ebreak
+        (is_op(0b10, 0b100) & c[12:12] & rs2_zero & ~rd_zero, rvc_i_type(Bits(12)(0), rd, 0b000, x1, 0b1100111)),  # c.jalr
+        (is_op(0b10, 0b100) & c[12:12] & ~rs2_zero, rvc_r_type(0b0000000, rs2, rd, 0b000, rd, 0b0110011)),  # c.add
+        (is_op(0b10, 0b110), rvc_s_type(swsp_imm, rs2, x2, 0b010, 0b0100011)),                          # c.swsp
+    ]
+
+    expanded = Bits(32)(0)
+    for cond, inst in cases:
+        expanded = cond.select(inst.bitcast(Bits(32)), expanded)
+    return expanded
+
+def decode_logic(instruction, is_compressed = None):
+    return decoder_signals.bundle(**decode_fields(instruction, is_compressed))
+
+def decode_fields(instruction, is_compressed = None):
+    # 以字典的形式返回译码结果，宏融合需要在打包之前改写其中的一些字段
 
     views = {i: i(instruction) for i in supported_types} # 这里的 views 指的是什么
     is_type = {i: Bits(1)(0) for i in supported_types}
@@ -80,13 +177,29 @@ def decode_logic(instruction):
     alu = supported.select(alu, Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE))
     cond = supported.select(cond, Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_TRUE))
 
-    memory = concat(eqs['sw'], eqs['lw'] | eqs['lbu'])
-    mem_ext = concat(eqs['lbu'], eqs['lbu'])
+    # 向量指令借用 R 型的格式，寄存器字段里放的是向量寄存器号：
+    # 只有 vle32 / vse32 的 rs1 是标量的基地址，只有 vredsum 的 rd 是标量寄存器
+    vec_view = views[RInstruction].view()
+    is_vector = eqs['vle32'] | eqs['vse32'] | eqs['vadd'] | eqs['vmul'] | eqs['vredsum']
+    vec_arith = eqs['vadd'] | eqs['vmul'] | eqs['vredsum']
+    rd_valid = rd_valid & ~(is_vector & ~eqs['vredsum'])
+    rs1_valid = rs1_valid & ~vec_arith
+    rs2_valid = rs2_valid & ~is_vector
+
+    # lr.w 按 load 处理；sc.w 和 amoadd.w 要写内存，放进 store 队列，在 ROB head 上执行，结果写回 rd
+    is_lr = eqs['lr.w']
+    is_sc = eqs['sc.w']
+    is_amo = eqs['amoadd.w']
+    rs2_valid = rs2_valid & ~is_lr
+
+    is_load = eqs['lw'] | eqs['lbu'] | eqs['lb'] | eqs['lh'] | eqs['lhu'] | eqs['vle32'] | is_lr
+    memory = concat(eqs['sw'] | eqs['sb'] | eqs['sh'] | eqs['vse32'] | is_sc | is_amo, is_load)
+    mem_ext = concat(Bits(1)(0), eqs['lb'] | eqs['lh'])
 
     is_branch = is_type[BInstruction] | is_type[JInstruction] | eqs['jalr'] | eqs['mret']
-    is_reg_write = is_type[RInstruction] | is_type[IInstruction] | is_type[JInstruction] | eqs['lw'] | eqs['lbu'] | eqs['jalr'] # Newly inserted, waiting to be verified
-    is_memory_write = is_type[SInstruction] # Newly inserted, waiting to be verified
-    is_load = eqs['lw'] | eqs['lbu']
+    is_reg_write = is_type[RInstruction] | is_type[IInstruction] | is_type[JInstruction] | is_load | eqs['jalr'] # Newly inserted, waiting to be verified
+    is_reg_write = is_reg_write & ~(is_vector & ~eqs['vredsum'])
+    is_memory_write = is_type[SInstruction] | eqs['vse32'] | is_sc | is_amo # Newly inserted, waiting to be verified
     is_load_or_store = is_load | is_memory_write
     is_offset_branch = is_type[BInstruction] | eqs['jal']
     link_pc = eqs['jalr'] | eqs['jal']
@@ -96,7 +209,12 @@ def decode_logic(instruction):
     get_high_bit = eqs['mulh'] | eqs['mulhu'] | eqs['mulhsu']
     rs1_sign = eqs['mulh'] | eqs['mulhsu']
     rs2_sign = eqs['mulh']
-    memory_length = eqs['lbu'].select(Bits(2)(0), Bits(2)(2)) # 00: byte, 01: half, 10: word
+    is_div = (alu == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_DIV))
+    is_rem = eqs['rem'] | eqs['remu']
+    div_signed = eqs['div'] | eqs['rem']
+    is_byte = eqs['lb'] | eqs['lbu'] | eqs['sb']
+    is_half = eqs['lh'] | eqs['lhu'] | eqs['sh']
+    memory_length = is_byte.select(Bits(2)(0), is_half.select(Bits(2)(1), Bits(2)(2))) # 00: byte, 01: half, 10: word
     
 
     rd = rd_valid.select(views[RInstruction].view().rd, Bits(5)(0))
@@ -112,6 +230,13 @@ def decode_logic(instruction):
             imm = is_type[i].select(tmp_imm, imm)
     imm = eqs['lui'].select(views[UInstruction].imm(False).concat(Bits(12)(0)), imm)
     imm = eqs['auipc'].select(views[UInstruction].imm(False).concat(Bits(12)(0)), imm)
+    # sh1add / sh2add / sh3add 复用 ALU_SHADD，移位量放在 imm 里
+    for n in range(1, 4):
+        imm = eqs[f'sh{n}add'].select(Bits(32)(n), imm)
+        imm_valid = imm_valid | eqs[f'sh{n}add']
+
+    # 短的向前条件分支（if-then 的 hammock）：偏移为正并且不超过 HAMMOCK_MAX_LEN 条指令
+    is_hammock = is_type[BInstruction] & ~imm[31:31] & (imm <= Bits(32)(4 * HAMMOCK_MAX_LEN))
 
     csr_read = eqs['csrrs'] | eqs['mret']
     csr_calculate = eqs['csrrs']
@@ -123,7 +248,10 @@ def decode_logic(instruction):
         view = views[IInstruction].view()
         log('CSR instruction: opcode = 0x{:x} func3: 0x{:x} csr_addr: 0x{:x}', view.opcode, view.func3, view.imm)
 
-    return decoder_signals.bundle(
+    if is_compressed is None:
+        is_compressed = Bits(1)(0)
+
+    return dict(
         memory=memory,
         alu=alu,
         cond=cond,
@@ -154,5 +282,20 @@ def decode_logic(instruction):
         get_high_bit = get_high_bit,
         rs1_sign = rs1_sign,
         rs2_sign = rs2_sign,
+        is_div = is_div,
+        is_rem = is_rem,
+        div_signed = div_signed,
         memory_length = memory_length,
+        is_compressed = is_compressed,
+        cmp_to_rd = Bits(1)(0),
+        is_vector = is_vector,
+        vec_op = vec_view.func3,
+        vd = vec_view.rd[0:2],
+        vs1 = vec_view.rs1[0:2],
+        vs2 = vec_view.rs2[0:2],
+        is_hammock = is_hammock,
+        is_predicated = Bits(1)(0),
+        is_lr = is_lr,
+        is_sc = is_sc,
+        is_amo = is_amo,
     )
\ No newline at end of file
@@ -3,6 +3,15 @@ from opcodes import *
 from instruction import *
 from decode_logic import *
 from ROB import *
+from utils import *
+from perf import *
+from fusion import *
+
+UOP_CACHE_LOG_SIZE = 4  # 译码结果缓存的条目数取对数，按 PC 的半字地址直接映射
+LOOP_BUFFER_SIZE = 8    # 循环缓冲能存下几条译码结果（融合后的一对算一条），循环体加上闭合分支不能超过这个数
+
+def uop_index(pc):
+    return pc[1:UOP_CACHE_LOG_SIZE].bitcast(Bits(UOP_CACHE_LOG_SIZE))
 
 class Decoder(Module):
 
@@ -11,26 +20,225 @@ class Decoder(Module):
             "receive": Port(Bits(1)),
             "fetch_addr": Port(Bits(32)),
             "predicted_taken": Port(Bits(1)),
-            "pred_next_pc": Port(Bits(32))
+            "predicted_target": Port(Bits(32)),
+            "uop_hit": Port(Bits(1))            # 取指阶段查译码结果缓存命中了，icache 没有读
         })
         self.name = "D"
 
     @module.combinational
-    def build(self, rob: ROB, rdata: Array, rob_full_array: Array, decode_valid_array: Array, clear_signal_array: Array):
-        receive, fetch_addr, predicted_taken, pred_next_pc = self.pop_all_ports(True)
-        inst = rdata[0].bitcast(Bits(32))
+    def build(self, rob: ROB, icache_douts: list, rob_full_array: Array, decode_valid_array: Array, clear_signal_array: Array,
+              decode_redirect_valid_array: Array, decode_redirect_pc_array: Array, loop_active_array: Array,
+              tid: int, decode_turn_array: Array, perf: PerfCounters):
+        receive, fetch_addr, predicted_taken, predicted_target, uop_hit = self.pop_all_ports(True)
+
+        # 译码结果缓存：按 PC 存下展开后的指令和整套译码信号，标签在取指阶段，命中时 icache 没有读，
+        # 指令和译码信号都从这里取；只有不命中的时候才需要译码，命中时把译码逻辑的输入固定为 0，不让它跟着翻转
+        # icache 只能由程序镜像初始化，store 写不到它，缓存的内容不会过期
+        window = uop_hit.select(Bits(32)(0), icache_window(icache_douts, fetch_addr))
+        # 低两位不是 11 的是 16 位压缩指令，先展开成 32 位再译码
+        raw_compressed = (window[0:1] != Bits(2)(0b11))
+        raw_inst = raw_compressed.select(expand_rvc(window[0:15]), window)
+        decoded = decode_fields(raw_inst, raw_compressed)
+
+        uop_size = 1 << UOP_CACHE_LOG_SIZE
+        uop_inst = RegArray(Bits(32), uop_size)
+        uop_fields = {k: RegArray(v.dtype, uop_size) for k, v in decoded.items()}
+        uop_idx = uop_index(fetch_addr)
+        inst = uop_hit.select(uop_inst[uop_idx], raw_inst)
+        fields = {k: uop_hit.select(reg[uop_idx], decoded[k]) for k, reg in uop_fields.items()}
+        with Condition(receive & ~uop_hit):
+            uop_inst[uop_idx] = raw_inst
+            for k, reg in uop_fields.items():
+                reg[uop_idx] = decoded[k]
+
+        is_compressed = fields['is_compressed']
+        inst_len = is_compressed.select(Int(32)(2), Int(32)(4))
+        pred_next_pc = predicted_taken.select(predicted_target, (fetch_addr.bitcast(Int(32)) + inst_len).bitcast(Bits(32)))
 
         rob_full = rob_full_array[0]
         clear = clear_signal_array[0]
+        # SMT 时上个周期轮到哪个线程取指，这个周期就轮到哪个线程的译码器往 ROB 发指令，两个译码器不会同时发
+        grant = decode_turn_array[0] == Bits(1)(tid)
+
+        # 循环缓冲的状态：0 空闲，1 正在记录循环体，2 正在重放
+        lsd_state = RegArray(Bits(2), 1)
+        replaying = lsd_state[0] == Bits(2)(2)
+
+        # 上个周期译码阶段改了取指方向，这个周期到的是改向之前顺序取进来的指令，丢掉
+        # 重放的时候取指已经停了，还在路上的指令也丢掉
+        incoming = receive & ~clear & ~decode_redirect_valid_array[0] & ~replaying
+
+        # log("raw: 0x{:08x}  | addr: 0x{:05x} | incoming: {}", inst, fetch_addr, incoming)
+
+        # 宏融合：可能作为融合对第一条的指令先在这里留一个周期，
+        # 下一条指令紧跟着到来并且能和它融合时，两条指令只占一个 ROB / RS 条目
+        pending_valid = RegArray(Bits(1), 1)
+        pending_inst = RegArray(Bits(32), 1)
+        pending_addr = RegArray(Bits(32), 1)
+        pending_taken = RegArray(Bits(1), 1)
+        pending_next_pc = RegArray(Bits(32), 1)
+        pending_target = RegArray(Bits(32), 1)
+        pending_fields = {k: RegArray(v.dtype, 1) for k, v in fields.items()}
+        first = {k: reg[0] for k, reg in pending_fields.items()}
+
+        # 动态谓词化：hammock 分支按不跳转取指，分支和它的目标之间的指令叫作影子
+        # 影子里的指令不参与融合，否则融合出来的操作可能一半在影子里，一半在影子外
+        hammock_open = RegArray(Bits(1), 1)
+        hammock_lo = RegArray(Bits(32), 1)
+        hammock_hi = RegArray(Bits(32), 1)
+        fusion_ok = ~hammock_open[0]
+
+        can_fuse, kinds, fused = fuse_pair(pending_inst[0], first, inst, fields)
+        # 第一条指令被预测为跳转时，后面来的不是它顺序执行的下一条，不能融合
+        fuse = pending_valid[0] & incoming & can_fuse & ~pending_taken[0] & fusion_ok
+
+        send_pending = pending_valid[0] & ~fuse & ~clear & grant
+        hold_incoming = incoming & ~fuse & (pending_valid[0] | (fusion_head(inst) & fusion_ok))
+        send_incoming = incoming & ~pending_valid[0] & ~hold_incoming
+        sending = fuse | send_pending | send_incoming
+
+        out_fields = {}
+        for k in fields:
+            out_fields[k] = send_pending.select(first[k], fuse.select(fused[k], fields[k]))
+        out_addr = send_pending.select(pending_addr[0], fetch_addr)
+        out_taken = send_pending.select(pending_taken[0], predicted_taken)
+        out_next_pc = send_pending.select(pending_next_pc[0], pred_next_pc)
+        out_target = send_pending.select(pending_target[0], predicted_target)
+
+        # 直接跳转的目标在译码时就能算出来：jal（以及融合成 jal 的 auipc + jalr）一定跳到 PC + imm，
+        # 条件分支在 BTB 里没有它的目标时改用静态预测：向后跳的预测跳转，向前跳的预测不跳转
+        # 和取指时的预测不一样就在下个周期让取指改向，只损失一条顺序取进来的指令，不必等到提交时清空流水线
+        out_len = out_fields['is_compressed'].select(Int(32)(2), Int(32)(4))
+        seq_pc = (out_addr.bitcast(Int(32)) + out_len).bitcast(Bits(32))
+        branch_target = (out_addr.bitcast(Int(32)) + out_fields['imm'].bitcast(Int(32))).bitcast(Bits(32))
+        is_jal = out_fields['is_offset_br'] & out_fields['link_pc']
+        is_cond = out_fields['is_offset_br'] & ~out_fields['link_pc']
+        btb_miss = is_cond & (out_target != branch_target)
+        static_taken = out_fields['imm'][31:31]
+        final_taken = is_jal.select(Bits(1)(1), btb_miss.select(static_taken, out_taken))
+        final_next_pc = (is_jal | (btb_miss & static_taken)).select(branch_target, btb_miss.select(seq_pc, out_next_pc))
+        redirect = sending & (final_next_pc != out_next_pc)
+        decode_redirect_valid_array[0] = redirect
+        with Condition(redirect):
+            decode_redirect_pc_array[0] = final_next_pc
+
+        # 取指时已经按跳转预测的分支不谓词化，影子里的分支也不再谓词化
+        predicated = out_fields['is_hammock'] & ~final_taken & ~hammock_open[0]
+        out_fields['is_predicated'] = predicated
+        open_shadow = sending & predicated
+        leave_shadow = sending & ((out_addr >= hammock_hi[0]) | (out_addr <= hammock_lo[0]))
+        with Condition(open_shadow):
+            hammock_lo[0] = out_addr
+            hammock_hi[0] = (out_addr.bitcast(Int(32)) + out_fields['imm'].bitcast(Int(32))).bitcast(Bits(32))
+        hammock_open[0] = ~clear & (open_shadow | (hammock_open[0] & ~leave_shadow))
+
+        # 循环缓冲：遇到一个向后跳转的条件分支时，把下一轮循环体译码出来的结果按顺序存下来；
+        # 闭合的分支再次到来时，如果中间的指令都是顺序执行、没有别的分支，就进入重放：
+        # 直接从缓冲里把译码结果发给 ROB，取指和译码都停下来，直到循环出口预测错误清空流水线
+        lsd_start = RegArray(Bits(32), 1)
+        lsd_end = RegArray(Bits(32), 1)
+        lsd_expect = RegArray(Bits(32), 1)
+        lsd_count = RegArray(Int(32), 1)
+        lsd_len = RegArray(Int(32), 1)
+        lsd_ptr = RegArray(Int(32), 1)
+        lsd_fields = {k: RegArray(v.dtype, LOOP_BUFFER_SIZE) for k, v in fields.items()}
+        lsd_addr = RegArray(Bits(32), LOOP_BUFFER_SIZE)
+        lsd_taken = RegArray(Bits(1), LOOP_BUFFER_SIZE)
+        lsd_next_pc = RegArray(Bits(32), LOOP_BUFFER_SIZE)
+        lsd_bits = (LOOP_BUFFER_SIZE - 1).bit_length()
+
+        idle = lsd_state[0] == Bits(2)(0)
+        capturing = lsd_state[0] == Bits(2)(1)
+        first_addr = fuse.select(pending_addr[0], out_addr)     # 融合的一对要从第一条的地址开始接上
+        backward = is_cond & final_taken & (branch_target < out_addr)
+        start_capture = idle & sending & backward
+        in_order = first_addr == lsd_expect[0]
+        at_end = out_addr == lsd_end[0]
+        closes = at_end & is_cond & final_taken & (final_next_pc == lsd_start[0])
+        plain_body = ~out_fields['is_branch'] & (out_fields['alu'] != Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE))
+        room = lsd_count[0] < Int(32)(LOOP_BUFFER_SIZE - 1)
+        store_entry = capturing & sending & in_order & (closes | (~at_end & plain_body & room))
+        start_replay = store_entry & closes
+        abort = capturing & sending & ~store_entry
+
+        slot = lsd_count[0].bitcast(Bits(32))[0:lsd_bits - 1]
+        with Condition(store_entry):
+            for k, reg in lsd_fields.items():
+                reg[slot] = out_fields[k]
+            lsd_addr[slot] = out_addr
+            lsd_taken[slot] = final_taken
+            lsd_next_pc[slot] = final_next_pc
+        with Condition(start_capture):
+            lsd_start[0] = branch_target
+            lsd_end[0] = out_addr
+            lsd_expect[0] = branch_target
+            lsd_count[0] = Int(32)(0)
+        with Condition(store_entry & ~start_replay):
+            lsd_count[0] = lsd_count[0] + Int(32)(1)
+            lsd_expect[0] = final_next_pc
+        with Condition(start_replay):
+            lsd_len[0] = lsd_count[0] + Int(32)(1)
+            lsd_ptr[0] = Int(32)(0)
+
+        replay_send = replaying & ~clear & ~rob_full & grant
+        ptr = lsd_ptr[0].bitcast(Bits(32))[0:lsd_bits - 1]
+        next_ptr = lsd_ptr[0] + Int(32)(1)
+        with Condition(replay_send):
+            lsd_ptr[0] = (next_ptr == lsd_len[0]).select(Int(32)(0), next_ptr)
+
+        next_state = lsd_state[0]
+        next_state = start_capture.select(Bits(2)(1), next_state)
+        next_state = abort.select(Bits(2)(0), next_state)
+        next_state = start_replay.select(Bits(2)(2), next_state)
+        next_state = clear.select(Bits(2)(0), next_state)
+        lsd_state[0] = next_state
+        loop_active_array[0] = next_state == Bits(2)(2)
 
-        sending = receive & ~clear
+        with Condition(hold_incoming):
+            pending_inst[0] = inst
+            pending_addr[0] = fetch_addr
+            pending_taken[0] = predicted_taken
+            pending_next_pc[0] = pred_next_pc
+            pending_target[0] = predicted_target
+            for k, reg in pending_fields.items():
+                reg[0] = fields[k]
+        # 改向或者开始重放时，一起留下来的那条也是顺序取进来的，丢掉；没轮到自己时留着的那条继续等
+        keep_pending = pending_valid[0] & ~grant & ~clear
+        pending_valid[0] = (hold_incoming & ~redirect & ~start_replay) | keep_pending
 
-        # log("raw: 0x{:08x}  | addr: 0x{:05x} | sending: {}", inst, fetch_addr, sending)
+        out = dict(
+            receive = sending | replay_send,
+            signals = {k: replay_send.select(reg[ptr], out_fields[k]) for k, reg in lsd_fields.items()},
+            addr = replay_send.select(lsd_addr[ptr], out_addr),
+            predicted_taken = replay_send.select(lsd_taken[ptr], final_taken),
+            pred_next_pc = replay_send.select(lsd_next_pc[ptr], final_next_pc)
+        )
+        # SMT 时几个线程的译码器共用一个 ROB 端口，由 ThreadArbiter 转发
+        if rob is not None:
+            rob.async_called(
+                receive = out['receive'],
+                signals = decoder_signals.bundle(**out['signals']),
+                addr = out['addr'],
+                predicted_taken = out['predicted_taken'],
+                pred_next_pc = out['pred_next_pc'],
+                tid = Bits(1)(tid)
+            )
 
-        rob.async_called(
-            receive = sending,
-            signals = decode_logic(inst),
-            addr = fetch_addr,
-            predicted_taken = predicted_taken,
-            pred_next_pc = pred_next_pc
-        )
\ No newline at end of file
+        perf.incr("decode_insts", incoming)
+        perf.incr("decode_rvc_insts", incoming & is_compressed)
+        perf.incr("fusion_pairs", fuse)
+        perf.incr("decode_predicated_branches", open_shadow)
+        perf.incr("decode_redirects", redirect)
+        perf.incr("decode_jal_redirects", redirect & is_jal)
+        perf.incr("decode_btfn_predictions", sending & btb_miss)
+        perf.incr("lsd_loops_captured", start_replay)
+        perf.incr("lsd_replayed_insts", replay_send)
+        perf.incr("lsd_frontend_idle_cycles", replaying)
+        # 前端气泡：ROB 收得下、又轮到这个线程，取指这条路却没有送来指令的周期。重放时每个这样的周期都会送一条，
+        # 没有气泡，所以重放省掉的气泡按取指这条路平时的气泡率估算（见 main.py 的 summarize_perf）
+        accepting = ~rob_full & ~clear & grant & ~replaying
+        perf.incr("frontend_open_cycles", accepting)
+        perf.incr("frontend_bubbles", accepting & ~sending)
+        for name, kind in kinds.items():
+            perf.incr(f"fusion_{name}", fuse & kind)
+        return out
@@ -0,0 +1,128 @@
+from assassyn.frontend import *
+from instruction import *
+from utils import *
+from perf import *
+
+DIV_BITS_PER_CYCLE = 2      # 每个周期算出几位商，32 位除法最多需要 32 / DIV_BITS_PER_CYCLE 个周期
+
+def negate32(value):
+    return (Int(32)(0) - value.bitcast(Int(32))).bitcast(Bits(32))
+
+class DIV_ALU(Module):
+
+    def __init__(self):
+        super().__init__(ports = {
+            "valid": Port(Bits(1)),
+            "rob_index": Port(Bits(3)),
+            "alu_a": Port(Bits(32)),
+            "alu_b": Port(Bits(32)),
+            "pc_addr": Port(Bits(32)),
+            "is_rem": Port(Bits(1)),
+            "div_signed": Port(Bits(1)),
+        })
+        self.name = "DIV_ALU"
+
+    @module.combinational
+    def build(
+        self,
+        rob_index_array: Array,
+        result_array: Array,
+        pc_result_array: Array,
+        signal_array: Array,
+        div_busy_array: Array,
+        clear_signal_array: Array,
+        perf: PerfCounters,
+    ):
+        (
+            valid,
+            rob_index,
+            alu_a,
+            alu_b,
+            pc_addr,
+            is_rem,
+            div_signed
+        ) = self.pop_all_ports(True)
+
+        # 迭代的 restoring 除法器，同一时间只处理一条指令，忙的时候 RS 不会再发除法过来
+        busy = RegArray(Bits(1), 1)
+        count = RegArray(Int(32), 1)              # 还剩多少位商没有算
+        rem_reg = RegArray(Bits(32), 1)
+        quot_reg = RegArray(Bits(32), 1)          # 被除数逐位移出，商逐位移入
+        divisor_reg = RegArray(Bits(32), 1)
+        neg_quot_reg = RegArray(Bits(1), 1)
+        neg_rem_reg = RegArray(Bits(1), 1)
+        is_rem_reg = RegArray(Bits(1), 1)
+        rob_index_reg = RegArray(Bits(3), 1)
+        addr_reg = RegArray(Bits(32), 1)
+
+        clear = clear_signal_array[0]
+        start = valid & ~busy[0] & ~clear
+
+        a_neg = div_signed & alu_a[31:31]
+        b_neg = div_signed & alu_b[31:31]
+        a_abs = a_neg.select(negate32(alu_a), alu_a)
+        b_abs = b_neg.select(negate32(alu_b), alu_b)
+
+        # 提前结束：除数为 0，或者被除数的绝对值比除数小，结果不用迭代就能确定
+        div_by_zero = (alu_b == Bits(32)(0))
+        trivial = ~div_by_zero & (a_abs < b_abs)
+        early = div_by_zero | trivial
+        early_quot = div_by_zero.select(Bits(32)(0xffffffff), Bits(32)(0))
+        early_result = is_rem.select(alu_a, early_quot)
+
+        # 被除数前导 0 对应的那几位商一定是 0，直接跳过
+        clz = Int(32)(32)
+        for i in range(32):
+            clz = a_abs[i:i].select(Int(32)(31 - i), clz)
+
+        with Condition(start & ~early):
+            busy[0] = Bits(1)(1)
+            count[0] = Int(32)(32) - clz
+            rem_reg[0] = Bits(32)(0)
+            quot_reg[0] = a_abs << clz.bitcast(Bits(32))[0:4]
+            divisor_reg[0] = b_abs
+            neg_quot_reg[0] = a_neg ^ b_neg
+            neg_rem_reg[0] = a_neg
+            is_rem_reg[0] = is_rem
+            rob_index_reg[0] = rob_index
+            addr_reg[0] = pc_addr
+
+        # 每个周期做 DIV_BITS_PER_CYCLE 步移位、比较、相减
+        rem = rem_reg[0]
+        quot = quot_reg[0]
+        divisor = concat(Bits(1)(0), divisor_reg[0]).bitcast(UInt(33))
+        for j in range(DIV_BITS_PER_CYCLE):
+            active = count[0] > Int(32)(j)
+            shifted = concat(rem, quot[31:31]).bitcast(UInt(33))
+            ge = shifted >= divisor
+            diff = (shifted - divisor).bitcast(Bits(33))[0:31]
+            new_rem = ge.select(diff, shifted.bitcast(Bits(33))[0:31])
+            new_quot = concat(quot[0:30], ge)
+            rem = active.select(new_rem, rem)
+            quot = active.select(new_quot, quot)
+
+        finishing = busy[0] & (count[0] <= Int(32)(DIV_BITS_PER_CYCLE)) & ~clear
+        with Condition(busy[0] & ~finishing & ~clear):
+            count[0] = count[0] - Int(32)(DIV_BITS_PER_CYCLE)
+            rem_reg[0] = rem
+            quot_reg[0] = quot
+        with Condition(finishing | clear):
+            busy[0] = Bits(1)(0)
+
+        iter_result = is_rem_reg[0].select(neg_rem_reg[0].select(negate32(rem), rem),
+                                           neg_quot_reg[0].select(negate32(quot), quot))
+
+        # 迭代做完的结果和提前结束的结果不会在同一个周期出现：忙的时候不会开始新的除法
+        early_done = start & early
+        write_back = finishing | early_done
+        signal_array[0] = write_back.select(Bits(1)(1), Bits(1)(0))
+        with Condition(write_back):
+            result_array[0] = finishing.select(iter_result, early_result)
+            rob_index_array[0] = finishing.select(rob_index_reg[0], rob_index)
+            pc_result_array[0] = (finishing.select(addr_reg[0], pc_addr).bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
+
+        div_busy_array[0] = (busy[0] & ~finishing & ~clear) | (start & ~early)
+
+        perf.incr("div_ops", start)
+        perf.incr("div_early_out", early_done)
+        perf.incr("div_busy_cycles", busy[0])
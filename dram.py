@@ -0,0 +1,122 @@
+from assassyn.frontend import *
+from perf import *
+
+DRAM_BANKS_LOG = 2      # DRAM 的 bank 数取 log
+DRAM_COL_BITS = 8       # 一行 256 字节；测试程序的数据都很小，行开得太大就只剩行命中了
+DRAM_OPEN_ROW = True    # True：访问完以后行保持打开（open-row）；False：每次访问完立刻预充电（closed-row）
+T_CAS = 3               # 行已经打开时读写一次要等的周期数
+T_RCD = 4               # 打开一行（activate）要等的周期数
+T_RP = 4                # 关掉一行（precharge）要等的周期数
+T_BURST = 2             # 数据总线上两次传输之间至少隔几个周期，限制带宽
+
+class DRAMTiming:
+    # dcache 背后的 DRAM 时序模型：数据仍然放在 dcache 的 SRAM 里，这里只决定一次访存要等多久
+    # 地址按 行 | bank | 列 划分，每个 bank 记住自己打开的是哪一行；每个访存端口同一时间只有一个请求在等
+    # 端口上的请求要保持不变直到被放行，放行的那个周期才真正读写 SRAM
+    # 要在使用它的模块的 build 里创建：各个端口调用 request，最后调用一次 update
+
+    def __init__(self, ports, open_row = DRAM_OPEN_ROW):
+        self.ports = ports
+        self.open_row = open_row
+        self.banks = 1 << DRAM_BANKS_LOG
+        self.row_bits = 32 - DRAM_COL_BITS - DRAM_BANKS_LOG
+        self.row = [RegArray(Bits(self.row_bits), 1) for _ in range(self.banks)]       # 每个 bank 打开的行
+        self.row_valid = [RegArray(Bits(1), 1) for _ in range(self.banks)]             # 这个 bank 有没有打开的行
+        self.bank_busy = [RegArray(Int(32), 1, initializer=[0]) for _ in range(self.banks)]  # bank 还要忙几个周期
+        self.bus_busy = RegArray(Int(32), 1, initializer=[0])                          # 数据总线还要忙几个周期
+        self.active = [RegArray(Bits(1), 1) for _ in range(ports)]                     # 端口上的请求已经开始访问 DRAM
+        self.wait = [RegArray(Int(32), 1, initializer=[0]) for _ in range(ports)]      # 还要等几个周期才能放行
+        self.req_addr = [RegArray(Bits(32), 1) for _ in range(ports)]
+
+        # 以下在 request 里逐个端口累积，update 时一起写回
+        self.grants = []
+        self.granted = Bits(1)(0)
+        self.bus_free = self.bus_busy[0] == Int(32)(0)
+        self.bank_start = [Bits(1)(0)] * self.banks
+        self.bank_occupy = [Int(32)(0)] * self.banks
+        self.bank_row = [Bits(self.row_bits)(0)] * self.banks
+        self.n_hits = UInt(32)(0)
+        self.n_conflicts = UInt(32)(0)
+        self.n_empty = UInt(32)(0)
+        self.n_grants = UInt(32)(0)
+        self.n_waiting = UInt(32)(0)
+
+    def bank_of(self, addr):
+        return addr[DRAM_COL_BITS : DRAM_COL_BITS + DRAM_BANKS_LOG - 1]
+
+    def row_of(self, addr):
+        return addr[DRAM_COL_BITS + DRAM_BANKS_LOG : 31]
+
+    def request(self, valid, addr):
+        # 一个端口这个周期的请求，返回是否放行；先调用的端口优先，同一个周期只放行一个（数据总线只有一条）
+        p = len(self.grants)
+        assert p < self.ports
+        bank = self.bank_of(addr)
+        row = self.row_of(addr)
+        same = self.active[p][0] & (self.req_addr[p][0] == addr)
+
+        busy = Bits(1)(0)
+        hit = Bits(1)(0)
+        row_open = Bits(1)(0)
+        claimed = Bits(1)(0)
+        for b in range(self.banks):
+            mine = bank == Bits(DRAM_BANKS_LOG)(b)
+            busy = mine.select(self.bank_busy[b][0] != Int(32)(0), busy)
+            row_open = mine.select(self.row_valid[b][0], row_open)
+            hit = mine.select(self.row_valid[b][0] & (self.row[b][0] == row), hit)
+            claimed = mine.select(self.bank_start[b], claimed)
+
+        # 行命中只要 CAS；open-row 下换行要先预充电再打开；closed-row 下每次都要打开，预充电算在 bank 忙的时间里
+        latency = Int(32)(T_RCD + T_CAS)
+        if self.open_row:
+            latency = hit.select(Int(32)(T_CAS), row_open.select(Int(32)(T_RP + T_RCD + T_CAS), latency))
+            occupy = latency
+        else:
+            occupy = Int(32)(T_RCD + T_CAS + T_RP)
+
+        start = valid & ~same & ~busy & ~claimed
+        for b in range(self.banks):
+            mine = start & (bank == Bits(DRAM_BANKS_LOG)(b))
+            self.bank_start[b] = self.bank_start[b] | mine
+            self.bank_occupy[b] = mine.select(occupy, self.bank_occupy[b])
+            self.bank_row[b] = mine.select(row, self.bank_row[b])
+
+        wait = self.wait[p][0]
+        grant = valid & same & (wait == Int(32)(0)) & self.bus_free & ~self.granted
+        self.granted = self.granted | grant
+        self.grants.append(grant)
+
+        self.active[p][0] = start | (same & ~grant)
+        self.wait[p][0] = start.select(latency, (same & (wait != Int(32)(0))).select(wait - Int(32)(1), wait))
+        with Condition(start):
+            self.req_addr[p][0] = addr
+
+        one = UInt(32)(1)
+        zero = UInt(32)(0)
+        self.n_hits = self.n_hits + (start & hit).select(one, zero)
+        self.n_conflicts = self.n_conflicts + (start & row_open & ~hit).select(one, zero)
+        self.n_empty = self.n_empty + (start & ~row_open).select(one, zero)
+        self.n_grants = self.n_grants + grant.select(one, zero)
+        self.n_waiting = self.n_waiting + valid.select(one, zero)
+        return grant
+
+    def update(self, perf: PerfCounters):
+        # 所有端口都请求过以后调用一次，更新 bank 和数据总线的状态
+        assert len(self.grants) == self.ports
+        for b in range(self.banks):
+            busy = self.bank_busy[b][0]
+            self.bank_busy[b][0] = self.bank_start[b].select(self.bank_occupy[b], (busy == Int(32)(0)).select(busy, busy - Int(32)(1)))
+            with Condition(self.bank_start[b]):
+                self.row[b][0] = self.bank_row[b]
+                self.row_valid[b][0] = Bits(1)(1 if self.open_row else 0)
+        bus = self.bus_busy[0]
+        self.bus_busy[0] = self.granted.select(Int(32)(T_BURST - 1), self.bus_free.select(bus, bus - Int(32)(1)))
+
+        # 行缓冲命中率 = dram_row_hits / (hits + conflicts + empty)；平均访存延迟 = dram_latency_cycles / dram_accesses
+        always = Bits(1)(1)
+        perf.incr("dram_accesses", always, self.n_grants)
+        perf.incr("dram_row_hits", always, self.n_hits)
+        perf.incr("dram_row_conflicts", always, self.n_conflicts)
+        perf.incr("dram_row_empty", always, self.n_empty)
+        perf.incr("dram_latency_cycles", always, self.n_waiting)
+        perf.incr("dram_bus_stall_cycles", ~self.bus_free & (self.n_waiting != UInt(32)(0)))
@@ -1,5 +1,11 @@
 from assassyn.frontend import *
 from decoder import *
+from utils import *
+from perf import *
+
+CONF_BITS = 3           # 置信度计数器的位数：分支每预测对一次加一，预测错就清零
+CONF_THRESHOLD = 4      # 计数器小于这个值的分支算低置信度
+CONF_GATING = True      # 低置信度的分支还没提交时停止取指；关掉以后可以对比错误路径上取到的指令数
 
 class Fetcher(Module):
 
@@ -28,43 +34,112 @@ class FetcherImpl(Downstream):
         decoder: Decoder,
         rob_full_array: Array,
         decode_valid_array: Array,
-        icache: SRAM,
+        icache_banks: list,
         clear_signal_array: Array,
         reset_pc_addr_array: Array,
         bht_array: Array,
         btb_target_array: Array,
-        bht_log_size: int
+        bht_log_size: int,
+        conf_array: Array,
+        commit_valid_array: Array,
+        commit_addr_array: Array,
+        decode_redirect_valid_array: Array,
+        decode_redirect_pc_array: Array,
+        loop_active_array: Array,
+        tid: int,
+        fetch_turn_array: Array,
+        perf: PerfCounters
     ):
-        local_pc_addr = pc_addr.bitcast(Bits(32))
+        # pc_reg 里存的是上一次取指的地址，指令可能是 2 字节也可能是 4 字节，
+        # 要等上一次取到的指令从 icache 读出来以后，才知道顺序执行的下一条指令在哪里
+        last_valid = RegArray(Bits(1), 1)       # 上个周期是否真的发出了取指
+        last_taken = RegArray(Bits(1), 1)       # 上个周期取的那条指令是否被预测为跳转
+        last_target = RegArray(Bits(32), 1)
+
+        # 译码结果缓存的标签放在取指阶段：命中的 PC 不读 icache，指令长度也从缓存里取
+        uop_size = 1 << UOP_CACHE_LOG_SIZE
+        uop_valid = [RegArray(Bits(1), 1) for _ in range(uop_size)]
+        uop_tag = RegArray(Bits(32), uop_size)
+        uop_compressed = RegArray(Bits(1), uop_size)
+        last_hit = RegArray(Bits(1), 1)         # 上个周期取的那条在译码结果缓存里命中，没有读 icache
+        last_compressed = RegArray(Bits(1), 1)
+
+        last_pc = pc_addr.bitcast(Bits(32))
+        window_len = inst_length(icache_window([bank.dout for bank in icache_banks], last_pc))
+        last_len = last_hit[0].select(last_compressed[0].select(Int(32)(2), Int(32)(4)), window_len)
+        last_seq_pc = (last_pc.bitcast(Int(32)) + last_len).bitcast(Bits(32))
+        local_pc_addr = last_valid[0].select(last_taken[0].select(last_target[0], last_seq_pc), last_pc)
+        # 译码阶段算出了直接跳转的目标，或者对 BTB 里没有的条件分支做了静态预测
+        redirect = decode_redirect_valid_array[0]
+        local_pc_addr = redirect.select(decode_redirect_pc_array[0], local_pc_addr)
 
-        bht_index = local_pc_addr[2 : 2 + bht_log_size - 1].bitcast(Bits(6))
+        # 上个周期没命中的那条，这个周期译码器把译码结果填进缓存，这里同时填标签；
+        # 正在被填的那一项不算命中，否则译码器下个周期读到的是刚换进去的另一条指令
+        uop_fill = last_valid[0] & ~last_hit[0]
+        fill_idx = uop_index(last_pc)
+        uop_idx = uop_index(local_pc_addr)
+        for i in range(uop_size):
+            with Condition(uop_fill & (fill_idx == Bits(UOP_CACHE_LOG_SIZE)(i))):
+                uop_valid[i][0] = Bits(1)(1)
+        with Condition(uop_fill):
+            uop_tag[fill_idx] = last_pc
+            uop_compressed[fill_idx] = window_len == Int(32)(2)
+        uop_hit = read_mux(uop_valid, uop_idx, uop_size, 1) & (uop_tag[uop_idx] == local_pc_addr) & \
+                  ~(uop_fill & (fill_idx == uop_idx))
+
+        bht_index = local_pc_addr[1 : bht_log_size].bitcast(Bits(6))
         current_state = bht_array[bht_index]
         should_branch = current_state[1:1] 
         predicted_target = btb_target_array[bht_index]
 
-        next_seq_pc = (local_pc_addr.bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
-        next_pc_pred = should_branch.select(predicted_target, next_seq_pc)
+        # 取到一条低置信度的分支以后先停下来，等它提交（或者流水线被清空）再继续取指，
+        # 这样它预测错的时候，错误路径上的指令不会占满 ROB / RS / LSQ
+        gate_active = RegArray(Bits(1), 1)
+        gate_pc = RegArray(Bits(32), 1)
+        low_conf = conf_array[bht_index] < Bits(CONF_BITS)(CONF_THRESHOLD)
 
         clear = clear_signal_array[0]
-        fetch_valid = (~rob_full_array[0]) & (~clear)
+        release = clear | redirect | (commit_valid_array[0] & (commit_addr_array[0] == gate_pc[0]))
+        gated = gate_active[0] & ~release
+        # 循环缓冲在重放的时候不需要取指；SMT 时只有轮到自己的线程才能取指
+        my_turn = fetch_turn_array[0] == Bits(1)(tid)
+        fetch_valid = (~rob_full_array[0]) & (~clear) & (~loop_active_array[0]) & my_turn
+        if CONF_GATING:
+            fetch_valid = fetch_valid & ~gated
+        start_gate = fetch_valid & low_conf
+        if CONF_GATING:
+            with Condition(start_gate):
+                gate_pc[0] = local_pc_addr
+            gate_active[0] = start_gate | gated
+
+        perf.incr("fetch_low_conf", start_gate)
+        perf.incr("fetch_gated_cycles", gated & ~rob_full_array[0] & ~clear & my_turn)
+        # 每次命中省掉一次 icache 读（两个半字 bank 各一次）和一次完整的译码
+        perf.incr("uop_hits", fetch_valid & uop_hit)
+        perf.incr("uop_misses", fetch_valid & ~uop_hit)
 
-        # log("fetch_valid : {} | addr: 0x{:05x} | pred_taken: {} | next_pc: 0x{:05x}", 
-        #    fetch_valid, local_pc_addr, should_branch, next_pc_pred)
+        # log("fetch_valid : {} | addr: 0x{:05x} | pred_taken: {} | target: 0x{:05x}", 
+        #    fetch_valid, local_pc_addr, should_branch, predicted_target)
 
         decoder.async_called(
             receive = fetch_valid, 
             fetch_addr = local_pc_addr,
             predicted_taken = should_branch,
-            pred_next_pc = next_pc_pred
+            predicted_target = predicted_target,
+            uop_hit = uop_hit
         )
         
-        with Condition(fetch_valid & (~clear)):
-            pc_reg[0] = next_pc_pred
-        with Condition(~fetch_valid & (~clear)):
-            pc_reg[0] = pc_reg[0]
-
-        with Condition(clear):
-            pc_reg[0] = reset_pc_addr_array[0]
+        pc_reg[0] = clear.select(reset_pc_addr_array[0], local_pc_addr)
+        last_valid[0] = fetch_valid
+        last_taken[0] = should_branch
+        last_target[0] = predicted_target
+        last_hit[0] = uop_hit
+        last_compressed[0] = uop_compressed[uop_idx]
 
-        icache.build(Bits(1)(0), fetch_valid, local_pc_addr[2:2+depth_log - 1].bitcast(Int(depth_log)), Bits(32)(0))
-        return fetch_valid
\ No newline at end of file
+        # 半字地址 h 处的 32 位：低半字在 h，高半字在 h + 1，两个半字一定分属不同的 bank
+        word_idx = local_pc_addr[2:2+depth_log - 1].bitcast(UInt(depth_log))
+        odd_idx = word_idx
+        even_idx = word_idx + concat(Bits(depth_log - 1)(0), local_pc_addr[1:1]).bitcast(UInt(depth_log))
+        for bank, idx in zip(icache_banks, [even_idx, odd_idx]):
+            bank.build(Bits(1)(0), fetch_valid & ~uop_hit, idx.bitcast(Int(depth_log)), Bits(16)(0))
+        return fetch_valid
@@ -0,0 +1,88 @@
+from assassyn.frontend import *
+from instruction import *
+
+# 译码器里可以融合成一条操作的相邻指令对：
+#   lui rd, hi     + addi rd, rd, lo        -> addi rd, x0, (hi + lo)
+#   auipc rd, hi   + jalr rd, lo(rd)        -> 相对第二条指令 PC 的 jal rd
+#   slli rd, rs, s + add rd, rd, rt         -> shadd rd, rs, rt, s
+#   sltu rd, a, b  + bnez / beqz rd, off    -> bltu / bgeu a, b, off，同时把比较结果写回 rd
+# 融合后的操作沿用第二条指令的 PC、长度和分支预测，这样顺序执行的下一条 PC 和 BHT 的索引都不用变
+
+def raw_view(inst):
+    return {
+        'opcode': inst[0:6],
+        'rd': inst[7:11],
+        'func3': inst[12:14],
+        'rs1': inst[15:19],
+        'rs2': inst[20:24],
+        'func7': inst[25:31],
+    }
+
+def match(view, opcode, func3 = None, func7 = None):
+    eq = view['opcode'] == Bits(7)(opcode)
+    if func3 is not None:
+        eq = eq & (view['func3'] == Bits(3)(func3))
+    if func7 is not None:
+        eq = eq & (view['func7'] == Bits(7)(func7))
+    return eq
+
+def fusion_head(inst):
+    # 可能作为融合对第一条的指令，译码器要先把它留一个周期，等下一条来了再决定
+    view = raw_view(inst)
+    return match(view, 0b0110111) | match(view, 0b0010111) | \
+           match(view, 0b0010011, 0b001, 0b0000000) | match(view, 0b0110011, 0b011, 0b0000000)
+
+def fuse_pair(first_inst, first, second_inst, second):
+    f = raw_view(first_inst)
+    s = raw_view(second_inst)
+    rd = f['rd']
+    rd_nonzero = rd != Bits(5)(0)
+
+    lui_addi = match(f, 0b0110111) & match(s, 0b0010011, 0b000) & \
+               (s['rd'] == rd) & (s['rs1'] == rd) & rd_nonzero
+    auipc_jalr = match(f, 0b0010111) & match(s, 0b1100111, 0b000) & \
+                 (s['rd'] == rd) & (s['rs1'] == rd) & rd_nonzero
+    add_uses_rd = (s['rs1'] == rd) ^ (s['rs2'] == rd)
+    slli_add = match(f, 0b0010011, 0b001, 0b0000000) & match(s, 0b0110011, 0b000, 0b0000000) & \
+               (s['rd'] == rd) & add_uses_rd & rd_nonzero
+    is_beqz = match(s, 0b1100011, 0b000)
+    is_bnez = match(s, 0b1100011, 0b001)
+    cmp_branch = match(f, 0b0110011, 0b011, 0b0000000) & (is_beqz | is_bnez) & \
+                 (s['rs1'] == rd) & (s['rs2'] == Bits(5)(0)) & rd_nonzero
+
+    kinds = {
+        'lui_addi': lui_addi,
+        'auipc_jalr': auipc_jalr,
+        'slli_add': slli_add,
+        'cmp_branch': cmp_branch,
+    }
+
+    imm_sum = (first['imm'].bitcast(Int(32)) + second['imm'].bitcast(Int(32))).bitcast(Bits(32))
+    first_len = first['is_compressed'].select(Int(32)(2), Int(32)(4))
+    # jal 的目标按第二条指令的 PC 计算，要减去第一条指令的长度
+    call_offset = (imm_sum.bitcast(Int(32)) - first_len).bitcast(Bits(32))
+    other = (s['rs1'] == rd).select(second['rs2'], second['rs1'])
+
+    fused = dict(second)
+    fused['imm'] = lui_addi.select(imm_sum, fused['imm'])
+    fused['imm'] = auipc_jalr.select(call_offset, fused['imm'])
+    fused['imm'] = slli_add.select(first['imm'], fused['imm'])
+    fused['imm_valid'] = slli_add.select(Bits(1)(1), fused['imm_valid'])
+    fused['rs1'] = (lui_addi | auipc_jalr).select(Bits(5)(0), fused['rs1'])
+    fused['rs1'] = (slli_add | cmp_branch).select(first['rs1'], fused['rs1'])
+    fused['rs1_valid'] = auipc_jalr.select(Bits(1)(0), fused['rs1_valid'])
+    fused['rs2'] = slli_add.select(other, fused['rs2'])
+    fused['rs2'] = cmp_branch.select(first['rs2'], fused['rs2'])
+    fused['is_jalr'] = auipc_jalr.select(Bits(1)(0), fused['is_jalr'])
+    fused['is_offset_br'] = auipc_jalr.select(Bits(1)(1), fused['is_offset_br'])
+    fused['alu'] = slli_add.select(Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_SHADD), fused['alu'])
+    fused['rd'] = cmp_branch.select(rd, fused['rd'])
+    fused['rd_valid'] = cmp_branch.select(Bits(1)(1), fused['rd_valid'])
+    fused['is_reg_write'] = cmp_branch.select(Bits(1)(1), fused['is_reg_write'])
+    fused['cond'] = cmp_branch.select(Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_CMP_LTU), fused['cond'])
+    fused['flip'] = cmp_branch.select(is_beqz, fused['flip'])
+    fused['cmp_to_rd'] = cmp_branch
+    fused['is_hammock'] = cmp_branch.select(Bits(1)(0), fused['is_hammock'])
+
+    can_fuse = lui_addi | auipc_jalr | slli_add | cmp_branch
+    return can_fuse, kinds, fused
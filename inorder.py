@@ -0,0 +1,386 @@
+from assassyn.frontend import *
+from instruction import *
+from alu import *
+from mul_alu import *
+from div_alu import *
+from lsq import DCACHE_BANKS
+from dram import *
+from utils import *
+from perf import *
+from csr import *
+
+IQ_SIZE = 8     # 译码器送来的指令先进这个队列，队列里的位置要能装下反压生效之前还在路上的指令
+TAGS = 8        # 在执行单元里飞着的指令用 3 位的编号区分，和乱序核的 ROB 下标一样宽
+
+# 队列里每一项要存下来的译码信号
+IQ_FIELDS = [
+    'rs1', 'rs1_valid', 'rs2', 'rs2_valid', 'rd', 'rd_valid', 'imm', 'imm_valid', 'memory', 'alu', 'cond', 'flip',
+    'is_branch', 'link_pc', 'is_jalr', 'mem_ext', 'is_load_or_store', 'memory_length', 'get_high_bit',
+    'rs1_sign', 'rs2_sign', 'is_rem', 'div_signed', 'is_compressed', 'cmp_to_rd', 'csr_calculate',
+    'is_vector', 'is_lr', 'is_sc', 'is_amo',
+]
+
+class InOrderCore(Module):
+    # 对照用的顺序核：取指和译码沿用乱序核的 Fetcher / Decoder，端口和 ROB 一样，译码器不用改
+    # 译码器送来的指令进一个 IQ_SIZE 项的队列，按程序顺序从队列头一条一条发射（读寄存器、旁路）到
+    # ALU / MUL_ALU / DIV_ALU / dcache；记分牌（pending）记着哪些寄存器的新值还在执行单元里，
+    # 操作数没好或者 rd 还有没写回的旧值时停在队列头。执行单元延迟不同，写回是乱序的
+    # 执行单元写回的结果同一个周期直接旁路给发射级，不用等写进寄存器堆
+    # 分支在 ALU 里算出结果之前不再发射后面的指令，所以执行单元里不会有错误路径上的指令
+    # 不支持向量和原子指令，走到队列头时打印出来并停止模拟；也不做谓词化：hammock 分支跳转时按预测错误处理
+
+    def __init__(self):
+        super().__init__(ports = {
+            "receive": Port(Bits(1)),
+            "signals": Port(decoder_signals),
+            "addr": Port(Bits(32)),
+            "predicted_taken": Port(Bits(1)),
+            "pred_next_pc": Port(Bits(32)),
+            "tid": Port(Bits(1))
+        }, no_arbiter = True)
+        self.name = "IO"
+
+    @module.combinational
+    def build(
+        self,
+        alu: ALU,
+        mul_alu: MUL_ALU,
+        div_alu: DIV_ALU,
+        rob_index_array_from_alu: Array,
+        result_array_from_alu: Array,
+        pc_result_array_from_alu: Array,
+        signal_array_from_alu: Array,
+        rob_index_array_from_mul_alu: Array,
+        result_array_from_mul_alu: Array,
+        signal_array_from_mul_alu: Array,
+        rob_index_array_from_div_alu: Array,
+        result_array_from_div_alu: Array,
+        signal_array_from_div_alu: Array,
+        div_busy_array: Array,
+        dcache_banks: list,
+        depth_log: int,
+        rob_full_array: Array,
+        clear_signal_array: Array,
+        reset_pc_addr_array: Array,
+        bht_array: Array,
+        btb_target_array: Array,
+        bht_log_size: int,
+        conf_array: Array,
+        commit_valid_array: Array,
+        commit_addr_array: Array,
+        dram: bool,
+        perf: PerfCounters
+    ):
+        receive, signals, addr, predicted_taken, pred_next_pc, tid = self.pop_all_ports(True)
+
+        rf = [RegArray(Bits(32), 1) for _ in range(32)]
+        pending = [RegArray(Bits(1), 1) for _ in range(32)]     # 这个寄存器的新值还在执行单元里
+        pending_tag = RegArray(Bits(3), 32)                     # 算这个新值的指令的编号
+        inflight = [RegArray(Bits(1), 1) for _ in range(TAGS)]  # 这个编号的指令还没写回
+        tag_rd = RegArray(Bits(5), TAGS)
+        tag_writes = RegArray(Bits(1), TAGS)
+        next_tag = RegArray(Bits(3), 1)
+
+        head = RegArray(Int(32), 1, initializer = [0])
+        tail = RegArray(Int(32), 1, initializer = [0])
+        count = RegArray(Int(32), 1, initializer = [0])
+        iq = {k: RegArray(getattr(signals, k).dtype, IQ_SIZE) for k in IQ_FIELDS}
+        iq_addr = RegArray(Bits(32), IQ_SIZE)
+        iq_next_pc = RegArray(Bits(32), IQ_SIZE)
+
+        # 在等 ALU 算出结果的分支
+        branch_pending = RegArray(Bits(1), 1)
+        branch_tag = RegArray(Bits(3), 1)
+        branch_addr = RegArray(Bits(32), 1)
+        branch_next_pc = RegArray(Bits(32), 1)
+        branch_seq_pc = RegArray(Bits(32), 1)
+
+        # 上个周期发出去的 load，这个周期从 dcache 的输出上取值写回
+        load_valid = RegArray(Bits(1), 1)
+        load_tag = RegArray(Bits(3), 1)
+        load_bank = RegArray(Bits(1), 1)
+        load_place = RegArray(Bits(2), 1)
+        load_length = RegArray(Bits(2), 1)
+        load_signed = RegArray(Bits(1), 1)
+
+        csrs = CSRCounters()
+
+        clear = clear_signal_array[0]
+
+        # 写回：四个来源在同一个周期最多各写回一条，写的一定是不同的寄存器
+        douts = [[lane.dout for lane in lanes] for lanes in dcache_banks]
+        load_value = load_bus_value(douts, load_bank[0], load_place[0], load_length[0], load_signed[0])
+        wbs = [
+            (signal_array_from_alu[0], rob_index_array_from_alu[0], result_array_from_alu[0]),
+            (signal_array_from_mul_alu[0], rob_index_array_from_mul_alu[0], result_array_from_mul_alu[0]),
+            (signal_array_from_div_alu[0], rob_index_array_from_div_alu[0], result_array_from_div_alu[0]),
+            (load_valid[0], load_tag[0], load_value),
+        ]
+        for wb_valid, wb_tag, wb_value in wbs:
+            wb_rd = tag_rd[wb_tag]
+            wb_write = wb_valid & tag_writes[wb_tag] & (wb_rd != Bits(5)(0))
+            with Condition(wb_write):
+                write1hot(rf, wb_rd, wb_value)
+            with Condition(wb_write & (pending_tag[wb_rd] == wb_tag)):
+                write1hot(pending, wb_rd, Bits(1)(0))
+            with Condition(wb_valid):
+                write1hot(inflight, wb_tag, Bits(1)(0), width = 3)
+
+        def operand(reg, used):
+            # 寄存器的新值还没写回时，看这个周期有没有执行单元正好把它写回来，有的话直接旁路
+            is_pending = read_mux(pending, reg, 32, 1)
+            tag = pending_tag[reg]
+            hit = Bits(1)(0)
+            value = read_mux(rf, reg, 32, 32)
+            for wb_valid, wb_tag, wb_value in wbs:
+                match = is_pending & wb_valid & (wb_tag == tag)
+                hit = hit | match
+                value = match.select(wb_value, value)
+            zero = reg == Bits(5)(0)
+            ready = ~used | zero | ~is_pending | hit
+            return ready, zero.select(Bits(32)(0), value)
+
+        # 分支在 ALU 里的结果回来了：和取指时预测的下一条 PC 不一样就清空前端和队列
+        resolve = branch_pending[0] & signal_array_from_alu[0] & (rob_index_array_from_alu[0] == branch_tag[0])
+        branch_target = pc_result_array_from_alu[0]
+        branch_wrong = resolve & (branch_target != branch_next_pc[0])
+        actual_taken = branch_target != branch_seq_pc[0]
+
+        # 队列头的指令
+        head_idx = head[0].bitcast(Bits(32))[0:2]
+        e = {k: reg[head_idx] for k, reg in iq.items()}
+        e_addr = iq_addr[head_idx]
+        e_next_pc = iq_next_pc[head_idx]
+        rs1_ready, a = operand(e['rs1'], e['rs1_valid'])
+        rs2_ready, b = operand(e['rs2'], e['rs2_valid'])
+        rd_busy = e['rd_valid'] & (e['rd'] != Bits(5)(0)) & read_mux(pending, e['rd'], 32, 1)
+
+        is_mul = e['alu'] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_MUL)
+        is_div = e['alu'] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_DIV)
+        is_final = e['alu'] == Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE)
+        is_load = e['is_load_or_store'] & e['memory'][0:0]
+        is_store = e['is_load_or_store'] & e['memory'][1:1]
+        is_csr = e['csr_calculate']         # csrrs 在发射时直接读计数器写进寄存器堆，不经过执行单元
+        is_alu = ~e['is_load_or_store'] & ~is_mul & ~is_div & ~is_final & ~is_csr
+
+        div_sent = RegArray(Bits(1), 1)     # 上个周期刚发出去一条除法，除法器的 busy 这个周期还看不到
+        div_free = ~div_busy_array[0] & ~div_sent[0]
+
+        nothing_inflight = Bits(1)(1)
+        for t in range(TAGS):
+            nothing_inflight = nothing_inflight & ~inflight[t][0]
+
+        has_entry = count[0] > Int(32)(0)
+        branch_blocked = branch_pending[0] & ~(resolve & ~branch_wrong)
+        tag = next_tag[0]
+        tag_free = ~read_mux(inflight, tag, TAGS, 1)
+        operands_ready = rs1_ready & rs2_ready & ~rd_busy
+        unit_ready = ~is_div | div_free
+        unsupported = e['is_vector'] | e['is_lr'] | e['is_sc'] | e['is_amo']
+        issue_ready = has_entry & ~clear & ~branch_blocked & tag_free & operands_ready & unit_ready & ~is_final & ~unsupported
+
+        # 接了 DRAM 时序模型时，访存指令要等 DRAM 放行才能发射
+        mem_addr = (a.bitcast(Int(32)) + e['imm'].bitcast(Int(32))).bitcast(Bits(32))
+        mem_ready = Bits(1)(1)
+        if dram:
+            dram_timing = DRAMTiming(1)
+            mem_ready = ~e['is_load_or_store'] | dram_timing.request(issue_ready & e['is_load_or_store'], mem_addr)
+            dram_timing.update(perf)
+        can_issue = issue_ready & mem_ready
+
+        # 不是分支的指令，取指时却按跳转预测了（BTB 别名），发射时就能发现，直接从顺序的下一条重新取指
+        inst_len = e['is_compressed'].select(Int(32)(2), Int(32)(4))
+        seq_pc = (e_addr.bitcast(Int(32)) + inst_len).bitcast(Bits(32))
+        straight_wrong = can_issue & ~e['is_branch'] & (e_next_pc != seq_pc)
+
+        issue_alu = can_issue & is_alu
+        issue_mul = can_issue & is_mul
+        issue_div = can_issue & is_div
+        issue_load = can_issue & is_load
+        issue_store = can_issue & is_store
+        writes_rd = e['rd_valid'] & (e['rd'] != Bits(5)(0)) & ~is_store & ~is_csr
+
+        with Condition(can_issue):
+            write1hot(inflight, tag, ~is_store & ~is_csr, width = 3)
+            tag_rd[tag] = e['rd']
+            tag_writes[tag] = writes_rd
+            next_tag[0] = (tag.bitcast(UInt(3)) + UInt(3)(1)).bitcast(Bits(3))
+        with Condition(can_issue & writes_rd):
+            write1hot(pending, e['rd'], Bits(1)(1))
+            pending_tag[e['rd']] = tag
+        # rd 没有在等写回，这个周期也就不会有执行单元写它
+        with Condition(can_issue & is_csr & e['rd_valid'] & (e['rd'] != Bits(5)(0))):
+            write1hot(rf, e['rd'], csrs.read(e['imm'][0:11]))
+        with Condition(can_issue & e['is_branch']):
+            branch_tag[0] = tag
+            branch_addr[0] = e_addr
+            branch_next_pc[0] = e_next_pc
+            branch_seq_pc[0] = seq_pc
+        branch_pending[0] = (can_issue & e['is_branch']) | (branch_pending[0] & ~resolve)
+        div_sent[0] = issue_div
+
+        alu_a = e['is_branch'].select(e_addr, a)
+        alu_b = e['imm_valid'].select(e['imm'], b)
+        alu.async_called(
+            valid = issue_alu,
+            rob_index = tag,
+            a = a,
+            b = b,
+            alu_a = alu_a,
+            alu_b = alu_b,
+            link_pc = e['link_pc'],
+            is_jalr = e['is_jalr'],
+            cond = issue_alu.select(e['cond'], Bits(RV32I_ALU.CNT)(1)),
+            flip = e['flip'],
+            is_branch = e['is_branch'],
+            calc_type = issue_alu.select(e['alu'], Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE)),
+            pc_addr = e_addr,
+            is_compressed = e['is_compressed'],
+            cmp_to_rd = e['cmp_to_rd']
+        )
+        # 执行单元里的指令都比还没解决的分支老，清空的时候不用作废它们
+        mul_alu.async_called(
+            valid = issue_mul,
+            rob_index = tag,
+            alu_a = a,
+            alu_b = b,
+            calc_type = issue_mul.select(e['alu'], Bits(RV32I_ALU.CNT)(1 << RV32I_ALU.ALU_NONE)),
+            pc_addr = e_addr,
+            get_high_bit = e['get_high_bit'],
+            rs1_sign = e['rs1_sign'],
+            rs2_sign = e['rs2_sign'],
+            clear = Bits(1)(0),
+        )
+        div_alu.async_called(
+            valid = issue_div,
+            rob_index = tag,
+            alu_a = a,
+            alu_b = b,
+            pc_addr = e_addr,
+            is_rem = e['is_rem'],
+            div_signed = e['div_signed'],
+        )
+
+        # dcache 和 LSQ 的布局一样：按字地址最低位分成两个 bank，每个 bank 是 4 个字节宽的 SRAM
+        mem_bank = mem_addr[2:2]
+        mem_word = mem_addr[3:3+depth_log-2].bitcast(UInt(depth_log-1))
+        mem_place = mem_addr[0:1]
+        mem_length = e['memory_length']
+        store_mask = Bits(4)(0b1111)
+        store_mask = (mem_length == Bits(2)(0)).select(Bits(4)(0b0001) << mem_place, store_mask)
+        store_mask = (mem_length == Bits(2)(1)).select(Bits(4)(0b0011) << mem_place, store_mask)
+        store_lanes = b << concat(mem_place, Bits(3)(0))
+        for i, lanes in enumerate(dcache_banks):
+            in_bank = mem_bank == Bits(1)(i)
+            bank_mask = (issue_store & in_bank).select(store_mask, Bits(4)(0))
+            for j, lane in enumerate(lanes):
+                lane.build(we = bank_mask[j:j], re = issue_load & in_bank, addr = mem_word, wdata = store_lanes[8*j:8*j+7])
+
+        load_valid[0] = issue_load
+        with Condition(issue_load):
+            load_tag[0] = tag
+            load_bank[0] = mem_bank
+            load_place[0] = mem_place
+            load_length[0] = mem_length
+            load_signed[0] = e['mem_ext'][0:0]
+
+        # 分支预测器在分支的结果回来时训练，和乱序核在提交时训练一样
+        bht_idx = branch_addr[0][1 : bht_log_size].bitcast(Bits(6))
+        with Condition(resolve):
+            old_state = bht_array[bht_idx]
+            state_uint = old_state.bitcast(UInt(2))
+            plus_one = (old_state == Bits(2)(3)).select(Bits(2)(3), (state_uint + UInt(2)(1)).bitcast(Bits(2)))
+            minus_one = (old_state == Bits(2)(0)).select(Bits(2)(0), (state_uint - UInt(2)(1)).bitcast(Bits(2)))
+            bht_array[bht_idx] = actual_taken.select(plus_one, minus_one)
+
+            old_conf = conf_array[bht_idx]
+            conf_bits = old_conf.dtype.bits
+            conf_max = old_conf == Bits(conf_bits)((1 << conf_bits) - 1)
+            conf_plus = conf_max.select(old_conf, (old_conf.bitcast(UInt(conf_bits)) + UInt(conf_bits)(1)).bitcast(Bits(conf_bits)))
+            conf_array[bht_idx] = branch_wrong.select(Bits(conf_bits)(0), conf_plus)
+
+            with Condition(actual_taken):
+                btb_target_array[bht_idx] = branch_target
+
+        # 取指门控放行的依据：分支在有结果时报告，其它指令在发射时报告。
+        # 门控的 PC 可能是和低置信度表项重名的非分支指令，只报告分支的话它永远放不开；
+        # 同一周期既有分支出结果又有非分支发射时报告发射的那条：门控停在分支上时取指已经停了，
+        # 不可能有比它更年轻的指令在发射
+        report_issue = can_issue & ~e['is_branch']
+        commit_valid_array[0] = (report_issue | resolve).select(Bits(1)(1), Bits(1)(0))
+        commit_addr_array[0] = report_issue.select(e_addr, branch_addr[0])
+
+        flush = branch_wrong | straight_wrong
+        with Condition(flush):
+            reset_pc_addr_array[0] = branch_wrong.select(branch_target, seq_pc)
+        clear_signal_array[0] = flush.select(Bits(1)(1), Bits(1)(0))
+
+        # 入队：清空的那个周期和下一个周期到的都是错误路径上的指令
+        enqueue = receive & ~clear & ~flush & (count[0] < Int(32)(IQ_SIZE))
+        tail_idx = tail[0].bitcast(Bits(32))[0:2]
+        with Condition(enqueue):
+            for k, reg in iq.items():
+                reg[tail_idx] = getattr(signals, k)
+            iq_addr[tail_idx] = addr
+            iq_next_pc[tail_idx] = pred_next_pc
+
+        def advance(ptr):
+            nxt = ptr + Int(32)(1)
+            return (nxt == Int(32)(IQ_SIZE)).select(Int(32)(0), nxt)
+
+        new_count = count[0] + enqueue.select(Int(32)(1), Int(32)(0)) - can_issue.select(Int(32)(1), Int(32)(0))
+        head[0] = flush.select(Int(32)(0), can_issue.select(advance(head[0]), head[0]))
+        tail[0] = flush.select(Int(32)(0), enqueue.select(advance(tail[0]), tail[0]))
+        count[0] = flush.select(Int(32)(0), new_count)
+        rob_full_array[0] = new_count >= Int(32)(IQ_SIZE // 2)
+
+        with Condition(can_issue):
+            log("IO issued, addr: 0x{:08x}", e_addr)
+        log("register value {}: 0x{:08x}", Bits(5)(10), rf[10][0])
+
+        # 顺序核没有推测执行，发射出去的指令都会提交
+        csrs.tick(can_issue.select(UInt(64)(1), UInt(64)(0)), {
+            'branch_mispredicts': branch_wrong,
+            'lsq_stall_cycles': issue_ready & ~mem_ready,
+            'loads': issue_load,
+            'stores': issue_store,
+        })
+
+        perf.incr("cycles", Bits(1)(1))
+        # top-down 的分类和 ROB 一样，只是按队列头的指令能不能发射来算
+        refilling = RegArray(Bits(1), 1)
+        refilling[0] = flush | (refilling[0] & ~enqueue)
+        recovering = ~can_issue & (flush | clear)
+        waiting = ~can_issue & ~recovering & has_entry
+        perf.incr("topdown_retiring", can_issue)
+        perf.incr("topdown_bad_speculation", recovering)
+        perf.incr("topdown_frontend_refill", ~can_issue & ~recovering & ~has_entry & refilling[0])
+        perf.incr("topdown_frontend_fetch", ~can_issue & ~recovering & ~has_entry & ~refilling[0])
+        perf.incr("topdown_backend_memory", waiting & e['is_load_or_store'])
+        perf.incr("topdown_backend_core", waiting & ~e['is_load_or_store'])
+        perf.incr("inorder_insts", can_issue)
+        perf.incr("inorder_branches", can_issue & e['is_branch'])
+        perf.incr("inorder_loads", issue_load)
+        perf.incr("inorder_stores", issue_store)
+        perf.incr("inorder_mispredictions", flush)
+        perf.incr("inorder_empty_cycles", ~has_entry & ~clear)
+        perf.incr("inorder_branch_stall_cycles", has_entry & ~clear & branch_blocked)
+        perf.incr("inorder_raw_stall_cycles", has_entry & ~clear & ~branch_blocked & ~(rs1_ready & rs2_ready))
+        perf.incr("inorder_waw_stall_cycles", has_entry & ~clear & ~branch_blocked & rs1_ready & rs2_ready & rd_busy)
+        perf.incr("inorder_div_stall_cycles", has_entry & ~clear & ~branch_blocked & operands_ready & ~unit_ready)
+        perf.incr("inorder_mem_stall_cycles", issue_ready & ~mem_ready)
+        rs1_forwarded = e['rs1_valid'] & read_mux(pending, e['rs1'], 32, 1)
+        rs2_forwarded = e['rs2_valid'] & read_mux(pending, e['rs2'], 32, 1)
+        perf.incr("inorder_forwarded_operands", can_issue & (rs1_forwarded | rs2_forwarded))
+
+        # 向量和原子指令到了队列头，并且前面的分支都已经算出来（它一定在正确的路径上），停下来报错
+        with Condition(has_entry & ~clear & unsupported & ~branch_pending[0]):
+            log("unsupported vector / atomic instruction on the in-order core | addr: 0x{:08x}", e_addr)
+            finish()
+
+        # ebreak 到了队列头，并且前面的指令都写回了，模拟结束
+        halt = has_entry & ~clear & is_final & nothing_inflight & ~branch_pending[0]
+        with Condition(halt):
+            log("ebreak | hart: {} | addr: 0x{:08x}", Bits(32)(0), e_addr)
+            perf.dump()
+            finish()
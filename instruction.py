@@ -193,7 +193,7 @@ class BInstruction(Instruction):
         return InstSignal(eq, RV32I_ALU.ALU_ADD, cond = (cmp, flip))
 
 class RV32I_ALU:
-    CNT = 16
+    CNT = 32
 
     ALU_ADD = 0
     ALU_SUB = 1
@@ -211,6 +211,20 @@ class RV32I_ALU:
     ALU_TRUE = 11
     ALU_NONE = 15
     ALU_MUL = 14
+    ALU_DIV = 16
+    ALU_SHADD = 17  # (rs1 << imm) + rs2：融合的 slli + add，以及 sh1add / sh2add / sh3add
+    ALU_ANDN = 18
+    ALU_ORN = 19
+    ALU_CLZ = 20
+    ALU_CTZ = 21
+    ALU_CPOP = 22
+    ALU_MIN = 23
+    ALU_MINU = 24
+    ALU_MAX = 25
+    ALU_MAXU = 26
+    ALU_ROL = 27
+    ALU_ROR = 28
+    ALU_VEC = 29    # 向量运算，由 VEC_ALU 执行，具体的操作看 vec_op
 
 supported_opcodes = [
     ("jal", (0b1101111, RV32I_ALU.ALU_ADD, (RV32I_ALU.ALU_TRUE, False)), JInstruction),
@@ -224,6 +238,10 @@ supported_opcodes = [
     ("mulh", (0b0110011, 0b001, 0b0000001, RV32I_ALU.ALU_MUL), RInstruction),
     ("mulhu", (0b0110011, 0b011, 0b0000001, RV32I_ALU.ALU_MUL), RInstruction),
     ("mulhsu", (0b0110011, 0b010, 0b0000001, RV32I_ALU.ALU_MUL), RInstruction),
+    ("div", (0b0110011, 0b100, 0b0000001, RV32I_ALU.ALU_DIV), RInstruction),
+    ("divu", (0b0110011, 0b101, 0b0000001, RV32I_ALU.ALU_DIV), RInstruction),
+    ("rem", (0b0110011, 0b110, 0b0000001, RV32I_ALU.ALU_DIV), RInstruction),
+    ("remu", (0b0110011, 0b111, 0b0000001, RV32I_ALU.ALU_DIV), RInstruction),
 
     ("jalr", (0b1100111, 0b000, RV32I_ALU.ALU_ADD, (RV32I_ALU.ALU_TRUE, False), None, None), IInstruction),
     ("addi", (0b0010011, 0b000, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
@@ -231,11 +249,15 @@ supported_opcodes = [
     # Permenantly stop here to comprehend the total structure in a rapid way
     ('lw'    , (0b0000011, 0b010, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
     ('lbu'   , (0b0000011, 0b100, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
+    ('lb'    , (0b0000011, 0b000, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
+    ('lh'    , (0b0000011, 0b001, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
+    ('lhu'   , (0b0000011, 0b101, RV32I_ALU.ALU_ADD, None, None, None), IInstruction),
 
     ('ebreak', (0b1110011, 0b000, RV32I_ALU.ALU_NONE, None,0b000000000001,None), IInstruction),
 
     ('sw'    , (0b0100011, 0b010, RV32I_ALU.ALU_ADD), SInstruction),
-    # ('sb'    , (0b0100011, 0b000, RV32I_ALU.ALU_ADD), SInstruction),
+    ('sb'    , (0b0100011, 0b000, RV32I_ALU.ALU_ADD), SInstruction),
+    ('sh'    , (0b0100011, 0b001, RV32I_ALU.ALU_ADD), SInstruction),
 
     # mn,       opcode,    funct3,cmp,                  flip
     ('beq'   , (0b1100011, 0b000, RV32I_ALU.ALU_CMP_EQ,  False), BInstruction),
@@ -269,6 +291,37 @@ supported_opcodes = [
     ('andi' , (0b0010011, 0b111, RV32I_ALU.ALU_AND, None,None,None), IInstruction),
     ('ori' , (0b0010011, 0b110, RV32I_ALU.ALU_ORI, None,None,None), IInstruction),
     ('xori' , (0b0010011, 0b100, RV32I_ALU.ALU_XOR, None,None,None), IInstruction),
+
+    # Zba
+    ('sh1add', (0b0110011, 0b010, 0b0010000, RV32I_ALU.ALU_SHADD), RInstruction),
+    ('sh2add', (0b0110011, 0b100, 0b0010000, RV32I_ALU.ALU_SHADD), RInstruction),
+    ('sh3add', (0b0110011, 0b110, 0b0010000, RV32I_ALU.ALU_SHADD), RInstruction),
+
+    # Zbb
+    ('andn' , (0b0110011, 0b111, 0b0100000, RV32I_ALU.ALU_ANDN), RInstruction),
+    ('orn'  , (0b0110011, 0b110, 0b0100000, RV32I_ALU.ALU_ORN), RInstruction),
+    ('clz'  , (0b0010011, 0b001, RV32I_ALU.ALU_CLZ, None, 0b011000000000, None), IInstruction),
+    ('ctz'  , (0b0010011, 0b001, RV32I_ALU.ALU_CTZ, None, 0b011000000001, None), IInstruction),
+    ('cpop' , (0b0010011, 0b001, RV32I_ALU.ALU_CPOP, None, 0b011000000010, None), IInstruction),
+    ('min'  , (0b0110011, 0b100, 0b0000101, RV32I_ALU.ALU_MIN), RInstruction),
+    ('minu' , (0b0110011, 0b101, 0b0000101, RV32I_ALU.ALU_MINU), RInstruction),
+    ('max'  , (0b0110011, 0b110, 0b0000101, RV32I_ALU.ALU_MAX), RInstruction),
+    ('maxu' , (0b0110011, 0b111, 0b0000101, RV32I_ALU.ALU_MAXU), RInstruction),
+    ('rol'  , (0b0110011, 0b001, 0b0110000, RV32I_ALU.ALU_ROL), RInstruction),
+    ('ror'  , (0b0110011, 0b101, 0b0110000, RV32I_ALU.ALU_ROR), RInstruction),
+    ('rori' , (0b0010011, 0b101, RV32I_ALU.ALU_ROR, None, None, 0b011000), IInstruction),
+
+    # 向量扩展（custom-0），func3 就是 vec_op，见 vec_alu.py
+    ('vle32'  , (0b0001011, 0b000, 0b0000000, RV32I_ALU.ALU_ADD), RInstruction),
+    ('vse32'  , (0b0001011, 0b001, 0b0000000, RV32I_ALU.ALU_ADD), RInstruction),
+    ('vadd'   , (0b0001011, 0b010, 0b0000000, RV32I_ALU.ALU_VEC), RInstruction),
+    ('vmul'   , (0b0001011, 0b011, 0b0000000, RV32I_ALU.ALU_VEC), RInstruction),
+    ('vredsum', (0b0001011, 0b100, 0b0000000, RV32I_ALU.ALU_VEC), RInstruction),
+
+    # A 扩展里用来做多核同步的几条，aq / rl 位都要是 0
+    ('lr.w'    , (0b0101111, 0b010, 0b0001000, RV32I_ALU.ALU_ADD, 0b00000), RInstruction),
+    ('sc.w'    , (0b0101111, 0b010, 0b0001100, RV32I_ALU.ALU_ADD), RInstruction),
+    ('amoadd.w', (0b0101111, 0b010, 0b0000000, RV32I_ALU.ALU_ADD), RInstruction),
 ]
     
 decoder_signals = Record(
@@ -293,7 +346,7 @@ decoder_signals = Record(
     is_branch = Bits(1),
     is_offset_br = Bits(1),
     link_pc = Bits(1),
-    mem_ext = Bits(2),
+    mem_ext = Bits(2), # 第 0 位表示 load 结果需要符号扩展（lb / lh）
     is_memory_write = Bits(1),
     is_reg_write = Bits(1),
     is_load_or_store = Bits(1),
@@ -302,7 +355,22 @@ decoder_signals = Record(
     is_mult = Bits(1),
     get_high_bit = Bits(1), # 乘法指令中，是否获取高 32 位
     rs1_sign = Bits(1), # 记录 rs1 到底是有符号还是无符号，乘法的时候有用
-    rs2_sign = Bits(1)  # 记录 rs2 到底是有符号还是无符号，乘法的时候有用
+    rs2_sign = Bits(1),  # 记录 rs2 到底是有符号还是无符号，乘法的时候有用
+    is_div = Bits(1),
+    is_rem = Bits(1),   # 除法指令中，是否取余数
+    div_signed = Bits(1),
+    is_compressed = Bits(1), # 是否由 16 位的压缩指令展开而来，决定顺序执行时 PC 加 2 还是加 4
+    cmp_to_rd = Bits(1),    # 融合的比较 + 分支指令：除了跳转，还要把比较结果写回 rd
+    is_vector = Bits(1),
+    vec_op = Bits(3),
+    vd = Bits(3),       # 向量寄存器号，取 rd / rs1 / rs2 字段的低 3 位
+    vs1 = Bits(3),
+    vs2 = Bits(3),
+    is_hammock = Bits(1),       # 短的向前条件分支，可以谓词化
+    is_predicated = Bits(1),    # 按顺序取了分支后面的指令，分支跳转时在提交阶段把它们作废，不算预测错误
+    is_lr = Bits(1),
+    is_sc = Bits(1),            # sc.w 往 rd 写 0 表示成功，1 表示失败
+    is_amo = Bits(1)            # amoadd.w 往 rd 写内存里原来的值
 )
 
 supported_types = [RInstruction, IInstruction, BInstruction, UInstruction, JInstruction, SInstruction]
\ No newline at end of file
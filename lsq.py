@@ -1,8 +1,73 @@
 from assassyn.frontend import *
 from instruction import *
 from utils import *
+from perf import *
+from vec_alu import VLANES
+from dram import *
 
-LSQ_SIZE = 8
+LOAD_QUEUE_SIZE = 8     # load 队列的条目数，vle32 也放在这里
+STORE_QUEUE_SIZE = 8    # store 队列的条目数，vse32 也放在这里
+LSQ_SKID = 3            # ROB 发出反压之后还可能到达 ROB 的指令数：ROB 端口上、译码器留着的、取指刚取回来的各一条
+DCACHE_BANKS = 2
+LOAD_HIT_LATENCY = 1   # dcache 命中时 load 数据返回的周期数，load 的返回信号和推测唤醒都按这个延迟送出
+AGU_WIDTH = 2      # 每个周期最多算出几条访存指令的地址（1 或 2），两个 AGU 分别服务 load 队列和 store 队列
+VEC_BEATS = VLANES // DCACHE_BANKS     # 一条向量访存要占用几个周期的 dcache，每个周期每个 bank 传一个字
+BUS_SLOT = 3            # 多核时每个核轮流占用总线的周期数：原子操作读内存、写自己的 L1、其他核照着更新 L1
+
+class SnoopPort:
+    # 多核时每个核的 L1 都是整个数据内存的一份拷贝，用写更新的监听协议保持一致：
+    # 一个核写自己 L1 的同时把写的内容放到总线上，下个周期其他核把同样的内容写进各自的 L1
+
+    def __init__(self, depth_log):
+        self.valid = [RegArray(Bits(1), 1) for _ in range(DCACHE_BANKS)]
+        self.word = [RegArray(UInt(depth_log - 1), 1) for _ in range(DCACHE_BANKS)]
+        self.mask = [RegArray(Bits(4), 1) for _ in range(DCACHE_BANKS)]
+        self.data = [RegArray(Bits(32), 1) for _ in range(DCACHE_BANKS)]
+
+class MemQueue:
+    # load 队列和 store 队列的条目格式相同，各自是一个按程序顺序分配、从头部执行的循环队列
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = max((size - 1).bit_length(), 1)
+        self.head = RegArray(Int(32), 1, initializer=[0])                       # 头指针
+        self.tail = RegArray(Int(32), 1, initializer=[0])                       # 尾指针
+        self.count = RegArray(Int(32), 1, initializer=[0])                      # 队列里目前的条数
+        self.allocated = [RegArray(Bits(1), 1) for _ in range(size)]            # 这一条有没有分配指令
+        self.rob_index = RegArray(Bits(3), size)                                # 对应的 ROB 条目的索引
+        self.rs1_value = [RegArray(Bits(32), 1) for _ in range(size)]           # 基址寄存器的值
+        self.has_rs1 = RegArray(Bits(1), size)
+        self.rs1_recorder = RegArray(Bits(3), size)
+        self.has_rs1_recorder = [RegArray(Bits(1), 1) for _ in range(size)]
+        self.rs2_value = [RegArray(Bits(32), 1) for _ in range(size)]           # store 要写的值
+        self.has_rs2 = RegArray(Bits(1), size)
+        self.rs2_recorder = RegArray(Bits(3), size)
+        self.has_rs2_recorder = [RegArray(Bits(1), 1) for _ in range(size)]
+        self.imm = RegArray(Bits(32), size)
+        self.mem_length = RegArray(Bits(2), size)                               # 访存长度
+        self.mem_signed = RegArray(Bits(1), size)                               # load 的结果是否需要符号扩展
+        self.addr = RegArray(Bits(32), size)                                    # 指令自己的 PC
+        self.ready = [RegArray(Bits(1), 1) for _ in range(size)]                # 源操作数是否都准备好
+        self.mem_addr = [RegArray(Bits(32), 1) for _ in range(size)]            # AGU 算出的访存地址
+        self.mem_addr_ready = [RegArray(Bits(1), 1) for _ in range(size)]       # 访存地址是否已经算好
+        self.is_vector = RegArray(Bits(1), size)                                # 是否为 vle32 / vse32
+        self.vs = RegArray(Bits(3), size)                                       # vse32 要写回内存的向量寄存器
+        self.older_stores = RegArray(Int(32), size)                             # load 分派时已经分派了多少条 store
+        self.is_lr = RegArray(Bits(1), size)
+        self.is_sc = RegArray(Bits(1), size)
+        self.is_amo = RegArray(Bits(1), size)
+        self.tid = RegArray(Bits(1), size)                                      # SMT 时属于哪个线程
+
+    def index(self, ptr):
+        return ptr.bitcast(Bits(32))[0:self.bits - 1]
+
+    def advance(self, ptr):
+        nxt = ptr + Int(32)(1)
+        return (nxt == Int(32)(self.size)).select(Int(32)(0), nxt)
+
+    def entry_valid(self, idx, clear):
+        return read_mux(self.allocated, idx, self.size, 1) & read_mux(self.ready, idx, self.size, 1) & \
+               read_mux(self.mem_addr_ready, idx, self.size, 1) & ~clear
 
 class LSQ(Module):
 
@@ -21,44 +86,58 @@ class LSQ(Module):
             "addr": Port(Bits(32)),
             "lsq_modify_rd": Port(Bits(5)),
             "lsq_recorder": Port(Bits(3)),
-            "lsq_modify_value": Port(Bits(32)),            "rob_head_index": Port(Bits(3)),        })
+            "lsq_modify_value": Port(Bits(32)),
+            "rob_head_index": Port(Bits(3)),
+            "rob_head_dead": Port(Bits(1)),            # head 不会提交（SMT 时它所在的线程已经清空），它的 store 不能写内存
+            "tid": Port(Bits(1)),
+        })
         self.name = "LSQ"
 
     @module.combinational
     def build(
         self, 
-        dcache: SRAM,
+        dcache_banks: list,
         depth_log: int,
         rob_index_array_ret: Array,
         pc_result_array: Array,
         signal_array: Array,
+        store_rob_index_array_ret: Array,
+        store_pc_result_array: Array,
+        store_signal_array: Array,
         clear_signal_array: Array,
         memory_place_array: Array,
+        load_bank_array: Array,
+        load_length_array: Array,
+        load_signed_array: Array,
+        load_wakeup_valid_array: Array,
+        load_wakeup_index_array: Array,
+        vrf: list,
+        vec_load_valid_array: Array,
+        vec_load_beat_array: Array,
+        vec_load_bank_array: Array,
+        vec_load_rob_index_array: Array,
+        load_credit_array: Array,
+        store_credit_array: Array,
+        hartid: int,
+        snoop_ports: list,
+        threads: int,
+        atomic_signal_array: Array,
+        atomic_rob_index_array: Array,
+        atomic_result_array: Array,
+        dram: bool,
+        perf: PerfCounters,
     ):
         # 这是一个顺序执行的用于处理 load/store 指令的模块
+        # load 和 store 分成两个队列，各自按程序顺序执行；load 记下它前面有多少条 store，等这些 store 都做完了才能访存
+        # SMT 时两个线程的 store 分开计数，load 只等自己线程的 store，另一个线程的数据在 dcache 的另一半，不会有冲突
 
-        head = RegArray(Int(32), 1, initializer=[0])          # 存储 LSQ 的头指针
-        tail = RegArray(Int(32), 1, initializer=[0])          # 存储 LSQ 的尾指针
-        lsq_size = RegArray(Int(32), 1)                       # 存储 LSQ 目前指令的条数
-        lsq_full = Bits(1)(0)                                 # 存储 LSQ 是否已满
-        allocated_array = [RegArray(Bits(1), 1) for _ in range(LSQ_SIZE)]         # LSQ 中这一条有没有分配指令
-
-        rob_index_array = RegArray(Bits(3), LSQ_SIZE)         # 存储对应的 ROB 条目的索引
-        is_load_array = RegArray(Bits(1), LSQ_SIZE)           # 是否为 load 指令
-        is_store_array = RegArray(Bits(1), LSQ_SIZE)          # 是否为 store 指令
-        rs1_array = RegArray(Bits(5), LSQ_SIZE)               # 存储 rs1 的编号
-        rs1_value_array = [RegArray(Bits(32), 1) for _ in range(LSQ_SIZE)]        # 存储 rs1 的值
-        has_rs1_array = RegArray(Bits(1), LSQ_SIZE)           # 存储指令中是否有 rs1
-        rs1_recorder_array = RegArray(Bits(3), LSQ_SIZE)      # 存储 rs1 的 recorder
-        has_rs1_recorder_array = [RegArray(Bits(1), 1) for _ in range(LSQ_SIZE)]  # 存储 rs1 是否有 recorder
-        rs2_array = RegArray(Bits(5), LSQ_SIZE)               # 存储 rs2 的编号
-        rs2_value_array = [RegArray(Bits(32), 1) for _ in range(LSQ_SIZE)]        # 存储 rs2 的值
-        has_rs2_array = RegArray(Bits(1), LSQ_SIZE)           # 存储指令中是否有 rs2
-        rs2_recorder_array = RegArray(Bits(3), LSQ_SIZE)      # 存储 rs2 的 recorder
-        has_rs2_recorder_array = [RegArray(Bits(1), 1) for _ in range(LSQ_SIZE)]   # 存储 rs2 是否有 recorder
-        imm_array = RegArray(Bits(32), LSQ_SIZE)              # 存储立即数 imm
-        addr_array = RegArray(Bits(32), LSQ_SIZE)             # 存储计算得到的地址
-        ready_array = [RegArray(Bits(1), 1) for _ in range(LSQ_SIZE)]             # 存储该条目是否准备好
+        lq = MemQueue(LOAD_QUEUE_SIZE)
+        sq = MemQueue(STORE_QUEUE_SIZE)
+        queues = [lq, sq]
+        # 每个线程到目前为止分派进 store 队列的条数、写进 dcache 的 store 条数
+        store_dispatched = [RegArray(Int(32), 1, initializer=[0]) for _ in range(threads)]
+        store_done = [RegArray(Int(32), 1, initializer=[0]) for _ in range(threads)]
+        vec_beat = RegArray(Int(32), 1, initializer=[0])            # head 上的向量访存已经做完了几拍
 
         (
             lsq_write,
@@ -75,7 +154,9 @@ class LSQ(Module):
             lsq_modify_rd,
             lsq_recorder,
             lsq_modify_value,
-            rob_head_index
+            rob_head_index,
+            rob_head_dead,
+            tid
         ) = self.pop_all_ports(True)
 
         rs1_coincidence = rs1_has_recorder & (rs1_recorder == lsq_recorder) & lsq_modify_recorder
@@ -90,111 +171,381 @@ class LSQ(Module):
         #    log("rob_index: {} | rs1_value: 0x{:08x} | rs1_recorder: {} | rs1_has_recorder: {} | rs2_value: 0x{:08x} | rs2_recorder: {} | rs2_has_recorder: {} | addr: 0x{:08x}",
         #        rob_index, rs1_value, rs1_recorder, rs1_has_recorder, rs2_value, rs2_recorder, rs2_has_recorder, addr)
 
+        clear = clear_signal_array[0]
+        lsq_write = lsq_write & (~clear)
+        lsq_modify_recorder = lsq_modify_recorder & (~clear)
 
-        lsq_write = lsq_write & (~clear_signal_array[0])
-        lsq_modify_recorder = lsq_modify_recorder & (~clear_signal_array[0])
+        # ROB 按两个队列各自的 credit 分派，队列满的时候不会再有访存指令送过来
+        q_writes = []
+        for q, want in zip(queues, [signals.memory[0:0], signals.memory[1:1]]):
+            q_write = lsq_write & want & (q.count[0] < Int(32)(q.size))
+            tail_idx = q.index(q.tail[0])
+            with Condition(q_write):
+                # log("LSQ entry {} allocated", q.tail[0])
+                write1hot(q.allocated, tail_idx, Bits(1)(1))
+                q.rob_index[tail_idx] = rob_index
+                q.imm[tail_idx] = signals.imm
+                q.mem_length[tail_idx] = signals.memory_length
+                q.mem_signed[tail_idx] = signals.mem_ext[0:0]
+                q.is_vector[tail_idx] = signals.is_vector
+                q.vs[tail_idx] = signals.vs2
+                q.older_stores[tail_idx] = by_thread(tid, [cnt[0] for cnt in store_dispatched])
+                q.is_lr[tail_idx] = signals.is_lr
+                q.is_sc[tail_idx] = signals.is_sc
+                q.is_amo[tail_idx] = signals.is_amo
+                q.tid[tail_idx] = tid
+                write1hot(q.rs1_value, tail_idx, rs1_value)
+                q.has_rs1[tail_idx] = signals.rs1_valid
+                q.rs1_recorder[tail_idx] = rs1_recorder
+                write1hot(q.has_rs1_recorder, tail_idx, rs1_has_recorder)
+                write1hot(q.rs2_value, tail_idx, rs2_value)
+                q.has_rs2[tail_idx] = signals.rs2_valid
+                q.rs2_recorder[tail_idx] = rs2_recorder
+                write1hot(q.has_rs2_recorder, tail_idx, rs2_has_recorder)
+                write1hot(q.ready, tail_idx, ~((signals.rs1_valid & rs1_has_recorder) | (signals.rs2_valid & rs2_has_recorder)))
+                write1hot(q.mem_addr_ready, tail_idx, Bits(1)(0))
+                q.addr[tail_idx] = addr
+                q.tail[0] = q.advance(q.tail[0])
+            q_writes.append(q_write)
+        lq_write, sq_write = q_writes
 
-        head_ptr = head[0]
-        tail_ptr = tail[0]
-        
-        head_idx = head_ptr.bitcast(Bits(32))[0:2]
-        tail_idx = tail_ptr.bitcast(Bits(32))[0:2]
-
-        updated_tail_ptr = tail_ptr + Int(32)(1)
-        updated_tail_ptr = (updated_tail_ptr == Int(32)(LSQ_SIZE)).select(Int(32)(0), updated_tail_ptr)
-        updated_lsq_size = lsq_size[0] + Int(32)(1)
-
-        lsq_full = (updated_lsq_size == Int(32)(LSQ_SIZE)).select(Bits(1)(1), Bits(1)(0))
-
-        write_valid = lsq_write & ~lsq_full
-        with Condition(lsq_write & ~lsq_full):
-            # log("LSQ entry {} allocated", tail_ptr)
-            write1hot(allocated_array, tail_idx, Bits(1)(1))
-            rob_index_array[tail_idx] = rob_index
-            is_load_array[tail_idx] = signals.memory[0:0]
-            is_store_array[tail_idx] = signals.memory[1:1]
-            imm_array[tail_idx] = signals.imm
-            rs1_array[tail_idx] = signals.rs1
-            write1hot(rs1_value_array, tail_idx, rs1_value, width = 3)
-            has_rs1_array[tail_idx] = signals.rs1_valid
-            rs1_recorder_array[tail_idx] = rs1_recorder
-            write1hot(has_rs1_recorder_array, tail_idx, rs1_has_recorder, width = 3)
-            rs2_array[tail_idx] = signals.rs2
-            write1hot(rs2_value_array, tail_idx, rs2_value, width = 3)
-            has_rs2_array[tail_idx] = signals.rs2_valid
-            rs2_recorder_array[tail_idx] = rs2_recorder
-            write1hot(has_rs2_recorder_array, tail_idx, rs2_has_recorder, width = 3)
-            
-            write1hot(ready_array, tail_idx, ~((signals.rs1_valid & rs1_has_recorder) | (signals.rs2_valid & rs2_has_recorder)), width = 3)
-            addr_array[tail_idx] = addr
-            tail[0] = updated_tail_ptr
+        # AGU: 只要基址寄存器准备好了就乱序地算出地址并存下来，不必等到条目走到队列头部
+        # 两个队列各挑一条还没有地址的条目；只有一个 AGU 时 load 队列优先
+        agu_picks = []
+        for q in queues:
+            pick_valid = Bits(1)(0)
+            pick_idx = Bits(q.bits)(0)
+            for i in reversed(range(q.size)):
+                base_ready = (~q.has_rs1[i]) | (~q.has_rs1_recorder[i][0])
+                want = q.allocated[i][0] & (~q.mem_addr_ready[i][0]) & base_ready
+                pick_valid = want.select(Bits(1)(1), pick_valid)
+                pick_idx = want.select(Bits(q.bits)(i), pick_idx)
+            agu_picks.append((q, pick_valid, pick_idx))
+        if AGU_WIDTH < 2:
+            agu_picks[1] = (sq, agu_picks[1][1] & ~agu_picks[0][1], agu_picks[1][2])
+
+        for n, (q, pick_valid, pick_idx) in enumerate(agu_picks):
+            agu_fire = pick_valid & (~clear)
+            agu_addr = (read_mux(q.rs1_value, pick_idx, q.size, 32).bitcast(Int(32)) + q.imm[pick_idx].bitcast(Int(32))).bitcast(Bits(32))
+            if threads > 1:
+                # SMT 时两个线程跑的是各自的程序，线程 1 的数据放在 dcache 的后一半，它的地址都加上半个 dcache 的偏移
+                thread_base = q.tid[pick_idx].select(Bits(32)(1 << (depth_log + 1)), Bits(32)(0))
+                agu_addr = (agu_addr.bitcast(Int(32)) + thread_base.bitcast(Int(32))).bitcast(Bits(32))
+            with Condition(agu_fire):
+                write1hot(q.mem_addr, pick_idx, agu_addr)
+                write1hot(q.mem_addr_ready, pick_idx, Bits(1)(1))
+            perf.incr(f"lsq_agu{n}_ops", agu_fire)
         
-        # 检查 head 指向的条目是否准备好执行
-        dcache_we = Bits(1)(0)
-        dcache_re = Bits(1)(0)
-        dcache_addr = Bits(depth_log)(0).bitcast(UInt(depth_log))
-        dcache_wdata = Bits(32)(0)
-
-        alu_a = read_mux(rs1_value_array, head_idx, LSQ_SIZE, 32)
-        alu_b = imm_array[head_idx]
-        alu_result = (alu_a.bitcast(Int(32)) + alu_b.bitcast(Int(32))).bitcast(Bits(32))
-
-        is_memory_read = is_load_array[head_idx]
-        is_memory_write = is_store_array[head_idx]
-        request_addr = alu_result[2:2+depth_log-1].bitcast(UInt(depth_log))
-
-        dcache_we = is_memory_write
-        dcache_re = is_memory_read
-        dcache_addr = request_addr
-        memory_place_array[0] = alu_result.bitcast(Bits(32))[0:1] # load_byte 的时候需要确定是加载哪个字节
-        dcache_wdata = read_mux(rs2_value_array, head_idx, LSQ_SIZE, 32)
-
-        is_store = is_store_array[head_idx]
-        rob_idx_of_head = rob_index_array[head_idx]
-        can_execute_store = (rob_idx_of_head == rob_head_index)
-        condition_met = (~is_store) | (is_store & can_execute_store)
-
-        execute_valid = read_mux(allocated_array, head_idx, LSQ_SIZE, 1) & read_mux(ready_array, head_idx, LSQ_SIZE, 1) & (~clear_signal_array[0]) & condition_met
-        # log("head_idx: {} | allocated: {} | ready: {}", head_idx, read_mux(allocated_array, head_idx, LSQ_SIZE, 1), read_mux(ready_array, head_idx, LSQ_SIZE, 1))
-        with Condition(execute_valid):
-            # 执行 head 指向的条目
-            #log("LSQ entry {} executed", head_ptr)
-
-            write1hot(allocated_array, head_idx, Bits(1)(0))
-            head[0] = (head_ptr + Int(32)(1) == Int(32)(LSQ_SIZE)).select(Int(32)(0), head_ptr + Int(32)(1))
-        dcache.build(we = dcache_we & execute_valid, re = dcache_re & execute_valid, addr = dcache_addr, wdata = dcache_wdata)
-        # with Condition(dcache_we & execute_valid | dcache_re & execute_valid):
-        #     log("DCACHE | we: {} | re: {} | wdata: 0x{:08x} | addr: 0x{:08x} | pc_addr: 0x{:08x}", dcache_we & execute_valid, dcache_re & execute_valid, dcache_wdata, dcache_addr, addr_array[0])
-
-        with Condition(lsq_modify_recorder):
-            for i in range(LSQ_SIZE):
-                # log("LSQ entry {} modify recorder", Bits(5)(i))
-                # log("  allocated: {}, has_rs1_recorder: {}, rs1_recorder: {}, has_rs2_recorder: {}, rs2_recorder: {}", 
-                #     allocated_array[i][0], has_rs1_recorder_array[i][0], rs1_recorder_array[i], has_rs2_recorder_array[i][0], rs2_recorder_array[i])
-                modify_rs1_recorder = allocated_array[i][0] & has_rs1_recorder_array[i][0] & (rs1_recorder_array[i] == lsq_recorder)
-                modify_rs2_recorder = allocated_array[i][0] & has_rs2_recorder_array[i][0] & (rs2_recorder_array[i] == lsq_recorder)
+        # 多核时总线按时间片轮转：第 BUS_SLOT * hartid 个周期可以为原子操作读内存，下一个周期可以写 L1 并广播，
+        # 再下一个周期其他核更新它们的 L1。同一时间只有一个核在写，各个核的 L1 不会同时收到两份更新
+        num_cores = len(snoop_ports)
+        if num_cores > 1:
+            bus_phase = RegArray(Int(32), 1, initializer=[0])
+            last_phase = bus_phase[0] == Int(32)(BUS_SLOT * num_cores - 1)
+            bus_phase[0] = last_phase.select(Int(32)(0), bus_phase[0] + Int(32)(1))
+            own_read = bus_phase[0] == Int(32)(BUS_SLOT * hartid)
+            own_write = bus_phase[0] == Int(32)(BUS_SLOT * hartid + 1)
+        else:
+            own_read = Bits(1)(1)
+            own_write = Bits(1)(1)
+
+        apply_valid = []
+        apply_word = []
+        apply_mask = []
+        apply_data = []
+        for b in range(DCACHE_BANKS):
+            valid = Bits(1)(0)
+            word = UInt(depth_log - 1)(0)
+            mask = Bits(4)(0)
+            data = Bits(32)(0)
+            for k, port in enumerate(snoop_ports):
+                if k == hartid:
+                    continue
+                hit = port.valid[b][0]
+                valid = valid | hit
+                word = hit.select(port.word[b][0], word)
+                mask = hit.select(port.mask[b][0], mask)
+                data = hit.select(port.data[b][0], data)
+            apply_valid.append(valid)
+            apply_word.append(word)
+            apply_mask.append(mask)
+            apply_data.append(data)
+        applying = Bits(1)(0)
+        for valid in apply_valid:
+            applying = applying | valid
+
+        # dcache 按字地址的最低位分成两个 bank，load 端口和 store 端口各自访问一个 bank
+        # 轮到 ROB head 的 store 和紧跟在它后面的 load 只要落在不同的 bank 上，就可以在同一个周期完成
+        lq_head = lq.index(lq.head[0])
+        sq_head = sq.index(sq.head[0])
+        load_addr = read_mux(lq.mem_addr, lq_head, lq.size, 32)
+        head_addr = read_mux(sq.mem_addr, sq_head, sq.size, 32)
+        lq_entry_valid = lq.entry_valid(lq_head, clear)
+        sq_entry_valid = sq.entry_valid(sq_head, clear)
+
+        # store 只有在成为 ROB head 的时候才能执行
+        sq_at_head = sq_entry_valid & (sq.rob_index[sq_head] == rob_head_index)
+        # SMT 时作废的 store 到了 head 不写内存，直接退出队列，告诉 ROB 它做完了
+        amo_pending = RegArray(Bits(1), 1)
+        sq_discard = sq_at_head & rob_head_dead & ~amo_pending[0]
+        sq_at_head = sq_at_head & ~rob_head_dead
+        sq_atomic = sq.is_sc[sq_head] | sq.is_amo[sq_head]
+        store_fire = sq_at_head & ~sq.is_vector[sq_head] & ~sq_atomic & own_write
+        # 接了 DRAM 时序模型时，普通的 load / store 要等 DRAM 放行才能读写 SRAM；向量访存和原子操作不经过它
+        if dram:
+            dram_timing = DRAMTiming(2)
+            store_fire = dram_timing.request(store_fire, head_addr)
+        store_bank = head_addr[2:2]
+        load_bank = load_addr[2:2]
+
+        # SRAM 一个周期就读出数据；LOAD_HIT_LATENCY 更长时 load 的返回信号要多打几拍才送出去，
+        # 这几拍里不再读 dcache，dout 保持不动
+        load_stages = [[RegArray(Bits(1), 1), RegArray(Bits(3), 1), RegArray(Bits(32), 1), RegArray(Bits(2), 1),
+                        RegArray(Bits(1), 1), RegArray(Bits(2), 1), RegArray(Bits(1), 1)] for _ in range(LOAD_HIT_LATENCY - 1)]
+        # 推测唤醒走另一条流水线，从调度 load 的时刻开始数 LOAD_HIT_LATENCY 拍，和数据什么时候真的回来无关
+        wake_stages = [[RegArray(Bits(1), 1), RegArray(Bits(3), 1)] for _ in range(LOAD_HIT_LATENCY - 1)]
+        load_woken = RegArray(Bits(1), 1)       # 队列头部的 load 已经发过推测唤醒，等 DRAM 的时候不再重复唤醒
+        load_in_flight = Bits(1)(0)
+        for stage in load_stages:
+            load_in_flight = load_in_flight | stage[0][0]
+
+        older_pending = lq.older_stores[lq_head] - by_thread(lq.tid[lq_head], [cnt[0] for cnt in store_done])
+        load_ready = lq_entry_valid & ~lq.is_vector[lq_head] & ~applying & ~load_in_flight
+        behind_store = load_ready & store_fire & (older_pending == Int(32)(1)) & (sq.tid[sq_head] == lq.tid[lq_head])
+        bank_conflict = behind_store & (store_bank == load_bank)
+        # 调度器只看 load 到了队列头部、前面的 store 都做完了（或者正和它前面那条 store 一起做），就当它发出去了；
+        # bank 冲突和 DRAM 的等待要到访存的这一拍才知道，不影响推测唤醒
+        load_issue = load_ready & ((older_pending == Int(32)(0)) | behind_store)
+        load_fire = load_ready & ((older_pending == Int(32)(0)) | (behind_store & (store_bank != load_bank)))
+        if dram:
+            load_fire = dram_timing.request(load_fire, load_addr)
+            dram_timing.update(perf)
+
+        store_word = head_addr[3:3+depth_log-2].bitcast(UInt(depth_log-1))
+        load_word = load_addr[3:3+depth_log-2].bitcast(UInt(depth_log-1))
+        store_wdata = read_mux(sq.rs2_value, sq_head, sq.size, 32)
+
+        # 每个 bank 由 4 个字节宽的 SRAM 组成，sb / sh 只写被选中的那几个字节，不需要先读出整个字
+        store_place = head_addr[0:1]
+        store_length = sq.mem_length[sq_head]
+        store_mask = Bits(4)(0b1111)
+        store_mask = (store_length == Bits(2)(0)).select(Bits(4)(0b0001) << store_place, store_mask)
+        store_mask = (store_length == Bits(2)(1)).select(Bits(4)(0b0011) << store_place, store_mask)
+        store_lanes = store_wdata << concat(store_place, Bits(3)(0))
+
+        # 向量访存也要等到成为 ROB head 才执行，这时它独占两个 bank：
+        # 每拍访问连续的 DCACHE_BANKS 个字，它们的地址最低的字地址位不同，正好各落在一个 bank 上
+        vec_load = lq_entry_valid & lq.is_vector[lq_head] & (lq.rob_index[lq_head] == rob_head_index) & ~applying & ~load_in_flight
+        vec_store = sq_at_head & sq.is_vector[sq_head] & own_write
+        vec_fire = vec_load | vec_store
+        vec_last = vec_fire & (vec_beat[0] == Int(32)(VEC_BEATS - 1))
+        vec_addr = vec_load.select(load_addr, head_addr)
+        beat_shift = (4 * DCACHE_BANKS).bit_length() - 1
+        beat_base = (vec_addr.bitcast(Int(32)) + (vec_beat[0].bitcast(Bits(32)) << Bits(32)(beat_shift)).bitcast(Int(32)))
+        vec_addrs = [(beat_base + Int(32)(4 * k)).bitcast(Bits(32)) for k in range(DCACHE_BANKS)]
+        vec_words = []
+        vs = sq.vs[sq_head]
+        for k in range(DCACHE_BANKS):
+            value = vrf[k][vs]
+            for beat in range(1, VEC_BEATS):
+                value = (vec_beat[0] == Int(32)(beat)).select(vrf[beat * DCACHE_BANKS + k][vs], value)
+            vec_words.append(value)
+
+        with Condition(vec_fire):
+            vec_beat[0] = vec_last.select(Int(32)(0), vec_beat[0] + Int(32)(1))
+
+        # amoadd.w：先读出原来的值，下个周期把相加的结果写回去，原来的值写回 rd
+        # 多核时读和写正好落在自己时间片的前两个周期，中间不会有别的核的更新插进来
+        amo_read = sq_at_head & sq.is_amo[sq_head] & ~amo_pending[0] & own_read & ~load_in_flight
+        amo_write = amo_pending[0] & ~clear
+        amo_pending[0] = amo_read
+        douts = [[lane.dout for lane in lanes] for lanes in dcache_banks]
+        amo_old = Bits(32)(0)
+        for b, word in enumerate(dcache_words(douts)):
+            amo_old = (store_bank == Bits(1)(b)).select(word, amo_old)
+        amo_new = (amo_old.bitcast(Int(32)) + store_wdata.bitcast(Int(32))).bitcast(Bits(32))
+
+        # lr.w 记下保留的地址；别的核写了这个字，或者执行了 sc.w 以后保留失效
+        resv_valid = RegArray(Bits(1), 1)
+        resv_addr = RegArray(Bits(32), 1)
+        sc_fire = sq_at_head & sq.is_sc[sq_head] & own_write
+        sc_success = sc_fire & resv_valid[0] & (resv_addr[0][2:31] == head_addr[2:31])
+        lr_fire = load_fire & lq.is_lr[lq_head]
+        resv_hit = Bits(1)(0)
+        for b in range(DCACHE_BANKS):
+            resv_hit = resv_hit | (apply_valid[b] & (resv_addr[0][2:2] == Bits(1)(b)) &
+                                   (resv_addr[0][3:3+depth_log-2].bitcast(UInt(depth_log-1)) == apply_word[b]))
+        with Condition(lr_fire):
+            resv_addr[0] = load_addr
+        resv_valid[0] = lr_fire | (resv_valid[0] & ~resv_hit & ~sc_fire)
+
+        atomic_write = amo_write | sc_success
+        atomic_data = amo_write.select(amo_new, store_wdata)
+        atomic_done = amo_write | sc_fire
+        atomic_signal_array[0] = atomic_done.select(Bits(1)(1), Bits(1)(0))
+        atomic_rob_index_array[0] = sq.rob_index[sq_head]
+        atomic_result_array[0] = amo_write.select(amo_old, sc_success.select(Bits(32)(0), Bits(32)(1)))
+
+        # 每个队列每个周期最多退出一条，退出的条目作为 credit 还给 ROB
+        lq_pop = load_fire | (vec_last & vec_load)
+        sq_pop = store_fire | (vec_last & vec_store) | atomic_done | sq_discard
+        for q, q_head, pop, q_write in [(lq, lq_head, lq_pop, lq_write), (sq, sq_head, sq_pop, sq_write)]:
+            with Condition(pop):
+                write1hot(q.allocated, q_head, Bits(1)(0))
+                q.head[0] = q.advance(q.head[0])
+            with Condition(~clear):
+                q.count[0] = q.count[0] + q_write.select(Int(32)(1), Int(32)(0)) - pop.select(Int(32)(1), Int(32)(0))
+        for t in range(threads):
+            with Condition(sq_write & (tid == Bits(1)(t))):
+                store_dispatched[t][0] = store_dispatched[t][0] + Int(32)(1)
+            with Condition(sq_pop & (sq.tid[sq_head] == Bits(1)(t))):
+                store_done[t][0] = store_done[t][0] + Int(32)(1)
+        load_credit_array[0] = lq_pop.select(Bits(1)(1), Bits(1)(0))
+        store_credit_array[0] = sq_pop.select(Bits(1)(1), Bits(1)(0))
+
+        for i, lanes in enumerate(dcache_banks):
+            bank_we = (store_fire | atomic_write) & (store_bank == Bits(1)(i))
+            bank_re = (load_fire & (load_bank == Bits(1)(i))) | (amo_read & (store_bank == Bits(1)(i)))
+            bank_mask = atomic_write.select(Bits(4)(0b1111), store_mask)
+            vec_word = vec_addrs[0][3:3+depth_log-2].bitcast(UInt(depth_log-1))
+            vec_data = vec_words[0]
+            for k in range(1, DCACHE_BANKS):
+                in_bank = (vec_addrs[k][2:2] == Bits(1)(i))
+                vec_word = in_bank.select(vec_addrs[k][3:3+depth_log-2].bitcast(UInt(depth_log-1)), vec_word)
+                vec_data = in_bank.select(vec_words[k], vec_data)
+            bank_addr = vec_fire.select(vec_word, (bank_we | amo_read).select(store_word, load_word))
+            bank_data = vec_fire.select(vec_data, atomic_write.select(atomic_data, store_lanes))
+            own_mask = vec_store.select(Bits(4)(0b1111), bank_we.select(bank_mask, Bits(4)(0)))
+
+            # 别的核的更新和自己的访存不会在同一个周期用同一个 bank：自己的写在时间片里错开，load 遇到更新就等一个周期
+            apply = apply_valid[i]
+            for j, lane in enumerate(lanes):
+                lane_we = apply.select(apply_mask[i][j:j], own_mask[j:j])
+                lane.build(we = lane_we, re = ~apply & (bank_re | vec_load), addr = apply.select(apply_word[i], bank_addr),
+                           wdata = apply.select(apply_data[i], bank_data)[8*j:8*j+7])
+
+            if num_cores > 1:
+                port = snoop_ports[hartid]
+                port.valid[i][0] = own_mask != Bits(4)(0)
+                port.word[i][0] = bank_addr
+                port.mask[i][0] = own_mask
+                port.data[i][0] = bank_data
+
+                # 每一次写都要落到每一份拷贝上，靠的是下面三条，任何一条不成立都打印出来并停止模拟：
+                #   自己的写只发生在自己时间片的写周期（BUS_SLOT * hartid + 1）；
+                #   这个周期没有别的核的更新，否则 apply 会盖掉自己的写；
+                #   每个 bank 同一个周期最多收到一个核的更新，否则只有一份会被写进去
+                others = [other.valid[i][0] for k, other in enumerate(snoop_ports) if k != hartid]
+                multiple = Bits(1)(0)
+                for a in range(len(others)):
+                    for b in range(a + 1, len(others)):
+                        multiple = multiple | (others[a] & others[b])
+                own_writing = own_mask != Bits(4)(0)
+                violation = (own_writing & (~own_write | apply)) | multiple
+                with Condition(violation):
+                    log("snoop bus violation | hart: {} | bank: {} | own write: {} | in slot: {} | update: {} | multiple updates: {}",
+                        Bits(32)(hartid), Bits(32)(i), own_writing, own_write, apply, multiple)
+                    finish()
+        # with Condition(store_fire | load_fire):
+        #     log("DCACHE | store: {} 0x{:08x} <- 0x{:08x} | load: {} 0x{:08x}", store_fire, head_addr, store_wdata, load_fire, load_addr)
+
+        perf.incr("lsq_bank_conflicts", bank_conflict)
+        perf.incr("lsq_dual_issue", store_fire & load_fire)
+        perf.incr("lsq_subword_stores", store_fire & (store_length != Bits(2)(2)))
+        perf.incr("lsq_vec_beats", vec_fire)
+        perf.incr("lq_occupancy", ~clear, lq.count[0].bitcast(UInt(32)))
+        perf.incr("sq_occupancy", ~clear, sq.count[0].bitcast(UInt(32)))
+        perf.incr("lq_full_cycles", ~clear & (lq.count[0] == Int(32)(lq.size)))
+        perf.incr("sq_full_cycles", ~clear & (sq.count[0] == Int(32)(sq.size)))
+        perf.incr("lq_blocked_by_store", load_ready & ~load_fire)
+        perf.incr("lsq_atomics", atomic_done)
+        perf.incr("lsq_dead_stores", sq_discard)
+        perf.incr("lsq_sc_failures", sc_fire & ~sc_success)
+        if num_cores > 1:
+            perf.incr("lsq_snoop_updates", applying)
+            perf.incr("lsq_bus_wait_cycles", sq_at_head & ~sq.is_vector[sq_head] & ~own_write & ~amo_pending[0])
+
+        # load 的数据回到总线上时，等待它的条目直接从 load 总线上取值，不必等到它提交
+        load_hit = signal_array[0] & (~clear)
+        load_value = load_bus_value([[lane.dout for lane in lanes] for lanes in dcache_banks], load_bank_array[0], memory_place_array[0],
+                                    load_length_array[0], load_signed_array[0])
+        wake_index = rob_index_array_ret[0]
+
+        for q, q_write in zip(queues, q_writes):
+            for i in range(q.size):
+                modify_rs1_recorder = lsq_modify_recorder & q.allocated[i][0] & q.has_rs1_recorder[i][0] & (q.rs1_recorder[i] == lsq_recorder)
+                modify_rs2_recorder = lsq_modify_recorder & q.allocated[i][0] & q.has_rs2_recorder[i][0] & (q.rs2_recorder[i] == lsq_recorder)
+                wake_rs1 = load_hit & q.allocated[i][0] & q.has_rs1_recorder[i][0] & (q.rs1_recorder[i] == wake_index)
+                wake_rs2 = load_hit & q.allocated[i][0] & q.has_rs2_recorder[i][0] & (q.rs2_recorder[i] == wake_index)
                 with Condition(modify_rs1_recorder):
-                    has_rs1_recorder_array[i][0] = Bits(1)(0)
-                    rs1_value_array[i][0] = lsq_modify_value
+                    q.has_rs1_recorder[i][0] = Bits(1)(0)
+                    q.rs1_value[i][0] = lsq_modify_value
                 with Condition(modify_rs2_recorder):
-                    has_rs2_recorder_array[i][0] = Bits(1)(0)
-                    rs2_value_array[i][0] = lsq_modify_value
-                
-                with Condition(~(write_valid & (tail_ptr == Int(32)(i)))):
-                    # log("  ready_array[{}] modified to : {}", Bits(5)(i), ~((has_rs1_array[i] & (has_rs1_recorder_array[i][0] & (~modify_rs1_recorder))) | (has_rs2_array[i] & (has_rs2_recorder_array[i][0] & (~modify_rs2_recorder)))))
-                    ready_array[i][0] = ~((has_rs1_array[i] & (has_rs1_recorder_array[i][0] & (~modify_rs1_recorder))) | 
-                                                        (has_rs2_array[i] & (has_rs2_recorder_array[i][0] & (~modify_rs2_recorder))))
-                
-        with Condition(clear_signal_array[0]):
-            head[0] = Int(32)(0)
-            tail[0] = Int(32)(0)
-            lsq_size[0] = Int(32)(0)
-            for i in range(LSQ_SIZE):
-                allocated_array[i][0] = Bits(1)(0)
-
-        rob_index_array_ret[0] = rob_index_array[head_idx]
-        pc_result_array[0] = (addr_array[head_idx].bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
-        signal_array[0] = execute_valid.select(Bits(1)(1), Bits(1)(0))
-        
-        with Condition(~clear_signal_array[0]):
-            lsq_size[0] = lsq_size[0] + write_valid.select(Int(32)(1), Int(32)(0)) - execute_valid.select(Int(32)(1), Int(32)(0))
\ No newline at end of file
+                    q.has_rs2_recorder[i][0] = Bits(1)(0)
+                    q.rs2_value[i][0] = lsq_modify_value
+                with Condition(wake_rs1):
+                    q.has_rs1_recorder[i][0] = Bits(1)(0)
+                    q.rs1_value[i][0] = load_value
+                with Condition(wake_rs2):
+                    q.has_rs2_recorder[i][0] = Bits(1)(0)
+                    q.rs2_value[i][0] = load_value
+
+                rs1_resolved = modify_rs1_recorder | wake_rs1
+                rs2_resolved = modify_rs2_recorder | wake_rs2
+                with Condition((lsq_modify_recorder | load_hit) & ~(q_write & (q.tail[0] == Int(32)(i)))):
+                    q.ready[i][0] = ~((q.has_rs1[i] & (q.has_rs1_recorder[i][0] & (~rs1_resolved))) | 
+                                      (q.has_rs2[i] & (q.has_rs2_recorder[i][0] & (~rs2_resolved))))
+
+        with Condition(clear):
+            for q in queues:
+                q.head[0] = Int(32)(0)
+                q.tail[0] = Int(32)(0)
+                q.count[0] = Int(32)(0)
+                for i in range(q.size):
+                    q.allocated[i][0] = Bits(1)(0)
+            for t in range(threads):
+                store_dispatched[t][0] = Int(32)(0)
+                store_done[t][0] = Int(32)(0)
+            vec_beat[0] = Int(32)(0)
+
+        ret = [load_fire.select(Bits(1)(1), Bits(1)(0)),
+               lq.rob_index[lq_head],
+               (lq.addr[lq_head].bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32)),
+               load_addr[0:1], # load_byte 的时候需要确定是加载哪个字节
+               load_bank,
+               lq.mem_length[lq_head],
+               lq.mem_signed[lq_head]]
+        for stage in load_stages:
+            for reg, value in zip(stage, [ret[0] & (~clear)] + ret[1:]):
+                reg[0] = value
+            ret = [reg[0] for reg in stage]
+        signal_array[0] = ret[0]
+        rob_index_array_ret[0] = ret[1]
+        pc_result_array[0] = ret[2]
+        memory_place_array[0] = ret[3]
+        load_bank_array[0] = ret[4]
+        load_length_array[0] = ret[5]
+        load_signed_array[0] = ret[6]
+
+        # 推测唤醒：load 一被调度就假设它会在 LOAD_HIT_LATENCY 个周期后命中，每条 load 只唤醒一次；
+        # 数据晚到或者没来由 RS 作废被选中的指令，等数据真的回来再发
+        wake_fire = load_issue & ~load_woken[0] & (~clear)
+        load_woken[0] = (load_woken[0] | load_issue) & ~lq_pop & (~clear)
+        wake = [wake_fire.select(Bits(1)(1), Bits(1)(0)), lq.rob_index[lq_head]]
+        for stage in wake_stages:
+            for reg, value in zip(stage, [wake[0] & (~clear)] + wake[1:]):
+                reg[0] = value
+            wake = [reg[0] for reg in stage]
+        load_wakeup_valid_array[0] = wake[0]
+        load_wakeup_index_array[0] = wake[1]
+        perf.incr("lsq_load_wakeups", wake_fire)
+
+        store_rob_index_array_ret[0] = sq.rob_index[sq_head]
+        store_pc_result_array[0] = (sq.addr[sq_head].bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
+        store_signal_array[0] = (store_fire | (vec_last & vec_store) | sq_discard).select(Bits(1)(1), Bits(1)(0))
+
+        # vle32 的数据下个周期从 dcache 读出来，由 ROB 写进向量寄存器堆
+        vec_load_valid_array[0] = vec_load.select(Bits(1)(1), Bits(1)(0))
+        vec_load_beat_array[0] = vec_beat[0]
+        vec_load_bank_array[0] = vec_addrs[0][2:2]
+        vec_load_rob_index_array[0] = lq.rob_index[lq_head]
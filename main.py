@@ -1,5 +1,8 @@
 import os
+import re
+import json
 import shutil
+import time
 
 from assassyn.frontend import *
 from assassyn.backend import *
@@ -14,6 +17,11 @@ from RS import *
 from alu import *
 from lsq import *
 from mul_alu import *
+from div_alu import *
+from vec_alu import *
+from perf import *
+from smt import *
+from inorder import *
 
 current_path = os.path.dirname(os.path.abspath(__file__))
 workspace = f"{current_path}/.workspace/"
@@ -23,12 +31,13 @@ class Driver(Module):
         super().__init__(ports={})
 
     @module.combinational
-    def build(self, fetcher: Module):
+    def build(self, fetchers: list):
         init_reg = RegArray(UInt(1), 1, initializer=[1])
         with Condition(init_reg[0] == UInt(1)(1)):
             init_reg[0] = UInt(1)(0)
         with Condition(init_reg[0] == UInt(1)(0)):
-            d_call = fetcher.async_called()
+            for fetcher in fetchers:
+                fetcher.async_called()
 
 def cp_if_exists(src, dst, required):
     if os.path.exists(src):
@@ -36,150 +45,706 @@ def cp_if_exists(src, dst, required):
     elif required:
         raise FileNotFoundError(f"File {src} not found")
 
-def init_workspace(base_path, case):
+def thread_workload(t):
+    # SMT 时线程 t 的程序放在 workload.t{t}.* 里，线程 0 沿用原来的名字
+    return 'workload' if t == 0 else f'workload.t{t}'
+
+def init_workspace(base_path, cases, thread_words):
     if os.path.exists(f'{workspace}'):
         shutil.rmtree(f'{workspace}')
     os.mkdir(f'{workspace}')
-    cp_if_exists(f'{base_path}/{case}.exe', f'{workspace}/workload.exe', False)
-    cp_if_exists(f'{base_path}/{case}.data', f'{workspace}/workload.data', True)
-    cp_if_exists(f'{base_path}/{case}.config', f'{workspace}/workload.config', False)
+    for t, case in enumerate(cases):
+        name = thread_workload(t)
+        cp_if_exists(f'{base_path}/{case}.exe', f'{workspace}/{name}.exe', False)
+        cp_if_exists(f'{base_path}/{case}.data', f'{workspace}/{name}.data', True)
+        cp_if_exists(f'{base_path}/{case}.config', f'{workspace}/{name}.config', False)
+        if os.path.exists(f'{workspace}/{name}.exe'):
+            split_halves(f'{workspace}/{name}.exe')
+    if len(cases) > 1:
+        merge_thread_data(len(cases), thread_words)
+    split_banks(f'{workspace}/workload.data', DCACHE_BANKS)
 
-def build_cpu(depth_log: int):
-    init_workspace(f"{current_path}/workloads", "tak")
-    with open(f'{workspace}/workload.config') as f:
-        raw = f.readline()
-        raw = raw.replace('offset:', "'offset':").replace('data_offset:', "'data_offset':")
-        offsets = eval(raw)
-        value = hex(offsets['data_offset'])
-        value = value[1:] if value[0] == '-' else value
-        value = value[2:]
-        open(f'{workspace}/workload.init', 'w').write(value)
+def merge_thread_data(threads, thread_words):
+    # 各个线程共用一个 dcache，线程 t 的数据从第 t * thread_words 个字开始，LSQ 给它的地址加上同样的偏移
+    images = [read_hex_words(f'{workspace}/{thread_workload(t)}.data') for t in range(threads)]
+    words = []
+    for t, image in enumerate(images):
+        assert len(image) <= thread_words, f"thread {t} data does not fit in its part of the dcache"
+        words += image
+        if t != threads - 1:
+            words += [0] * (thread_words - len(image))
+    with open(f'{workspace}/workload.data', 'w') as f:
+        f.write('\n'.join(f'{w:x}' for w in words) + '\n')
 
-    sys = SysBuilder("Tomasulo-CPU")
+def read_hex_words(path):
+    # 每行一个十六进制的字，// 后面是注释
+    with open(path) as f:
+        lines = [line.split('//')[0].strip() for line in f.read().split('\n')]
+    return [int(line, 16) for line in lines if line]
 
-    with sys:
-        rob_index_array_to_alu = RegArray(Bits(3), 1)
-        result_array_to_alu = RegArray(Bits(32), 1)
-        pc_result_array_to_alu = RegArray(Bits(32), 1)
-        signal_array_to_alu = RegArray(Bits(1), 1)
-
-        rob_index_array_to_mul_alu = RegArray(Bits(3), 1)
-        result_array_to_mul_alu = RegArray(Bits(32), 1)
-        pc_result_array_to_mul_alu = RegArray(Bits(32), 1)
-        signal_array_to_mul_alu = RegArray(Bits(1), 1)
-
-        rob_index_array_to_lsq = RegArray(Bits(3), 1)
-        pc_result_array_to_lsq = RegArray(Bits(32), 1)
-        signal_array_to_lsq = RegArray(Bits(1), 1)
-        memory_place_array = RegArray(Bits(2), 1)
-
-        clear_signal_array = RegArray(Bits(1), 1)
-        reset_pc_addr = RegArray(Bits(32), 1)
-
-        decode_valid = RegArray(Bits(1), 1)
-        rob_full = RegArray(Bits(1), 1)
-        rob_full_for_fetcher = RegArray(Bits(1), 1)
-
-        BHT_LOG_SIZE = 6
-        BHT_SIZE = 1 << BHT_LOG_SIZE
-        
-        bht_array = RegArray(Bits(2), BHT_SIZE, initializer=[1] * BHT_SIZE)
-        btb_target_array = RegArray(Bits(32), BHT_SIZE, initializer=[0] * BHT_SIZE)
+def split_banks(path, banks):
+    # 按字地址交错，把数据镜像拆给每个 dcache bank，每个 bank 再按字节拆成 4 个字节宽的 SRAM
+    words = read_hex_words(path)
+    for i in range(banks):
+        for j in range(4):
+            with open(f'{path}.bank{i}.lane{j}', 'w') as f:
+                f.write('\n'.join(f'{(w >> (8 * j)) & 0xff:x}' for w in words[i::banks]) + '\n')
 
-        icache = SRAM(width=32, depth = 1<<depth_log, init_file = f"{workspace}/workload.exe")
-        icache.name = "icache"
-        
-        rob = ROB()
-        decoder = Decoder()
-        fetcher = Fetcher()
-        fetcher_impl = FetcherImpl()
-        alu = ALU()
-        rs = RS()
-        lsq = LSQ()
-        mul_alu = MUL_ALU()
-        dcache = SRAM(width=32, depth = 1<<depth_log, init_file = f"{workspace}/workload.data")
-        dcache.name = "dcache"
-
-        rob.build(
-            rob_full_array=rob_full,
-            rob_full_array_for_fetcher=rob_full_for_fetcher,
-            
-            rob_index_array_from_alu = rob_index_array_to_alu,
-            result_array_from_alu = result_array_to_alu,
-            pc_result_array_from_alu = pc_result_array_to_alu,
-            signal_array_from_alu = signal_array_to_alu,
-
-            rob_index_array_from_mul_alu = rob_index_array_to_mul_alu,
-            result_array_from_mul_alu = result_array_to_mul_alu,
-            pc_result_array_from_mul_alu = pc_result_array_to_mul_alu,
-            signal_array_from_mul_alu = signal_array_to_mul_alu,
-
-            rob_index_array_from_lsq = rob_index_array_to_lsq,
-            result_array_from_lsq = dcache.dout,
-            pc_result_array_from_lsq = pc_result_array_to_lsq,
-            signal_array_from_lsq = signal_array_to_lsq,
-            memory_place_array = memory_place_array,
-
-            reset_pc_addr_array = reset_pc_addr,
-            rs = rs,
-            lsq = lsq,
-            clear_signal_array = clear_signal_array,
-            bht_array = bht_array,
-            btb_target_array = btb_target_array,
-            bht_log_size = BHT_LOG_SIZE
-        )
+def split_halves(path):
+    # icache 按半字交错：每个字的低半字放进偶数 bank，高半字放进奇数 bank
+    words = read_hex_words(path)
+    for i in range(2):
+        with open(f'{path}.half{i}', 'w') as f:
+            f.write('\n'.join(f'{(w >> (16 * i)) & 0xffff:x}' for w in words) + '\n')
+
+BHT_LOG_SIZE = 6
+
+def build_predictor():
+    BHT_SIZE = 1 << BHT_LOG_SIZE
+    bht_array = RegArray(Bits(2), BHT_SIZE, initializer=[1] * BHT_SIZE)
+    btb_target_array = RegArray(Bits(32), BHT_SIZE, initializer=[0] * BHT_SIZE)
+    # 不是分支的 PC 不会训练置信度，初始为最高置信度，避免它们把取指门控住
+    conf_array = RegArray(Bits(CONF_BITS), BHT_SIZE, initializer=[(1 << CONF_BITS) - 1] * BHT_SIZE)
+    return bht_array, btb_target_array, conf_array
+
+def build_frontend(
+    depth_log: int,
+    tid: int,
+    suffix: str,
+    rob: Module,
+    rob_full_array: Array,
+    clear_signal_array: Array,
+    reset_pc_addr_array: Array,
+    bht_array: Array,
+    btb_target_array: Array,
+    conf_array: Array,
+    commit_valid_array: Array,
+    commit_addr_array: Array,
+    fetch_turn_array: Array,
+    decode_turn_array: Array,
+    perf: PerfCounters
+):
+    # 一个线程的前端：icache、取指和译码。rob 是译码器发往的后端，乱序核的 ROB 或者顺序核；
+    # SMT 时传 None，译码器的输出交给 ThreadArbiter 转发
+    decode_valid = RegArray(Bits(1), 1)
+    decode_redirect_valid = RegArray(Bits(1), 1)
+    decode_redirect_pc = RegArray(Bits(32), 1)
+    loop_active = RegArray(Bits(1), 1)
+
+    icache_banks = []
+    for i in range(2):
+        bank = SRAM(width=16, depth = 1<<depth_log, init_file = f"{workspace}/{thread_workload(tid)}.exe.half{i}")
+        bank.name = f"icache_half{i}{suffix}"
+        icache_banks.append(bank)
+
+    decoder = Decoder()
+    fetcher = Fetcher()
+    fetcher_impl = FetcherImpl()
+    for m in [decoder, fetcher, fetcher_impl]:
+        m.name = f"{m.name}{suffix}"
+
+    pc_reg, pc_addr = fetcher.build()
 
-        pc_reg, pc_addr = fetcher.build()
+    fetcher_impl.build(
+        depth_log = depth_log,
+        pc_reg = pc_reg,
+        pc_addr = pc_addr,
+        decoder = decoder,
+        rob_full_array = rob_full_array,
+        decode_valid_array = decode_valid,
+        icache_banks = icache_banks,
+        clear_signal_array = clear_signal_array,
+        reset_pc_addr_array = reset_pc_addr_array,
+        bht_array = bht_array,
+        btb_target_array = btb_target_array,
+        bht_log_size = BHT_LOG_SIZE,
+        conf_array = conf_array,
+        commit_valid_array = commit_valid_array,
+        commit_addr_array = commit_addr_array,
+        decode_redirect_valid_array = decode_redirect_valid,
+        decode_redirect_pc_array = decode_redirect_pc,
+        loop_active_array = loop_active,
+        tid = tid,
+        fetch_turn_array = fetch_turn_array,
+        perf = perf
+    )
 
-        fetch_valid = fetcher_impl.build(
+    out = decoder.build(rob = rob, icache_douts = [bank.dout for bank in icache_banks], rob_full_array = rob_full_array,
+                        decode_valid_array = decode_valid, clear_signal_array = clear_signal_array,
+                        decode_redirect_valid_array = decode_redirect_valid, decode_redirect_pc_array = decode_redirect_pc,
+                        loop_active_array = loop_active, tid = tid, decode_turn_array = decode_turn_array, perf = perf)
+    return fetcher, out
+
+def build_core(depth_log: int, hartid: int, snoop_ports: list, halt_arrays: list, threads: int = 1, dram: bool = False):
+    # 一个完整的 Tomasulo 核：前端、ROB、RS、各个执行单元、LSQ，以及它私有的 icache / dcache
+    # threads > 1 时是 SMT：每个线程有自己的取指、译码和 icache，后端共用
+    suffix = '' if hartid == 0 else f"_{hartid}"
+
+    rob_index_array_to_alu = RegArray(Bits(3), 1)
+    result_array_to_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_alu = RegArray(Bits(32), 1)
+    signal_array_to_alu = RegArray(Bits(1), 1)
+
+    rob_index_array_to_mul_alu = RegArray(Bits(3), 1)
+    result_array_to_mul_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_mul_alu = RegArray(Bits(32), 1)
+    signal_array_to_mul_alu = RegArray(Bits(1), 1)
+
+    rob_index_array_to_div_alu = RegArray(Bits(3), 1)
+    result_array_to_div_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_div_alu = RegArray(Bits(32), 1)
+    signal_array_to_div_alu = RegArray(Bits(1), 1)
+    div_busy = RegArray(Bits(1), 1)
+
+    rob_index_array_to_vec_alu = RegArray(Bits(3), 1)
+    signal_array_to_vec_alu = RegArray(Bits(1), 1)
+    write_vrf_array_to_vec_alu = RegArray(Bits(1), 1)
+    vd_array_to_vec_alu = RegArray(Bits(3), 1)
+    lane_result_arrays_to_vec_alu = [RegArray(Bits(32), 1) for _ in range(VLANES)]
+    scalar_result_array_to_vec_alu = RegArray(Bits(32), 1)
+    vrf = [RegArray(Bits(32), VREGS) for _ in range(VLANES)]    # 向量寄存器堆，每个 lane 一个
+
+    rob_index_array_to_lsq = RegArray(Bits(3), 1)
+    pc_result_array_to_lsq = RegArray(Bits(32), 1)
+    signal_array_to_lsq = RegArray(Bits(1), 1)
+    memory_place_array = RegArray(Bits(2), 1)
+    load_bank_array = RegArray(Bits(1), 1)
+    load_length_array = RegArray(Bits(2), 1)
+    load_signed_array = RegArray(Bits(1), 1)
+    load_wakeup_valid_array = RegArray(Bits(1), 1)
+    load_wakeup_index_array = RegArray(Bits(3), 1)
+
+    store_rob_index_array_to_lsq = RegArray(Bits(3), 1)
+    store_pc_result_array_to_lsq = RegArray(Bits(32), 1)
+    store_signal_array_to_lsq = RegArray(Bits(1), 1)
+    vec_load_valid_array = RegArray(Bits(1), 1)
+    vec_load_beat_array = RegArray(Int(32), 1)
+    vec_load_bank_array = RegArray(Bits(1), 1)
+    vec_load_rob_index_array = RegArray(Bits(3), 1)
+    load_credit = RegArray(Bits(1), 1)
+    store_credit = RegArray(Bits(1), 1)
+    atomic_signal = RegArray(Bits(1), 1)
+    atomic_rob_index = RegArray(Bits(3), 1)
+    atomic_result = RegArray(Bits(32), 1)
+
+    clear_signal_array = RegArray(Bits(1), 1)
+    reset_pc_addrs = [RegArray(Bits(32), 1) for _ in range(threads)]
+    # 每个线程的前端有自己的 clear：SMT 时清空流水线只清一个线程，ROB 收不下的指令也只让它所在线程的前端重新取指
+    thread_clears = [RegArray(Bits(1), 1) for _ in range(threads)]
+
+    rob_full = RegArray(Bits(1), 1)
+    rob_full_for_fetcher = RegArray(Bits(1), 1)
+
+    bht_array, btb_target_array, conf_array = build_predictor()
+    commit_valid_array = RegArray(Bits(1), 1)
+    commit_addr_array = RegArray(Bits(32), 1)
+
+    # SMT：这个周期轮到哪个线程取指、哪个线程的译码器往 ROB 发，各线程在 ROB 里有几条指令，是否已经停在 ebreak 上
+    fetch_turn = RegArray(Bits(1), 1)
+    decode_turn = RegArray(Bits(1), 1)
+    thread_counts = [RegArray(Int(32), 1, initializer=[0]) for _ in range(threads)]
+    thread_halts = [RegArray(Bits(1), 1) for _ in range(threads)]
+
+    rob = ROB()
+    alu = ALU()
+    rs = RS()
+    lsq = LSQ()
+    mul_alu = MUL_ALU()
+    div_alu = DIV_ALU()
+    vec_alu = VEC_ALU()
+    for m in [rob, alu, rs, lsq, mul_alu, div_alu, vec_alu]:
+        m.name = f"{m.name}{suffix}"
+    dcache_banks = []
+    for i in range(DCACHE_BANKS):
+        lanes = []
+        for j in range(4):
+            lane = SRAM(width=8, depth = 1<<(depth_log - 1), init_file = f"{workspace}/workload.data.bank{i}.lane{j}")
+            lane.name = f"dcache_bank{i}_lane{j}{suffix}"
+            lanes.append(lane)
+        dcache_banks.append(lanes)
+    dcache_douts = [[lane.dout for lane in lanes] for lanes in dcache_banks]
+
+    perf = PerfCounters(f"core{hartid}." if len(halt_arrays) > 1 else '')
+
+    # 分支预测器（BHT / BTB / 置信度）各线程共用，其余的前端状态每个线程一份
+    fetchers = []
+    decoder_outs = []
+    for t in range(threads):
+        tsuffix = suffix if t == 0 else f"{suffix}_t{t}"
+        tperf = perf if threads == 1 else perf.child(f"t{t}")
+        fetcher, out = build_frontend(
             depth_log = depth_log,
-            pc_reg = pc_reg,
-            pc_addr = pc_addr,
-            decoder = decoder,
+            tid = t,
+            suffix = tsuffix,
+            rob = rob if threads == 1 else None,
             rob_full_array = rob_full,
-            decode_valid_array = decode_valid,
-            icache = icache,
-            clear_signal_array = clear_signal_array,
-            reset_pc_addr_array = reset_pc_addr,
+            clear_signal_array = thread_clears[t],
+            reset_pc_addr_array = reset_pc_addrs[t],
             bht_array = bht_array,
             btb_target_array = btb_target_array,
-            bht_log_size = BHT_LOG_SIZE
+            conf_array = conf_array,
+            commit_valid_array = commit_valid_array,
+            commit_addr_array = commit_addr_array,
+            fetch_turn_array = fetch_turn,
+            decode_turn_array = decode_turn,
+            perf = tperf
         )
+        fetchers.append(fetcher)
+        decoder_outs.append(out)
 
-        decoder.build(rob = rob, rdata = icache.dout, rob_full_array = rob_full, decode_valid_array = decode_valid, clear_signal_array = clear_signal_array)
+    if threads > 1:
+        arbiter = ThreadArbiter()
+        arbiter.name = f"{arbiter.name}{suffix}"
+        arbiter.build(
+            rob = rob,
+            decoder_outs = decoder_outs,
+            fetch_turn_array = fetch_turn,
+            decode_turn_array = decode_turn,
+            thread_count_arrays = thread_counts,
+            thread_halt_arrays = thread_halts,
+            perf = perf
+        )
 
-        driver = Driver()
-        driver.build(fetcher)
+    rs.build(
+        alu = alu,
+        mul_alu = mul_alu,
+        div_alu = div_alu,
+        div_busy_array = div_busy,
+        clear_signal_array = clear_signal_array,
+        load_wakeup_valid_array = load_wakeup_valid_array,
+        load_wakeup_index_array = load_wakeup_index_array,
+        load_signal_array = signal_array_to_lsq,
+        load_rob_index_array = rob_index_array_to_lsq,
+        load_dout_arrays = dcache_douts,
+        load_bank_array = load_bank_array,
+        memory_place_array = memory_place_array,
+        load_length_array = load_length_array,
+        load_signed_array = load_signed_array,
+        perf = perf,
+    )
+    
+    alu.build(
+        rob_index_array = rob_index_array_to_alu,
+        result_array = result_array_to_alu,
+        pc_result_array = pc_result_array_to_alu,
+        signal_array = signal_array_to_alu,
+        perf = perf
+    )
 
-        rs.build(
-            alu = alu,
-            mul_alu = mul_alu,
-            clear_signal_array = clear_signal_array,
-        )
-        
-        alu.build(
-            rob_index_array = rob_index_array_to_alu,
-            result_array = result_array_to_alu,
-            pc_result_array = pc_result_array_to_alu,
-            signal_array = signal_array_to_alu
-        )
+    mul_alu.build(
+        rob_index_array = rob_index_array_to_mul_alu,
+        result_array = result_array_to_mul_alu,
+        pc_result_array = pc_result_array_to_mul_alu,
+        signal_array = signal_array_to_mul_alu,
+        perf = perf
+    )
 
-        mul_alu.build(
-            rob_index_array = rob_index_array_to_mul_alu,
-            result_array = result_array_to_mul_alu,
-            pc_result_array = pc_result_array_to_mul_alu,
-            signal_array = signal_array_to_mul_alu
-        )
+    div_alu.build(
+        rob_index_array = rob_index_array_to_div_alu,
+        result_array = result_array_to_div_alu,
+        pc_result_array = pc_result_array_to_div_alu,
+        signal_array = signal_array_to_div_alu,
+        div_busy_array = div_busy,
+        clear_signal_array = clear_signal_array,
+        perf = perf
+    )
+
+    vec_alu.build(
+        vrf = vrf,
+        rob_index_array = rob_index_array_to_vec_alu,
+        signal_array = signal_array_to_vec_alu,
+        write_vrf_array = write_vrf_array_to_vec_alu,
+        vd_array = vd_array_to_vec_alu,
+        lane_result_arrays = lane_result_arrays_to_vec_alu,
+        scalar_result_array = scalar_result_array_to_vec_alu,
+        clear_signal_array = clear_signal_array,
+        perf = perf
+    )
+    
+    lsq.build(
+        dcache_banks = dcache_banks,
+        depth_log = depth_log,
+        rob_index_array_ret = rob_index_array_to_lsq,
+        pc_result_array = pc_result_array_to_lsq,
+        signal_array = signal_array_to_lsq,
+        store_rob_index_array_ret = store_rob_index_array_to_lsq,
+        store_pc_result_array = store_pc_result_array_to_lsq,
+        store_signal_array = store_signal_array_to_lsq,
+        clear_signal_array = clear_signal_array,
+        memory_place_array = memory_place_array,
+        load_bank_array = load_bank_array,
+        load_length_array = load_length_array,
+        load_signed_array = load_signed_array,
+        load_wakeup_valid_array = load_wakeup_valid_array,
+        load_wakeup_index_array = load_wakeup_index_array,
+        vrf = vrf,
+        vec_load_valid_array = vec_load_valid_array,
+        vec_load_beat_array = vec_load_beat_array,
+        vec_load_bank_array = vec_load_bank_array,
+        vec_load_rob_index_array = vec_load_rob_index_array,
+        load_credit_array = load_credit,
+        store_credit_array = store_credit,
+        hartid = hartid,
+        snoop_ports = snoop_ports,
+        threads = threads,
+        atomic_signal_array = atomic_signal,
+        atomic_rob_index_array = atomic_rob_index,
+        atomic_result_array = atomic_result,
+        dram = dram,
+        perf = perf
+    )
+
+    # ROB 放到最后 build，ebreak 时导出的计数器才能包含所有模块
+    rob.build(
+        rob_full_array=rob_full,
+        rob_full_array_for_fetcher=rob_full_for_fetcher,
         
-        lsq.build(
-            dcache = dcache,
-            depth_log = depth_log,
-            rob_index_array_ret = rob_index_array_to_lsq,
-            pc_result_array = pc_result_array_to_lsq,
-            signal_array = signal_array_to_lsq,
-            clear_signal_array = clear_signal_array,
-            memory_place_array = memory_place_array
-        )
+        rob_index_array_from_alu = rob_index_array_to_alu,
+        result_array_from_alu = result_array_to_alu,
+        pc_result_array_from_alu = pc_result_array_to_alu,
+        signal_array_from_alu = signal_array_to_alu,
+
+        rob_index_array_from_mul_alu = rob_index_array_to_mul_alu,
+        result_array_from_mul_alu = result_array_to_mul_alu,
+        pc_result_array_from_mul_alu = pc_result_array_to_mul_alu,
+        signal_array_from_mul_alu = signal_array_to_mul_alu,
+
+        rob_index_array_from_div_alu = rob_index_array_to_div_alu,
+        result_array_from_div_alu = result_array_to_div_alu,
+        pc_result_array_from_div_alu = pc_result_array_to_div_alu,
+        signal_array_from_div_alu = signal_array_to_div_alu,
+
+        rob_index_array_from_vec_alu = rob_index_array_to_vec_alu,
+        signal_array_from_vec_alu = signal_array_to_vec_alu,
+        write_vrf_array_from_vec_alu = write_vrf_array_to_vec_alu,
+        vd_array_from_vec_alu = vd_array_to_vec_alu,
+        lane_result_arrays_from_vec_alu = lane_result_arrays_to_vec_alu,
+        scalar_result_array_from_vec_alu = scalar_result_array_to_vec_alu,
+
+        rob_index_array_from_lsq = rob_index_array_to_lsq,
+        result_array_from_lsq = dcache_douts,
+        pc_result_array_from_lsq = pc_result_array_to_lsq,
+        signal_array_from_lsq = signal_array_to_lsq,
+        store_rob_index_array_from_lsq = store_rob_index_array_to_lsq,
+        store_pc_result_array_from_lsq = store_pc_result_array_to_lsq,
+        store_signal_array_from_lsq = store_signal_array_to_lsq,
+        memory_place_array = memory_place_array,
+        load_bank_array = load_bank_array,
+        vec_load_valid_array = vec_load_valid_array,
+        vec_load_beat_array = vec_load_beat_array,
+        vec_load_bank_array = vec_load_bank_array,
+        vec_load_rob_index_array = vec_load_rob_index_array,
+        vrf = vrf,
+
+        reset_pc_addr_arrays = reset_pc_addrs,
+        thread_clear_arrays = thread_clears,
+        rs = rs,
+        lsq = lsq,
+        load_credit_array = load_credit,
+        store_credit_array = store_credit,
+        atomic_signal_array = atomic_signal,
+        atomic_rob_index_array = atomic_rob_index,
+        atomic_result_array = atomic_result,
+        vec_alu = vec_alu,
+        clear_signal_array = clear_signal_array,
+        bht_array = bht_array,
+        btb_target_array = btb_target_array,
+        bht_log_size = BHT_LOG_SIZE,
+        conf_array = conf_array,
+        commit_valid_array = commit_valid_array,
+        commit_addr_array = commit_addr_array,
+        hartid = hartid,
+        halt_arrays = halt_arrays,
+        threads = threads,
+        thread_count_arrays = thread_counts,
+        thread_halt_arrays = thread_halts,
+        perf = perf
+    )
+    return fetchers
+
+def build_inorder_core(depth_log: int, dram: bool = False):
+    # 对照用的顺序核：前端和 ALU / MUL_ALU / DIV_ALU 和乱序核一样，ROB / RS / LSQ 换成 InOrderCore
+    rob_index_array_to_alu = RegArray(Bits(3), 1)
+    result_array_to_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_alu = RegArray(Bits(32), 1)
+    signal_array_to_alu = RegArray(Bits(1), 1)
+
+    rob_index_array_to_mul_alu = RegArray(Bits(3), 1)
+    result_array_to_mul_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_mul_alu = RegArray(Bits(32), 1)
+    signal_array_to_mul_alu = RegArray(Bits(1), 1)
+
+    rob_index_array_to_div_alu = RegArray(Bits(3), 1)
+    result_array_to_div_alu = RegArray(Bits(32), 1)
+    pc_result_array_to_div_alu = RegArray(Bits(32), 1)
+    signal_array_to_div_alu = RegArray(Bits(1), 1)
+    div_busy = RegArray(Bits(1), 1)
+
+    clear_signal_array = RegArray(Bits(1), 1)
+    # 执行单元里的指令都在还没解决的分支前面，清空前端时不能作废除法器里的指令
+    unit_clear_array = RegArray(Bits(1), 1)
+    reset_pc_addr = RegArray(Bits(32), 1)
+    rob_full = RegArray(Bits(1), 1)
+
+    bht_array, btb_target_array, conf_array = build_predictor()
+    commit_valid_array = RegArray(Bits(1), 1)
+    commit_addr_array = RegArray(Bits(32), 1)
+    fetch_turn = RegArray(Bits(1), 1)
+    decode_turn = RegArray(Bits(1), 1)
+
+    core = InOrderCore()
+    alu = ALU()
+    mul_alu = MUL_ALU()
+    div_alu = DIV_ALU()
+    dcache_banks = []
+    for i in range(DCACHE_BANKS):
+        lanes = []
+        for j in range(4):
+            lane = SRAM(width=8, depth = 1<<(depth_log - 1), init_file = f"{workspace}/workload.data.bank{i}.lane{j}")
+            lane.name = f"dcache_bank{i}_lane{j}"
+            lanes.append(lane)
+        dcache_banks.append(lanes)
+
+    perf = PerfCounters('')
+
+    fetcher, _ = build_frontend(
+        depth_log = depth_log,
+        tid = 0,
+        suffix = '',
+        rob = core,
+        rob_full_array = rob_full,
+        clear_signal_array = clear_signal_array,
+        reset_pc_addr_array = reset_pc_addr,
+        bht_array = bht_array,
+        btb_target_array = btb_target_array,
+        conf_array = conf_array,
+        commit_valid_array = commit_valid_array,
+        commit_addr_array = commit_addr_array,
+        fetch_turn_array = fetch_turn,
+        decode_turn_array = decode_turn,
+        perf = perf
+    )
+
+    alu.build(
+        rob_index_array = rob_index_array_to_alu,
+        result_array = result_array_to_alu,
+        pc_result_array = pc_result_array_to_alu,
+        signal_array = signal_array_to_alu,
+        perf = perf
+    )
+
+    mul_alu.build(
+        rob_index_array = rob_index_array_to_mul_alu,
+        result_array = result_array_to_mul_alu,
+        pc_result_array = pc_result_array_to_mul_alu,
+        signal_array = signal_array_to_mul_alu,
+        perf = perf
+    )
+
+    div_alu.build(
+        rob_index_array = rob_index_array_to_div_alu,
+        result_array = result_array_to_div_alu,
+        pc_result_array = pc_result_array_to_div_alu,
+        signal_array = signal_array_to_div_alu,
+        div_busy_array = div_busy,
+        clear_signal_array = unit_clear_array,
+        perf = perf
+    )
+
+    # 和 ROB 一样放到最后 build，ebreak 时导出的计数器才能包含所有模块
+    core.build(
+        alu = alu,
+        mul_alu = mul_alu,
+        div_alu = div_alu,
+        rob_index_array_from_alu = rob_index_array_to_alu,
+        result_array_from_alu = result_array_to_alu,
+        pc_result_array_from_alu = pc_result_array_to_alu,
+        signal_array_from_alu = signal_array_to_alu,
+        rob_index_array_from_mul_alu = rob_index_array_to_mul_alu,
+        result_array_from_mul_alu = result_array_to_mul_alu,
+        signal_array_from_mul_alu = signal_array_to_mul_alu,
+        rob_index_array_from_div_alu = rob_index_array_to_div_alu,
+        result_array_from_div_alu = result_array_to_div_alu,
+        signal_array_from_div_alu = signal_array_to_div_alu,
+        div_busy_array = div_busy,
+        dcache_banks = dcache_banks,
+        depth_log = depth_log,
+        rob_full_array = rob_full,
+        clear_signal_array = clear_signal_array,
+        reset_pc_addr_array = reset_pc_addr,
+        bht_array = bht_array,
+        btb_target_array = btb_target_array,
+        bht_log_size = BHT_LOG_SIZE,
+        conf_array = conf_array,
+        commit_valid_array = commit_valid_array,
+        commit_addr_array = commit_addr_array,
+        dram = dram,
+        perf = perf
+    )
+    return [fetcher]
+
+def parse_perf(raw):
+    # 从模拟日志里取出 PerfCounters.dump 导出的计数器，按核分组；多核时名字前面有 coreK.，
+    # SMT 时每个线程前端的计数器名字前面还有 tN.，留在名字里
+    cores = {}
+    for line in raw.split('\n'):
+        m = re.search(r'perf\.([\w.]+): (\d+)', line)
+        if m is None:
+            continue
+        name, value = m.group(1), int(m.group(2))
+        core = 'core0'
+        c = re.match(r'(core\d+)\.(.*)', name)
+        if c is not None:
+            core, name = c.group(1), c.group(2)
+        cores.setdefault(core, {})[name] = value
+    return cores
+
+TOPDOWN = ['retiring', 'bad_speculation', 'frontend_refill', 'frontend_fetch', 'backend_memory', 'backend_core']
+
+def ratio(a, b):
+    return a / b if b else 0.0
+
+def summarize_perf(counters, threads):
+    # 乱序核和顺序核的计数器名字不一样，这里统一成一套
+    def get(*names):
+        for name in names:
+            if name in counters:
+                return counters[name]
+        return 0
+    # 前端的计数器 SMT 时每个线程各有一份（名字前面有 tN.），加起来算整个核的
+    def frontend(name):
+        return sum(value for key, value in counters.items() if re.fullmatch(rf'(t\d+\.)?{name}', key))
+    cycles = get('cycles')
+    insts = get('rob_commits', 'inorder_insts')
+    branches = get('rob_branches', 'inorder_branches')
+    mispredicts = get('rob_mispredictions', 'inorder_mispredictions')
+    summary = {
+        'cycles': cycles,
+        'insts': insts,
+        'ipc': ratio(insts, cycles),
+        'mpki': 1000 * ratio(mispredicts, insts),
+        'branch_mispredict_rate': ratio(mispredicts, branches),
+        'loads_pki': 1000 * ratio(get('rob_loads', 'inorder_loads'), insts),
+        'stores_pki': 1000 * ratio(get('rob_stores', 'inorder_stores'), insts),
+        'flushes': get('rob_flushes', 'inorder_mispredictions'),
+        'rob_full_cycles': get('rob_full_cycles'),
+        'rob_stall_cycles': get('rob_stall_cycles'),
+        'rs_full_cycles': get('rs_full_cycles'),
+        'lq_full_cycles': get('lq_full_cycles'),
+        'sq_full_cycles': get('sq_full_cycles'),
+        'lq_peak_used': get('rob_lq_peak_used'),
+        'sq_peak_used': get('rob_sq_peak_used'),
+        'mul_ops': get('mul_ops'),
+        # Zba / Zbb 指令在 ALU 里执行的次数（乱序核里包括错误路径上的）
+        'bitmanip_ops': get('alu_bitmanip_ops'),
+        'bitmanip_pki': 1000 * ratio(get('alu_bitmanip_ops'), insts),
+        'load_wakeups': get('lsq_load_wakeups'),
+        'load_replays': get('rs_load_replays'),
+    }
+    # CPI 栈：每一类周期数除以提交的指令数，各项加起来等于 CPI
+    summary['cpi_stack'] = {name: ratio(get(f'topdown_{name}'), insts) for name in TOPDOWN}
+    # 译码结果缓存每命中一次，省掉一次译码和两个 icache 半字 bank 各一次读
+    summary['uop_hit_rate'] = ratio(frontend('uop_hits'), frontend('uop_hits') + frontend('uop_misses'))
+    summary['decodes_saved'] = frontend('uop_hits')
+    summary['icache_reads_saved'] = 2 * frontend('uop_hits')
+    # 宏融合：每一对融合的指令少占一个 ROB / RS 条目
+    summary['fused_pairs'] = frontend('fusion_pairs')
+    summary['fused_pairs_pki'] = 1000 * ratio(frontend('fusion_pairs'), insts)
+    # 循环缓冲：重放的每一项都省掉一次取指（两个 icache 半字 bank 各读一次）和一次译码；
+    # 融合的一对只算一项，所以省掉的读和译码是下限。重放时前端没有气泡，省掉的气泡是
+    # 这些周期如果走取指这条路、按它平时的气泡率会出现的气泡数，是估算值
+    replayed = frontend('lsd_replayed_insts')
+    summary['lsd_hit_rate'] = ratio(replayed, replayed + frontend('decode_insts'))
+    summary['lsd_icache_reads_avoided'] = 2 * replayed
+    summary['lsd_decodes_avoided'] = replayed
+    summary['lsd_bubbles_removed'] = replayed * ratio(frontend('frontend_bubbles'), frontend('frontend_open_cycles'))
+    # 值预测：覆盖率是提交的 load 里用了预测值的比例，准确率是用了预测值的 load 里预测对的比例，
+    # 预测错的每次都要清空流水线
+    vp_used = get('vp_correct') + get('vp_squashes')
+    summary['vp_coverage'] = ratio(vp_used, get('vp_loads'))
+    summary['vp_accuracy'] = ratio(get('vp_correct'), vp_used)
+    summary['vp_mispredict_rate'] = ratio(get('vp_squashes'), vp_used)
+    summary['vp_squashes_pki'] = 1000 * ratio(get('vp_squashes'), insts)
+    if 'dram_accesses' in counters:
+        opened = get('dram_row_hits') + get('dram_row_conflicts') + get('dram_row_empty')
+        summary['dram_row_hit_rate'] = ratio(get('dram_row_hits'), opened)
+        summary['dram_avg_latency'] = ratio(get('dram_latency_cycles'), get('dram_accesses'))
+    if threads > 1:
+        for t in range(threads):
+            summary[f'ipc_t{t}'] = ratio(get(f'rob_commits_t{t}'), cycles)
+    return summary
+
+def report_perf(raw, cases, sim_seconds):
+    # 每次运行的计数器和汇总结果存到 perf.json，汇总结果同时打印出来
+    # sim_seconds 是模拟器跑完这次 workload 用的墙钟时间，换算成每秒模拟的周期数
+    cores = parse_perf(raw)
+    summaries = {core: summarize_perf(counters, len(cases)) for core, counters in sorted(cores.items())}
+    for core, s in summaries.items():
+        s['sim_seconds'] = sim_seconds
+        s['sim_khz'] = ratio(s['cycles'], 1000 * sim_seconds)
+        print(f"== {'+'.join(cases)} | {core} ==")
+        print(f"cycles: {s['cycles']} | insts: {s['insts']} | IPC: {s['ipc']:.3f} | MPKI: {s['mpki']:.2f} | "
+              f"mispredict rate: {100 * s['branch_mispredict_rate']:.1f}% | flushes: {s['flushes']}")
+        print(f"simulation: {sim_seconds:.2f} s | {s['sim_khz']:.1f} kcycles/s")
+        print(f"loads / kinst: {s['loads_pki']:.1f} | stores / kinst: {s['stores_pki']:.1f} | mul ops: {s['mul_ops']} | "
+              f"bitmanip ops: {s['bitmanip_ops']} ({s['bitmanip_pki']:.1f} / kinst) | "
+              f"full cycles: ROB {s['rob_full_cycles']} RS {s['rs_full_cycles']} LQ {s['lq_full_cycles']} SQ {s['sq_full_cycles']} | "
+              f"ROB occupancy stall cycles: {s['rob_stall_cycles']} | "
+              f"peak used: LQ {s['lq_peak_used']}/{LOAD_QUEUE_SIZE} SQ {s['sq_peak_used']}/{STORE_QUEUE_SIZE}")
+        stack = s['cpi_stack']
+        print(f"CPI stack: {sum(stack.values()):.3f} = " + " + ".join(f"{name} {stack[name]:.3f}" for name in TOPDOWN))
+        print(f"uop cache hit rate: {100 * s['uop_hit_rate']:.1f}% | decodes saved: {s['decodes_saved']} | "
+              f"icache bank reads saved: {s['icache_reads_saved']}")
+        print(f"fused pairs: {s['fused_pairs']} ({s['fused_pairs_pki']:.1f} / kinst)")
+        print(f"loop buffer hit rate: {100 * s['lsd_hit_rate']:.1f}% | icache bank reads avoided: {s['lsd_icache_reads_avoided']} | "
+              f"decodes avoided: {s['lsd_decodes_avoided']} | front-end bubbles removed (est.): {s['lsd_bubbles_removed']:.0f}")
+        print(f"value prediction: coverage {100 * s['vp_coverage']:.1f}% | accuracy {100 * s['vp_accuracy']:.1f}% | "
+              f"mispredict rate {100 * s['vp_mispredict_rate']:.1f}% | squashes / kinst: {s['vp_squashes_pki']:.2f}")
+        if 'dram_row_hit_rate' in s:
+            print(f"DRAM row hit rate: {100 * s['dram_row_hit_rate']:.1f}% | average latency: {s['dram_avg_latency']:.2f} cycles")
+        for t in range(len(cases)):
+            if f'ipc_t{t}' in s:
+                print(f"thread {t} ({cases[t]}) IPC: {s[f'ipc_t{t}']:.3f}")
+    with open(f'{workspace}/perf.json', 'w') as f:
+        json.dump({'workloads': cases, 'counters': cores, 'summary': summaries}, f, indent=2)
+    return summaries
+
+def build_cpu(depth_log: int, cases: list = ["tak"], in_order: bool = False, dram: bool = False):
+    # 给出两个 workload 时按 SMT 在同一个核上一起跑，例如 ["tak", "vector_add"]
+    # in_order 时换成顺序核，用来对比乱序核的 IPC，只支持单核、单线程
+    # dram 时在 dcache 后面接上 DRAM 时序模型（dram.py），访存延迟不再固定，计数器里有行缓冲命中率和平均延迟
+    threads = len(cases)
+    assert threads <= SMT_THREADS
+    assert not in_order or threads == 1, "the in-order core runs a single thread"
+    init_workspace(f"{current_path}/workloads", cases, 1 << (depth_log - 1))
+    with open(f'{workspace}/workload.config') as f:
+        raw = f.readline()
+        raw = raw.replace('offset:', "'offset':").replace('data_offset:', "'data_offset':")
+        offsets = eval(raw)
+        value = hex(offsets['data_offset'])
+        value = value[1:] if value[0] == '-' else value
+        value = value[2:]
+        open(f'{workspace}/workload.init', 'w').write(value)
+
+    # 多核的 workload 在 config 里写明要几个核
+    num_cores = offsets.get('cores', 1)
+    assert num_cores == 1 or threads == 1, "SMT is only supported on a single core"
+    assert num_cores == 1 or not in_order, "the in-order core is only built as a single core"
+
+    sys = SysBuilder("Tomasulo-CPU")
+
+    with sys:
+        snoop_ports = [SnoopPort(depth_log) for _ in range(num_cores)] if num_cores > 1 else []
+        halt_arrays = [RegArray(Bits(1), 1) for _ in range(num_cores)]
+        fetchers = []
+        if in_order:
+            fetchers += build_inorder_core(depth_log, dram)
+        else:
+            for hartid in range(num_cores):
+                fetchers += build_core(depth_log, hartid, snoop_ports, halt_arrays, threads, dram)
+
+        driver = Driver()
+        driver.build(fetchers)
     
     print(sys)
     conf = config(
@@ -193,10 +758,13 @@ def build_cpu(depth_log: int):
     simulator_path, verilog_path = elaborate(sys, **conf)
 
     # raw = utils.run_verilator(verilog_path)
+    start = time.time()
     raw = utils.run_simulator(simulator_path)
+    sim_seconds = time.time() - start
     with open(f'{workspace}/verilation.log', 'w') as f:
         f.write(raw)
     print(f"Verilation log saved to {workspace}/verilation.log")
+    report_perf(raw, cases, sim_seconds)
 
 depth_log = 16
 if __name__ == "__main__":
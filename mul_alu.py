@@ -1,6 +1,65 @@
 from assassyn.frontend import *
 from instruction import *
 from utils import *
+from perf import *
+
+MUL_STAGES = 2              # 乘法器的流水级数（至少为 2），压缩树的层数平均分到后面几级
+MUL_EARLY_OUT_BITS = 8      # 乘数能用这么多位有符号数表示时，只需要前几个 Booth 部分积，提前写回
+
+def booth_partial_products(alu_a, alu_b, rs1_sign, rs2_sign):
+    # radix-4 Booth 编码：33 位的乘数每次看 3 位，得到 17 个部分积，每个部分积都是 0, ±A, ±2A 左移 2i 位
+    a_ext = (rs1_sign & alu_a[31:31]).select(Bits(32)(0xffffffff), Bits(32)(0))
+    a = concat(a_ext, alu_a)
+    a2 = a << Bits(64)(1)
+    neg_a = (Int(64)(0) - a.bitcast(Int(64))).bitcast(Bits(64))
+    neg_a2 = neg_a << Bits(64)(1)
+
+    b_ext = rs2_sign & alu_b[31:31]
+    b_bits = [alu_b[i:i] for i in range(32)] + [b_ext, b_ext]
+
+    products = []
+    for i in range(17):
+        low = b_bits[2 * i - 1] if i > 0 else Bits(1)(0)
+        triple = concat(b_bits[2 * i + 1], b_bits[2 * i], low)
+        pp = Bits(64)(0)
+        pp = ((triple == Bits(3)(0b001)) | (triple == Bits(3)(0b010))).select(a, pp)
+        pp = (triple == Bits(3)(0b011)).select(a2, pp)
+        pp = (triple == Bits(3)(0b100)).select(neg_a2, pp)
+        pp = ((triple == Bits(3)(0b101)) | (triple == Bits(3)(0b110))).select(neg_a, pp)
+        products.append(pp << Bits(64)(2 * i))
+
+    # 乘数的高位全是符号位时，后面的 Booth 位都是 0，前 MUL_EARLY_OUT_BITS / 2 个部分积之和就是结果
+    high = concat(b_ext, alu_b[MUL_EARLY_OUT_BITS - 1:31])
+    high_ones = (1 << (34 - MUL_EARLY_OUT_BITS)) - 1
+    small = (high == Bits(34 - MUL_EARLY_OUT_BITS)(0)) | (high == Bits(34 - MUL_EARLY_OUT_BITS)(high_ones))
+    return products, small
+
+def wallace_level(terms):
+    # 一层 3:2 压缩
+    next_terms = []
+    while len(terms) >= 3:
+        a = terms.pop(0)
+        b = terms.pop(0)
+        c = terms.pop(0)
+
+        s = a ^ b ^ c
+        cout = (a & b) | (b & c) | (c & a)
+        cout = cout << Bits(64)(1)
+
+        next_terms.append(s)
+        next_terms.append(cout)
+    next_terms.extend(terms)
+    return next_terms
+
+def wallace_depth(n):
+    depth = 0
+    while n > 2:
+        n = (n // 3) * 2 + n % 3
+        depth += 1
+    return depth
+
+def add64(a, b):
+    return (a.bitcast(Int(64)) + b.bitcast(Int(64))).bitcast(Bits(64))
 
 class MUL_ALU(Module):
 
@@ -26,13 +85,14 @@ class MUL_ALU(Module):
         result_array: Array,
         pc_result_array: Array,
         signal_array: Array,
+        perf: PerfCounters,
     ):
         (
             valid,
             rob_index,
             alu_a,
             alu_b,
-            calc_type, 
+            calc_type,
             pc_addr,
             get_high_bit,
             rs1_sign,
@@ -40,80 +100,77 @@ class MUL_ALU(Module):
             clear
         ) = self.pop_all_ports(True)
 
-        partial_products = [RegArray(Bits(64), 1) for _ in range(33)]
-        partial_products_valid = RegArray(Bits(1), 1)
-        partial_result = Bits(64)(0)
-        partial_carry_result = Bits(64)(0)
-        partial_addr_array = RegArray(Bits(32), 1)
-        partial_rob_index_array = RegArray(Bits(3), 1)
-        partial_get_high_bit_array = RegArray(Bits(1), 1)
-        partial_rs1_sign_array = RegArray(Bits(1), 1)
-        partial_rs2_sign_array = RegArray(Bits(1), 1)
-
-        final_result = RegArray(Bits(64), 1)
-        final_carry_result = RegArray(Bits(64), 1)
-        final_product_valid = RegArray(Bits(1), 1)
-        final_addr_array = RegArray(Bits(32), 1)
-        final_rob_index_array = RegArray(Bits(3), 1)
-        final_get_high_bit_array = RegArray(Bits(1), 1)
-        final_rs1_sign_array = RegArray(Bits(1), 1)
-        final_rs2_sign_array = RegArray(Bits(1), 1)
-
-        alu_a = rs1_sign.select(concat(alu_a[31:31], alu_a), concat(Bits(1)(0), alu_a))  # Extend alu_a to 33 bits for sign handling
-        alu_b = rs2_sign.select(concat(alu_b[31:31], alu_b), concat(Bits(1)(0), alu_b))  # Extend alu_b to 33 bits for sign handling
-
-        alu_b = concat(Bits(31)(0), alu_b)  # Extend alu_b to 64 bits for shifting
+        assert MUL_STAGES >= 2
+        products, small = booth_partial_products(alu_a, alu_b, rs1_sign, rs2_sign)
+
+        # 每一级流水都带着这条乘法自己的状态往后走，写回时用的是随指令一起流动的 get_high_bit
+        levels = wallace_depth(len(products))
+        levels_per_stage = -(-levels // (MUL_STAGES - 1))
 
+        stage_valid = [RegArray(Bits(1), 1) for _ in range(MUL_STAGES)]
+        stage_rob_index = [RegArray(Bits(3), 1) for _ in range(MUL_STAGES)]
+        stage_addr = [RegArray(Bits(32), 1) for _ in range(MUL_STAGES)]
+        stage_get_high_bit = [RegArray(Bits(1), 1) for _ in range(MUL_STAGES)]
+        stage_small = RegArray(Bits(1), 1)
+
+        # 第 0 级：锁存 Booth 部分积
+        stage_terms = []
+        terms = [RegArray(Bits(64), 1) for _ in range(len(products))]
         with Condition(valid):
-            log("alu_a: 0x{:08x} | alu_b: 0x{:08x} | pc_addr: 0x{:08x}", alu_a, alu_b, pc_addr)
-            for i in range(33):
-                alu_a_bit = ((alu_a >> Bits(32)(i)) & Bits(33)(1))[0:0]
-                partial_products[i][0] = alu_a_bit.select(alu_b << Bits(32)(i), Bits(64)(0))
-            partial_addr_array[0] = pc_addr
-            partial_rob_index_array[0] = rob_index
-            partial_get_high_bit_array[0] = get_high_bit
-            partial_rs1_sign_array[0] = rs1_sign
-            partial_rs2_sign_array[0] = rs2_sign
-        partial_products_valid[0] = valid.select(Bits(1)(1), Bits(1)(0)) & ~clear
-
-        with Condition(partial_products_valid[0]):
-            log("Starting Wallace Tree Reduction")
-            # Wallace Tree Reduction
-            terms = [partial_products[i][0] for i in range(33)]
-            
-            while len(terms) > 2:
-                next_terms = []
-                while len(terms) >= 3:
-                    a = terms.pop(0)
-                    b = terms.pop(0)
-                    c = terms.pop(0)
-                    
-                    s = a ^ b ^ c
-                    cout = (a & b) | (b & c) | (c & a)
-                    cout = cout << Bits(64)(1)
-                    
-                    next_terms.append(s)
-                    next_terms.append(cout)
-                
-                next_terms.extend(terms)
-                terms = next_terms
-            
-            final_result[0] = terms[0]
-            final_carry_result[0] = terms[1]
-            final_addr_array[0] = partial_addr_array[0]
-            final_rob_index_array[0] = partial_rob_index_array[0]
-            final_get_high_bit_array[0] = partial_get_high_bit_array[0]
-            final_rs1_sign_array[0] = partial_rs1_sign_array[0]
-            final_rs2_sign_array[0] = partial_rs2_sign_array[0]
-        final_product_valid[0] = partial_products_valid[0].select(Bits(1)(1), Bits(1)(0)) & ~clear
-
-        signal_array[0] = final_product_valid[0].select(Bits(1)(1), Bits(1)(0)) & ~clear
-        with Condition(final_product_valid[0] & ~clear):
-            log("MUL_ALU Result: 0x{:016x}", (final_result[0].bitcast(Int(64)) + final_carry_result[0].bitcast(Int(64))).bitcast(Bits(64)))
-            result_array[0] = get_high_bit.select(
-                (final_result[0].bitcast(Int(64)) + final_carry_result[0].bitcast(Int(64))).bitcast(Bits(64))[32:63],
-                (final_result[0].bitcast(Int(64)) + final_carry_result[0].bitcast(Int(64))).bitcast(Bits(64))[0:31]
-            )
-            rob_index_array[0] = final_rob_index_array[0]
-            pc_result_array[0] = (final_addr_array[0].bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
+            # log("alu_a: 0x{:08x} | alu_b: 0x{:08x} | pc_addr: 0x{:08x}", alu_a, alu_b, pc_addr)
+            for reg, pp in zip(terms, products):
+                reg[0] = pp
+            stage_rob_index[0][0] = rob_index
+            stage_addr[0][0] = pc_addr
+            stage_get_high_bit[0][0] = get_high_bit
+            stage_small[0] = small
+        stage_valid[0][0] = valid & ~clear
+        stage_terms.append(terms)
+
+        last = MUL_STAGES - 1
+        last_busy = stage_valid[last][0]
+
+        # 提前结束：乘数足够小，而且这个周期最后一级没有结果要写回时，直接把前几个部分积加起来写回
+        early_out = stage_valid[0][0] & stage_small[0] & ~last_busy & ~clear
+        early_terms = [stage_terms[0][i][0] for i in range(MUL_EARLY_OUT_BITS // 2)]
+        early_product = early_terms[0]
+        for term in early_terms[1:]:
+            early_product = add64(early_product, term)
+
+        # 后面几级：每级做 levels_per_stage 层压缩
+        for k in range(1, MUL_STAGES):
+            prev = [reg[0] for reg in stage_terms[k - 1]]
+            for _ in range(levels_per_stage):
+                prev = wallace_level(prev)
+            regs = [RegArray(Bits(64), 1) for _ in range(len(prev))]
+            move = stage_valid[k - 1][0] & ~(early_out if k == 1 else Bits(1)(0))
+            with Condition(stage_valid[k - 1][0]):
+                for reg, term in zip(regs, prev):
+                    reg[0] = term
+                stage_rob_index[k][0] = stage_rob_index[k - 1][0]
+                stage_addr[k][0] = stage_addr[k - 1][0]
+                stage_get_high_bit[k][0] = stage_get_high_bit[k - 1][0]
+            stage_valid[k][0] = move & ~clear
+            stage_terms.append(regs)
+
+        final_terms = [reg[0] for reg in stage_terms[last]]
+        while len(final_terms) > 2:
+            final_terms = wallace_level(final_terms)
+        final_product = add64(final_terms[0], final_terms[1]) if len(final_terms) == 2 else final_terms[0]
+
+        write_back = (last_busy | early_out) & ~clear
+        product = last_busy.select(final_product, early_product)
+        high_bit = last_busy.select(stage_get_high_bit[last][0], stage_get_high_bit[0][0])
+        signal_array[0] = write_back.select(Bits(1)(1), Bits(1)(0))
+        with Condition(write_back):
+            # log("MUL_ALU Result: 0x{:016x}", product)
+            result_array[0] = high_bit.select(product[32:63], product[0:31])
+            rob_index_array[0] = last_busy.select(stage_rob_index[last][0], stage_rob_index[0][0])
+            pc_result_array[0] = (last_busy.select(stage_addr[last][0], stage_addr[0][0]).bitcast(Int(32)) + Int(32)(4)).bitcast(Bits(32))
 
+        busy = Bits(1)(0)
+        for k in range(MUL_STAGES):
+            busy = busy | stage_valid[k][0]
+        perf.incr("mul_ops", valid & ~clear)
+        perf.incr("mul_busy_cycles", busy)
+        perf.incr("mul_early_out", early_out)
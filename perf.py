@@ -0,0 +1,43 @@
+from assassyn.frontend import *
+
+class PerfCounters:
+    # 事件计数器的集合，每个计数器只能在一个模块里被累加
+
+    def __init__(self, prefix = ''):
+        self.prefix = prefix        # 多核时区分是哪个核的计数器
+        self.counters = {}
+        self.children = []          # SMT 时每个线程的前端各有一组计数器，跟着这一组一起导出
+
+    def child(self, name):
+        sub = PerfCounters(f"{self.prefix}{name}.")
+        self.children.append(sub)
+        return sub
+
+    def counter(self, name):
+        if name not in self.counters:
+            self.counters[name] = RegArray(UInt(32), 1, initializer = [0])
+        return self.counters[name]
+
+    def incr(self, name, cond, amount = None):
+        cnt = self.counter(name)
+        amount = UInt(32)(1) if amount is None else amount
+        with Condition(cond):
+            cnt[0] = cnt[0] + amount
+
+    def peak(self, name, value):
+        # 记录 value 出现过的最大值，用来检查队列占用有没有越过上界
+        cnt = self.counter(name)
+        with Condition(value > cnt[0]):
+            cnt[0] = value
+
+    def dump(self):
+        # 导出成 perf.begin 和 perf.end 之间的一段，每行一个 perf.<前缀><名字>: <值>，main.py 跑完以后从日志里解析
+        log(f"perf.begin {self.prefix}")
+        self.dump_counters()
+        log(f"perf.end {self.prefix}")
+
+    def dump_counters(self):
+        for name, cnt in self.counters.items():
+            log(f"perf.{self.prefix}{name}: {{}}", cnt[0])
+        for sub in self.children:
+            sub.dump_counters()
@@ -0,0 +1,65 @@
+from assassyn.frontend import *
+from instruction import *
+from utils import *
+from perf import *
+from ROB import *
+
+SMT_THREADS = 2     # 一个核最多同时跑几个线程，线程号只有 1 位
+
+class ThreadArbiter(Downstream):
+    # SMT 时每个线程有自己的取指和译码，后端（ROB、RS、各个执行单元、LSQ）共用
+    # 每个周期只让一个线程取指，按 ICOUNT 挑：ROB 里指令少的线程优先，一样多时轮流
+    # 这个线程取到的指令下个周期在它的译码器里，所以译码器发往 ROB 的权利晚一个周期跟着走
+
+    def __init__(self):
+        super().__init__()
+        self.name = "TA"
+
+    @downstream.combinational
+    def build(
+        self,
+        rob: ROB,
+        decoder_outs: list,
+        fetch_turn_array: Array,
+        decode_turn_array: Array,
+        thread_count_arrays: list,
+        thread_halt_arrays: list,
+        perf: PerfCounters
+    ):
+        # 没被调用的译码器这个周期没有输出，按不发送处理
+        outs = []
+        for out in decoder_outs:
+            outs.append({
+                'receive': out['receive'].optional(Bits(1)(0)),
+                'signals': {k: v.optional(v.dtype(0)) for k, v in out['signals'].items()},
+                'addr': out['addr'].optional(Bits(32)(0)),
+                'predicted_taken': out['predicted_taken'].optional(Bits(1)(0)),
+                'pred_next_pc': out['pred_next_pc'].optional(Bits(32)(0)),
+            })
+
+        # 只有轮到的那个译码器会发，按轮到的线程转发给 ROB
+        tid = decode_turn_array[0]
+        rob.async_called(
+            receive = by_thread(tid, [out['receive'] for out in outs]),
+            signals = decoder_signals.bundle(**{k: by_thread(tid, [out['signals'][k] for out in outs]) for k in outs[0]['signals']}),
+            addr = by_thread(tid, [out['addr'] for out in outs]),
+            predicted_taken = by_thread(tid, [out['predicted_taken'] for out in outs]),
+            pred_next_pc = by_thread(tid, [out['pred_next_pc'] for out in outs]),
+            tid = tid
+        )
+
+        # 停下来的线程不再取指；两个线程都在跑时 ROB 里指令少的先取，一样多就换另一个线程
+        count0 = thread_count_arrays[0][0]
+        count1 = thread_count_arrays[1][0]
+        halted0 = thread_halt_arrays[0][0]
+        halted1 = thread_halt_arrays[1][0]
+        last = fetch_turn_array[0]
+        prefer1 = (count1 < count0) | ((count1 == count0) & (last == Bits(1)(0)))
+        pick1 = ~halted1 & (halted0 | prefer1)
+        next_turn = pick1.select(Bits(1)(1), Bits(1)(0))
+        fetch_turn_array[0] = next_turn
+        decode_turn_array[0] = last
+
+        for t in range(SMT_THREADS):
+            perf.incr(f"smt_fetch_turns_t{t}", last == Bits(1)(t))
+        perf.incr("smt_turn_switches", next_turn != last)
@@ -11,4 +11,46 @@ def read_mux(arrs, idx_val, size, width):
     return_value = Bits(width)(0)
     for i in range(size):
         return_value = (Bits(5)(i) == idx_val.bitcast(Bits(5))).select(arrs[i][0], return_value)
-    return return_value
\ No newline at end of file
+    return return_value
+
+def dcache_words(dout_lanes):
+    # 每个 bank 由 4 个字节宽的 SRAM 拼成，dout_lanes[i][j] 是第 i 个 bank 第 j 个字节的输出
+    return [concat(lanes[3][0], lanes[2][0], lanes[1][0], lanes[0][0]).bitcast(Bits(32)) for lanes in dout_lanes]
+
+def load_bus_value(dout_lanes, bank, place, length, signed):
+    # 从各个 dcache bank 的输出里取出这次 load 的结果，按照访存长度截取并做符号扩展
+    word = Bits(32)(0)
+    for i, bank_word in enumerate(dcache_words(dout_lanes)):
+        word = (bank == Bits(1)(i)).select(bank_word, word)
+    result_byte = Bits(8)(0)
+    result_byte = (place == Bits(2)(0)).select(word[0:7], result_byte)
+    result_byte = (place == Bits(2)(1)).select(word[8:15], result_byte)
+    result_byte = (place == Bits(2)(2)).select(word[16:23], result_byte)
+    result_byte = (place == Bits(2)(3)).select(word[24:31], result_byte)
+    result_half = place[1:1].select(word[16:31], word[0:15])
+    byte_ext = (signed & result_byte[7:7]).select(Bits(24)(0xffffff), Bits(24)(0))
+    half_ext = (signed & result_half[15:15]).select(Bits(16)(0xffff), Bits(16)(0))
+    result = word
+    result = (length == Bits(2)(0)).select(concat(byte_ext, result_byte), result)
+    result = (length == Bits(2)(1)).select(concat(half_ext, result_half), result)
+    return result
+
+def icache_window(dout_arrays, pc):
+    # icache 按半字交错成两个 bank：偶数半字在 dout_arrays[0]，奇数半字在 dout_arrays[1]
+    # 两个 bank 一起读出从 pc 开始的 32 位，跨字边界的 32 位指令也能在一个周期取到
+    even = dout_arrays[0][0].bitcast(Bits(16))
+    odd = dout_arrays[1][0].bitcast(Bits(16))
+    low = pc[1:1].select(odd, even)
+    high = pc[1:1].select(even, odd)
+    return concat(high, low)
+
+def inst_length(window):
+    # 低两位不是 11 的是 16 位压缩指令
+    return (window[0:1] == Bits(2)(0b11)).select(Int(32)(4), Int(32)(2))
+
+def by_thread(tid, values):
+    # SMT 时按线程号从每个线程各自的一份里挑出一个；只有一个线程时直接返回，不生成多路选择器
+    result = values[0]
+    for t in range(1, len(values)):
+        result = (tid == Bits(1)(t)).select(values[t], result)
+    return result
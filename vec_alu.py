@@ -0,0 +1,87 @@
+from assassyn.frontend import *
+from instruction import *
+from utils import *
+from perf import *
+from mul_alu import booth_partial_products, wallace_level, add64
+
+VLANES = 4      # 每个向量寄存器有几个 32 位的 lane
+VREGS = 8       # 向量寄存器的个数
+
+class VEC_OP:
+    # 向量指令放在 custom-0 编码空间里，func3 区分具体的操作
+    LOAD = 0b000        # vle32 vd, (rs1)
+    STORE = 0b001       # vse32 vs2, (rs1)
+    ADD = 0b010         # vadd vd, vs1, vs2
+    MUL = 0b011         # vmul vd, vs1, vs2，每个 lane 取乘积的低 32 位
+    REDSUM = 0b100      # vredsum rd, vs1，把各个 lane 加起来写回标量寄存器
+
+def mul_low32(a, b):
+    terms = booth_partial_products(a, b, Bits(1)(0), Bits(1)(0))[0]
+    while len(terms) > 2:
+        terms = wallace_level(terms)
+    return add64(terms[0], terms[1])[0:31]
+
+def add32(a, b):
+    return (a.bitcast(Int(32)) + b.bitcast(Int(32))).bitcast(Bits(32))
+
+class VEC_ALU(Module):
+
+    def __init__(self):
+        super().__init__(ports = {
+            "valid": Port(Bits(1)),
+            "rob_index": Port(Bits(3)),
+            "op": Port(Bits(3)),
+            "vd": Port(Bits(3)),
+            "vs1": Port(Bits(3)),
+            "vs2": Port(Bits(3)),
+        })
+        self.name = "VEC_ALU"
+
+    @module.combinational
+    def build(
+        self,
+        vrf: list,
+        rob_index_array: Array,
+        signal_array: Array,
+        write_vrf_array: Array,
+        vd_array: Array,
+        lane_result_arrays: list,
+        scalar_result_array: Array,
+        clear_signal_array: Array,
+        perf: PerfCounters,
+    ):
+        (
+            valid,
+            rob_index,
+            op,
+            vd,
+            vs1,
+            vs2
+        ) = self.pop_all_ports(True)
+
+        # 向量指令只在成为 ROB head 的时候执行，这时更早的指令都已经提交，向量寄存器堆不需要重命名
+        # 每个 lane 都有自己的加法器和乘法器，结果交给 ROB 写回向量寄存器堆
+        a = [vrf[lane][vs1] for lane in range(VLANES)]
+        b = [vrf[lane][vs2] for lane in range(VLANES)]
+
+        is_mul = (op == Bits(3)(VEC_OP.MUL))
+        is_redsum = (op == Bits(3)(VEC_OP.REDSUM))
+        lanes = [is_mul.select(mul_low32(a[lane], b[lane]), add32(a[lane], b[lane])) for lane in range(VLANES)]
+
+        scalar = a[0]
+        for lane in range(1, VLANES):
+            scalar = add32(scalar, a[lane])
+
+        fire = valid & ~clear_signal_array[0]
+        signal_array[0] = fire.select(Bits(1)(1), Bits(1)(0))
+        with Condition(fire):
+            # log("VEC_ALU | op: {} | vd: v{} | vs1: v{} | vs2: v{}", op, vd, vs1, vs2)
+            rob_index_array[0] = rob_index
+            vd_array[0] = vd
+            write_vrf_array[0] = ~is_redsum
+            for result_array, result in zip(lane_result_arrays, lanes):
+                result_array[0] = result
+            scalar_result_array[0] = scalar
+
+        perf.incr("vec_ops", fire)
+        perf.incr("vec_lane_ops", fire & ~is_redsum, UInt(32)(VLANES))
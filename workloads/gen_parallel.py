@@ -0,0 +1,97 @@
+import os
+
+# 生成 vector_add / vector_multiply 的多核版本：每个核从 a0 里拿到自己的 hartid，
+# 按 hartid 交错地处理一部分元素，用 amoadd.w 把部分和加到 total 上，
+# 再用 lr.w / sc.w 给 done 加一，等所有核都做完以后每个核都把 total 读进 a0
+
+def encode_r(opcode, rd, funct3, rs1, rs2, funct7):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_i(opcode, rd, funct3, rs1, imm):
+    if imm < 0: imm += (1 << 12)
+    return (imm << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_s(opcode, funct3, rs1, rs2, imm):
+    if imm < 0: imm += (1 << 12)
+    imm_11_5 = (imm >> 5) & 0x7F
+    imm_4_0 = imm & 0x1F
+    return (imm_11_5 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (imm_4_0 << 7) | opcode
+
+def encode_b(opcode, funct3, rs1, rs2, imm):
+    if imm < 0: imm += (1 << 13)
+    imm_12 = (imm >> 12) & 1
+    imm_10_5 = (imm >> 5) & 0x3F
+    imm_4_1 = (imm >> 1) & 0xF
+    imm_11 = (imm >> 11) & 1
+    return (imm_12 << 31) | (imm_10_5 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (imm_11 << 7) | (imm_4_1 << 8) | opcode
+
+def amoadd_w(rd, rs2, rs1):
+    return encode_r(0x2f, rd, 0b010, rs1, rs2, 0b0000000)
+
+def lr_w(rd, rs1):
+    return encode_r(0x2f, rd, 0b010, rs1, 0, 0b0001000)
+
+def sc_w(rd, rs2, rs1):
+    return encode_r(0x2f, rd, 0b010, rs1, rs2, 0b0001100)
+
+def to_hex(val):
+    return f"{val:08x}"
+
+N = 20
+TOTAL = 3 * N * 4       # total 和 done 紧跟在 c 后面
+DONE = TOTAL + 4
+
+def program(op_name, cores):
+    op = encode_r(0x33, 30, 0, 30, 31, 0b0000001 if op_name == 'mul' else 0)
+    step = 4 * cores
+    return [
+        (encode_i(0x13, 5, 0, 10, 0),         "addi x5, x10, 0     i = hartid"),
+        (encode_i(0x13, 6, 0, 0, N),          f"addi x6, x0, {N}     limit = {N}"),
+        (encode_i(0x13, 7, 1, 10, 2),         "slli x7, x10, 2     base_a = hartid * 4"),
+        (encode_i(0x13, 28, 0, 7, 80),        "addi x28, x7, 80    base_b = base_a + 80"),
+        (encode_i(0x13, 29, 0, 7, 160),       "addi x29, x7, 160   base_c = base_a + 160"),
+        (encode_i(0x13, 11, 0, 0, 0),         "addi x11, x0, 0     partial = 0"),
+        (encode_i(0x03, 30, 2, 7, 0),         "lw x30, 0(x7)       x30 = a[i]"),
+        (encode_i(0x03, 31, 2, 28, 0),        "lw x31, 0(x28)      x31 = b[i]"),
+        (op,                                  f"{op_name} x30, x30, x31".ljust(20) + "x30 = a[i] " + ('*' if op_name == 'mul' else '+') + " b[i]"),
+        (encode_s(0x23, 2, 29, 30, 0),        "sw x30, 0(x29)      c[i] = x30"),
+        (encode_r(0x33, 11, 0, 11, 30, 0),    "add x11, x11, x30   partial += x30"),
+        (encode_i(0x13, 7, 0, 7, step),       f"addi x7, x7, {step}".ljust(20) + f"base_a += {cores}"),
+        (encode_i(0x13, 28, 0, 28, step),     f"addi x28, x28, {step}".ljust(20) + f"base_b += {cores}"),
+        (encode_i(0x13, 29, 0, 29, step),     f"addi x29, x29, {step}".ljust(20) + f"base_c += {cores}"),
+        (encode_i(0x13, 5, 0, 5, cores),      f"addi x5, x5, {cores}".ljust(20) + f"i += {cores}"),
+        (encode_b(0x63, 4, 5, 6, -36),        "blt x5, x6, -36     goto loop"),
+        (encode_i(0x13, 12, 0, 0, TOTAL),     f"addi x12, x0, {TOTAL}   &total"),
+        (amoadd_w(0, 11, 12),                 "amoadd.w x0, x11, (x12)  total += partial"),
+        (encode_i(0x13, 14, 0, 0, DONE),      f"addi x14, x0, {DONE}   &done"),
+        (lr_w(16, 14),                        "lr.w x16, (x14)     retry: x16 = done"),
+        (encode_i(0x13, 16, 0, 16, 1),        "addi x16, x16, 1    x16++"),
+        (sc_w(17, 16, 14),                    "sc.w x17, x16, (x14)"),
+        (encode_b(0x63, 1, 17, 0, -12),       "bne x17, x0, -12    sc 失败就重来"),
+        (encode_i(0x13, 15, 0, 0, cores),     f"addi x15, x0, {cores}".ljust(20) + "cores"),
+        (encode_i(0x03, 16, 2, 14, 0),        "lw x16, 0(x14)      wait: x16 = done"),
+        (encode_b(0x63, 4, 16, 15, -4),       "blt x16, x15, -4    还有核没做完就接着等"),
+        (encode_i(0x03, 10, 2, 12, 0),        "lw x10, 0(x12)      a0 = total"),
+        (0x00100073,                          "ebreak"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+    ]
+
+a = list(range(1, N + 1))
+b = list(range(N + 1, 2 * N + 1))
+
+def to_hex_data(val):
+    return f"{val & 0xffffffff:x}"
+
+base = os.path.dirname(os.path.abspath(__file__))
+for kernel, op_name in [("vector_add", "add"), ("vector_multiply", "mul")]:
+    for cores in [1, 2, 4]:
+        case = f"{kernel}_par{cores}"
+        with open(f"{base}/{case}.exe", "w") as f:
+            for i, (inst, comment) in enumerate(program(op_name, cores)):
+                f.write(f"{to_hex(inst)} // {i*4:3}: {comment}\n")
+        with open(f"{base}/{case}.data", "w") as f:
+            f.write('\n'.join(to_hex_data(x) for x in a + b + [0] * N + [0, 0]) + '\n')
+        with open(f"{base}/{case}.config", "w") as f:
+            f.write(f"{{ 'offset': 0, 'data_offset': 4096, 'cores': {cores} }}\n")
@@ -0,0 +1,84 @@
+import os
+
+# 生成 vector_add / vector_multiply 的向量版本：每条向量指令一次处理 4 个元素
+# 向量指令放在 custom-0（opcode 0x0b），func3 区分操作，见 vec_alu.py
+
+def encode_r(opcode, rd, funct3, rs1, rs2, funct7):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_i(opcode, rd, funct3, rs1, imm):
+    if imm < 0: imm += (1 << 12)
+    return (imm << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) | opcode
+
+def encode_b(opcode, funct3, rs1, rs2, imm):
+    if imm < 0: imm += (1 << 13)
+    imm_12 = (imm >> 12) & 1
+    imm_10_5 = (imm >> 5) & 0x3F
+    imm_4_1 = (imm >> 1) & 0xF
+    imm_11 = (imm >> 11) & 1
+    return (imm_12 << 31) | (imm_10_5 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) | (imm_11 << 7) | (imm_4_1 << 8) | opcode
+
+def vle32(vd, rs1):
+    return encode_r(0x0b, vd, 0b000, rs1, 0, 0)
+
+def vse32(vs, rs1):
+    return encode_r(0x0b, 0, 0b001, rs1, vs, 0)
+
+def varith(func3, vd, vs1, vs2):
+    return encode_r(0x0b, vd, func3, vs1, vs2, 0)
+
+def vredsum(rd, vs1):
+    return encode_r(0x0b, rd, 0b100, vs1, 0, 0)
+
+def to_hex(val):
+    return f"{val:08x}"
+
+VLANES = 4
+N = 20
+
+def program(op_name, func3):
+    return [
+        (encode_i(0x13, 5, 0, 0, 0),          "addi x5, x0, 0      i = 0"),
+        (encode_i(0x13, 6, 0, 0, N // VLANES), f"addi x6, x0, {N // VLANES}      limit = {N} / {VLANES}"),
+        (encode_i(0x13, 7, 0, 0, 0),          "addi x7, x0, 0      base_a = 0"),
+        (encode_i(0x13, 28, 0, 0, 80),        "addi x28, x0, 80    base_b = 80"),
+        (encode_i(0x13, 29, 0, 0, 160),       "addi x29, x0, 160   base_c = 160"),
+        (vle32(1, 7),                         "vle32 v1, (x7)      v1 = a[i:i+4]"),
+        (vle32(2, 28),                        "vle32 v2, (x28)     v2 = b[i:i+4]"),
+        (varith(func3, 3, 1, 2),              f"{op_name} v3, v1, v2" + ' ' * (9 - len(op_name)) + f"v3 = a {'+' if op_name == 'vadd' else '*'} b"),
+        (vse32(3, 29),                        "vse32 v3, (x29)     c[i:i+4] = v3"),
+        (encode_i(0x13, 7, 0, 7, 16),         "addi x7, x7, 16     base_a += 4"),
+        (encode_i(0x13, 28, 0, 28, 16),       "addi x28, x28, 16   base_b += 4"),
+        (encode_i(0x13, 29, 0, 29, 16),       "addi x29, x29, 16   base_c += 4"),
+        (encode_i(0x13, 5, 0, 5, 1),          "addi x5, x5, 1      i++"),
+        (encode_b(0x63, 4, 5, 6, -32),        "blt x5, x6, -32     goto loop_1"),
+        (encode_i(0x13, 5, 0, 0, 0),          "addi x5, x0, 0      i = 0"),
+        (encode_i(0x13, 29, 0, 0, 160),       "addi x29, x0, 160   base_c = 160"),
+        (encode_i(0x13, 10, 0, 0, 0),         "addi x10, x0, 0     ans = 0"),
+        (vle32(4, 29),                        "vle32 v4, (x29)     v4 = c[i:i+4]"),
+        (vredsum(30, 4),                      "vredsum x30, v4     x30 = sum(v4)"),
+        (encode_r(0x33, 10, 0, 10, 30, 0),    "add x10, x10, x30   ans += x30"),
+        (encode_i(0x13, 29, 0, 29, 16),       "addi x29, x29, 16   base_c += 4"),
+        (encode_i(0x13, 5, 0, 5, 1),          "addi x5, x5, 1      i++"),
+        (encode_b(0x63, 4, 5, 6, -20),        "blt x5, x6, -20     goto loop_2"),
+        (0x00100073,                          "ebreak"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+        (encode_r(0x33, 0, 0, 0, 0, 0),       "add x0, x0, x0      nop"),
+    ]
+
+a = list(range(1, N + 1))
+b = list(range(N + 1, 2 * N + 1))
+
+def to_hex_data(val):
+    return f"{val & 0xffffffff:x}"
+
+base = os.path.dirname(os.path.abspath(__file__))
+for case, op_name, func3, data_offset in [("vector_add_vec", "vadd", 0b010, 4096), ("vector_multiply_vec", "vmul", 0b011, 0)]:
+    with open(f"{base}/{case}.exe", "w") as f:
+        for i, (inst, comment) in enumerate(program(op_name, func3)):
+            f.write(f"{to_hex(inst)} // {i*4:2}: {comment}\n")
+    with open(f"{base}/{case}.data", "w") as f:
+        f.write('\n'.join(to_hex_data(x) for x in a + b + [0] * N) + '\n')
+    with open(f"{base}/{case}.config", "w") as f:
+        f.write(f"{{ 'offset': 0, 'data_offset': {data_offset} }}\n")